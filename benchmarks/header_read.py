@@ -0,0 +1,88 @@
+"""
+Benchmark for parsing TIFF headers from storage with a high latency per read.
+
+With ImageDePHI installed, run with `python benchmarks/header_read.py IMAGE...`.
+Each read of the file is delayed, as on network storage. The headers of each image are parsed
+with tifftools through a buffered file, as tifftools does when given a path, and through the
+`BlockReader` that ImageDePHI uses.
+"""
+
+from __future__ import annotations
+
+import io
+from pathlib import Path
+import time
+from typing import Any, BinaryIO, Callable, cast
+
+import click
+import tifftools
+
+from imagedephi.utils.tiff import HEADER_BLOCK_SIZE, BlockReader
+
+
+class SlowFile(io.RawIOBase):
+    """A file where each read takes an additional fixed time."""
+
+    def __init__(self, path: Path, latency: float) -> None:
+        super().__init__()
+        self.raw = open(path, "rb", buffering=0)
+        self.latency = latency
+        self.read_count = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        return self.raw.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self.raw.tell()
+
+    def readinto(self, buffer: Any) -> int | None:
+        time.sleep(self.latency)
+        self.read_count += 1
+        return self.raw.readinto(buffer)
+
+    def close(self) -> None:
+        self.raw.close()
+        super().close()
+
+
+def _time(name: str, read: Callable[[SlowFile], Any], path: Path, latency: float) -> float:
+    with SlowFile(path, latency) as slow_file:
+        start = time.perf_counter()
+        read(slow_file)
+        elapsed = time.perf_counter() - start
+        click.echo(f"  {name}: {elapsed * 1000:.1f} ms, {slow_file.read_count} reads")
+    return elapsed
+
+
+@click.command
+@click.argument("images", nargs=-1, required=True, type=click.Path(exists=True, path_type=Path))
+@click.option("--latency", default=5.0, help="Time added to each read, in milliseconds.")
+@click.option("--block-size", default=HEADER_BLOCK_SIZE, help="Block size of the block reader.")
+def header_read(images: list[Path], latency: float, block_size: int) -> None:
+    for image in images:
+        click.echo(f"{image.name}:")
+        buffered_time = _time(
+            "buffered",
+            lambda slow_file: tifftools.read_tiff(cast(BinaryIO, io.BufferedReader(slow_file))),
+            image,
+            latency / 1000,
+        )
+        block_time = _time(
+            "block reader",
+            lambda slow_file: tifftools.read_tiff(
+                cast(BinaryIO, BlockReader(cast(BinaryIO, slow_file), block_size))
+            ),
+            image,
+            latency / 1000,
+        )
+        click.echo(f"  {buffered_time / block_time:.1f}x faster")
+
+
+if __name__ == "__main__":
+    header_read()
@@ -0,0 +1,91 @@
+"""
+Memory benchmark for holding redaction plan reports for a large cohort.
+
+With ImageDePHI installed, run with `python benchmarks/plan_memory.py`.
+Synthetic summary-level reports, shaped like those of SVS images, are held both as plain dicts
+and in a `PlanSession`, and the memory allocated for each is measured with `tracemalloc`.
+"""
+
+from __future__ import annotations
+
+from collections import OrderedDict
+import time
+import tracemalloc
+from typing import Any, Callable
+
+import click
+
+from imagedephi.redact.plan_session import PlanSession, sort_image_tags
+
+TAG_NAMES = [
+    "AppMag",
+    "BitsPerSample",
+    "Compression",
+    "DateTime",
+    "Filename",
+    "ImageDescription",
+    "ImageLength",
+    "ImageWidth",
+    "Make",
+    "Model",
+    "ResolutionUnit",
+    "SamplesPerPixel",
+    "ScanScope ID",
+    "Software",
+    "TileLength",
+    "TileWidth",
+    "User",
+    "XResolution",
+    "YResolution",
+]
+
+
+def _report(image_index: int) -> dict[str, Any]:
+    # Build new strings for each image, as parsing each file would
+    report: dict[str, Any] = {
+        "".join(name): {
+            "action": "delete" if tag_index % 3 == 0 else "keep",
+            "value": [image_index + tag_index] if tag_index % 2 else f"value {image_index}",
+        }
+        for tag_index, name in enumerate(TAG_NAMES)
+    }
+    report["ICC Profile"] = {
+        "action": "delete",
+        "binary": {"value": "0x" + "ab" * 32, "bytes": 4096, "sha256": "cd" * 32},
+    }
+    report["comprehensive"] = True
+    report["associated_images"] = 2
+    return report
+
+
+def _measure(name: str, build: Callable[[], Any]) -> None:
+    tracemalloc.start()
+    start = time.perf_counter()
+    retained = build()
+    elapsed = time.perf_counter() - start
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    click.echo(f"{name}: {size / 2**20:.1f} MiB, built in {elapsed:.2f} s")
+    del retained
+
+
+@click.command
+@click.option("--images", default=100_000, help="Number of images in the cohort.")
+def plan_memory(images: int) -> None:
+    def build_dicts() -> OrderedDict[str, Any]:
+        return OrderedDict(
+            (f"slide-{index}.svs", sort_image_tags(_report(index))) for index in range(images)
+        )
+
+    def build_session() -> PlanSession:
+        session = PlanSession(max_images=None)
+        for index in range(images):
+            session.add_report(f"slide-{index}.svs", _report(index), comprehensive=True)
+        return session
+
+    _measure(f"{images} images as dicts", build_dicts)
+    _measure(f"{images} images in a plan session", build_session)
+
+
+if __name__ == "__main__":
+    plan_memory()
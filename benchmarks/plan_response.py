@@ -0,0 +1,140 @@
+"""
+Benchmark for encoding redaction plan and directory responses in the GUI server.
+
+With ImageDePHI installed, run with `python benchmarks/plan_response.py`.
+Synthetic reports are built for cohorts of each size, then encoded as a single page of every
+image, both with FastAPI's generic `jsonable_encoder` and with the typed response models that the
+server uses.
+"""
+
+from __future__ import annotations
+
+import json
+from pathlib import Path
+import statistics
+import time
+from typing import Any, Callable
+
+import click
+from fastapi.encoders import jsonable_encoder
+from pydantic import TypeAdapter
+
+from imagedephi.gui.api.api import DirectoryResponse, RedactionPlanResponse
+from imagedephi.redact.plan_session import PlanSession, to_columnar
+
+
+def _report(image_index: int) -> dict[str, Any]:
+    return {
+        "Date": {"action": "delete", "value": "01/01/08"},
+        "Filename": {"action": "delete", "value": f"slide-{image_index}"},
+        "AppMag": {"action": "keep", "value": 40},
+        "BitsPerSample": {"action": "keep", "value": [8, 8, 8]},
+        "ICC Profile": {"action": "delete", "binary": {"value": "0x" + "ab" * 40, "bytes": 4096}},
+        "StripOffsets": {"action": "keep", "value": list(range(32))},
+        "missing_tags": [{65000: "Unknown"}],
+        "associated_images": 2,
+    }
+
+
+def _plan_payload(image_count: int, columnar: bool) -> dict[str, Any]:
+    session = PlanSession(max_images=None)
+    for index in range(image_count):
+        session.add_report(f"slide-{index}.svs", _report(index), comprehensive=False)
+    data = session.get_page(image_count, 0)
+    return {
+        "data": to_columnar(data) if columnar else data,
+        "total": session.total,
+        "tags": session.tags_used,
+        "missing_rules": session.missing_rules,
+        "complete": True,
+    }
+
+
+def _directory_payload(image_count: int, path_type: Callable[[Path], Any]) -> list[dict[str, Any]]:
+    directory = Path("/data/cohort")
+    images = [
+        {"name": f"slide-{i}.svs", "path": path_type(directory / f"slide-{i}.svs")}
+        for i in range(image_count)
+    ]
+    return [
+        {
+            "directory_data": {
+                "directory": path_type(directory),
+                "ancestors": [{"name": "", "path": path_type(Path("/"))}],
+                "child_directories": [],
+                "child_images": images,
+                "child_yaml_files": [],
+                "image_count": image_count,
+                "file_count": image_count,
+                "images_complete": True,
+            }
+        }
+    ]
+
+
+def _time(fn: Callable[[], bytes], repeat: int) -> tuple[float, int]:
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        body = fn()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples), len(body)
+
+
+def _compare(
+    name: str, payload: Any, adapter: TypeAdapter, repeat: int, typed_payload: Any = None
+) -> None:
+    def generic() -> bytes:
+        return json.dumps(jsonable_encoder(payload)).encode()
+
+    def typed() -> bytes:
+        # This is what FastAPI does for endpoints with a response model
+        return adapter.dump_json(adapter.validate_python(typed_payload or payload))
+
+    generic_time, generic_size = _time(generic, repeat)
+    typed_time, typed_size = _time(typed, repeat)
+    click.echo(
+        f"{name}: jsonable_encoder {generic_time * 1000:.1f} ms ({generic_size} bytes), "
+        f"response model {typed_time * 1000:.1f} ms ({typed_size} bytes), "
+        f"{generic_time / typed_time:.1f}x faster"
+    )
+
+
+@click.command
+@click.option(
+    "--images",
+    "image_counts",
+    multiple=True,
+    type=int,
+    default=[1_000, 10_000],
+    help="Number of images in a cohort; may be given more than once.",
+)
+@click.option("--repeat", default=5, help="Number of times to encode each response.")
+def plan_response(image_counts: list[int], repeat: int) -> None:
+    plan_adapter = TypeAdapter(RedactionPlanResponse)
+    directory_adapter = TypeAdapter(list[DirectoryResponse])
+    for image_count in image_counts:
+        _compare(
+            f"{image_count} images, rows",
+            _plan_payload(image_count, columnar=False),
+            plan_adapter,
+            repeat,
+        )
+        _compare(
+            f"{image_count} images, columns",
+            _plan_payload(image_count, columnar=True),
+            plan_adapter,
+            repeat,
+        )
+        _compare(
+            f"{image_count} images, directory",
+            _directory_payload(image_count, Path),
+            directory_adapter,
+            repeat,
+            # Typed responses are built with plain strings, rather than paths
+            typed_payload=_directory_payload(image_count, str),
+        )
+
+
+if __name__ == "__main__":
+    plan_response()
@@ -0,0 +1,110 @@
+"""
+Load test for associated image generation in the GUI server.
+
+With ImageDePHI installed, run with a directory of images, e.g.
+`python benchmarks/thumbnail_load.py tests/data/input/svs`.
+Many concurrent clients request thumbnails, labels and macros, while a probe measures how late
+the server's event loop wakes up, which is what delays websocket progress updates. Requests are
+served in-process, so the results exclude network overhead.
+"""
+
+from __future__ import annotations
+
+import asyncio
+from pathlib import Path
+import random
+import statistics
+import time
+
+import click
+import httpx
+
+from imagedephi.gui.app import app
+from imagedephi.gui.thumbnail_scheduler import thumbnail_scheduler
+from imagedephi.utils.directory import iter_image_dirs
+
+PROBE_INTERVAL = 0.01
+
+
+def _percentile(samples: list[float], percentile: float) -> float:
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * percentile / 100), len(samples) - 1)]
+
+
+def _report(name: str, samples: list[float]) -> None:
+    click.echo(
+        f"{name}: p50 {_percentile(samples, 50) * 1000:.1f} ms, "
+        f"p99 {_percentile(samples, 99) * 1000:.1f} ms, "
+        f"max {max(samples) * 1000:.1f} ms ({len(samples)} samples)"
+    )
+
+
+async def _probe_event_loop(lags: list[float], stop: asyncio.Event) -> None:
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(PROBE_INTERVAL)
+        lags.append(time.perf_counter() - start - PROBE_INTERVAL)
+
+
+async def _client(
+    client: httpx.AsyncClient, images: list[Path], requests: int, latencies: list[float]
+) -> None:
+    for _ in range(requests):
+        params = {
+            "file_name": str(random.choice(images)),
+            "image_key": random.choice(["thumbnail", "label", "macro"]),
+            # Vary the size, so that requests aren't all coalesced
+            "max_width": str(random.randint(100, 200)),
+            "max_height": str(random.randint(100, 200)),
+        }
+        start = time.perf_counter()
+        await client.get("/image/", params=params)
+        latencies.append(time.perf_counter() - start)
+
+
+async def _run(images: list[Path], clients: int, requests: int) -> None:
+    latencies: list[float] = []
+    lags: list[float] = []
+    stop = asyncio.Event()
+    transport = httpx.ASGITransport(app=app)  # type: ignore
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+        # Start the workers before measuring
+        await client.get("/image/", params={"file_name": str(images[0]), "image_key": "thumbnail"})
+        probe = asyncio.create_task(_probe_event_loop(lags, stop))
+        start = time.perf_counter()
+        await asyncio.gather(
+            *(_client(client, images, requests, latencies) for _ in range(clients))
+        )
+        elapsed = time.perf_counter() - start
+        stop.set()
+        await probe
+    click.echo(f"{len(latencies)} requests in {elapsed:.2f} s")
+    _report("Request latency", latencies)
+    _report("Event loop lag", lags)
+    click.echo(f"Mean event loop lag: {statistics.mean(lags) * 1000:.1f} ms")
+
+
+@click.command
+@click.argument(
+    "image_dir", type=click.Path(exists=True, file_okay=False, readable=True, path_type=Path)
+)
+@click.option("--clients", default=16, help="Number of concurrent clients.")
+@click.option("--requests", default=20, help="Number of requests made by each client.")
+@click.option(
+    "--processes/--threads",
+    default=True,
+    help="Generate images in worker processes, or in worker threads of the server process.",
+)
+def thumbnail_load(image_dir: Path, clients: int, requests: int, processes: bool) -> None:
+    images = list(iter_image_dirs([image_dir]))
+    if not images:
+        raise click.BadParameter(f"No images found in {image_dir}")
+    thumbnail_scheduler.use_processes = processes
+    try:
+        asyncio.run(_run(images, clients, requests))
+    finally:
+        thumbnail_scheduler.shutdown()
+
+
+if __name__ == "__main__":
+    thumbnail_load()
@@ -0,0 +1,38 @@
+// Write gzip and brotli variants of the built assets, for the GUI server to send as they are
+import { readdir, readFile, stat, writeFile } from "node:fs/promises";
+import { join } from "node:path";
+import { brotliCompressSync, constants, gzipSync } from "node:zlib";
+
+const assetsDir = process.argv[2] ?? "../imagedephi/web_static/assets";
+const compressibleExtensions = [".js", ".css", ".svg", ".json", ".map"];
+// Compressing small files saves too little to be worth it
+const minimumSize = 1024;
+
+const variants = [
+  {
+    suffix: ".br",
+    compress: (data) =>
+      brotliCompressSync(data, {
+        params: { [constants.BROTLI_PARAM_QUALITY]: constants.BROTLI_MAX_QUALITY },
+      }),
+  },
+  { suffix: ".gz", compress: (data) => gzipSync(data, { level: 9 }) },
+];
+
+for (const name of await readdir(assetsDir)) {
+  const path = join(assetsDir, name);
+  if (!compressibleExtensions.some((extension) => name.endsWith(extension))) {
+    continue;
+  }
+  if ((await stat(path)).size < minimumSize) {
+    continue;
+  }
+  const data = await readFile(path);
+  for (const { suffix, compress } of variants) {
+    const compressed = compress(data);
+    // Only keep variants that are actually smaller
+    if (compressed.length < data.length) {
+      await writeFile(path + suffix, compressed);
+    }
+  }
+}
@@ -1,13 +1,21 @@
-import { ImagePlanParams } from "../store/types";
+import {
+  columnarPlanData,
+  imageFrameHeader,
+  imagePlanResponse,
+  ImagePlanParams,
+  imageRequest,
+  tileInfo,
+} from "../store/types";
 
 const basePath = import.meta.env.VITE_APP_API_URL
   ? import.meta.env.VITE_APP_API_URL
   : "";
 
-export async function getDirectoryInfo(path?: string) {
+export async function getDirectoryInfo(path?: string, limit?: number) {
   const selectedPath = path ? path : "/";
+  const limitParam = limit !== undefined ? `&limit=${limit}` : "";
   const response = await fetch(
-    `${basePath}/directory/?directory=${selectedPath}`,
+    `${basePath}/directory/?directory=${selectedPath}${limitParam}`,
     {
       method: "GET",
       mode: "cors",
@@ -19,15 +27,46 @@ export async function getDirectoryInfo(path?: string) {
 }
 
 export async function getRedactionPlan(params: ImagePlanParams) {
-  const response = await fetch(
-    `${basePath}/redaction_plan?input_directory=${params.directory}&rules_path=${params.rules}&limit=${params.limit}&offset=${params.offset}&update=${params.update}`,
-    {
-      method: "GET",
-      mode: "cors",
-    },
-  );
-  return response.json().then((data) => {
-    return data;
+  const query = new URLSearchParams({
+    input_directory: params.directory,
+    rules_path: `${params.rules}`,
+    limit: `${params.limit}`,
+    offset: `${params.offset}`,
+    update: `${params.update}`,
+    layout: "columns",
+  });
+  if (params.missingRulesOnly) query.append("missing_rules_only", "true");
+  if (params.tag) query.append("tag", params.tag);
+  if (params.action) query.append("action", params.action);
+  if (params.filename) query.append("filename", params.filename);
+  if (params.sortBy) query.append("sort_by", params.sortBy);
+  if (params.descending) query.append("descending", "true");
+  params.columns?.forEach((column) => query.append("columns", column));
+  const response = await fetch(`${basePath}/redaction_plan?${query}`, {
+    method: "GET",
+    mode: "cors",
+  });
+  return response.json().then((plan) => {
+    // Plans are sent in a compact columnar layout; expand them into a row per image
+    const { images, actions, values, details, columns } =
+      plan.data as columnarPlanData;
+    plan.data = Object.fromEntries(
+      images.map((image, index) => {
+        const row: Record<string, unknown> = {};
+        Object.entries(columns).forEach(([key, column]) => {
+          if (column[index] !== null) row[key] = column[index];
+        });
+        Object.entries(actions).forEach(([key, column]) => {
+          if (column[index] === null) return;
+          const entry: Record<string, unknown> = { action: column[index] };
+          const value = values[key]?.[index];
+          if (value !== undefined && value !== null) entry.value = value;
+          row[key] = { ...entry, ...details[key]?.[index] };
+        });
+        return [image, row];
+      }),
+    );
+    return plan as imagePlanResponse;
   });
 }
 
@@ -39,7 +78,7 @@ export async function redactImages(
   exportAssociated?: boolean,
 ) {
   const response = await fetch(
-    `${basePath}/redact/?input_directory=${inputDirectory}&output_directory=${outputDirectory}&rules_path=${rules}&rename=${rename !== false}&export_associated=${!!exportAssociated}`,
+    `${basePath}/jobs?input_directory=${inputDirectory}&output_directory=${outputDirectory}&rules_path=${rules}&rename=${rename !== false}&export_associated=${!!exportAssociated}`,
     {
       method: "POST",
       mode: "cors",
@@ -58,3 +97,81 @@ export async function getImages(path: string, imageKey: string) {
   );
   return response;
 }
+
+export async function getImageBatch(
+  requests: imageRequest[],
+  onImage: (header: imageFrameHeader, image: Blob | null) => void,
+  signal?: AbortSignal,
+) {
+  const response = await fetch(`${basePath}/images/`, {
+    method: "POST",
+    mode: "cors",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify(requests),
+    signal,
+  });
+  if (!response.body) {
+    return;
+  }
+  // Each frame is a 4 byte header length, a JSON header, then "length" bytes of image data
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = new Uint8Array(0);
+  while (true) {
+    const { done, value } = await reader.read();
+    if (value) {
+      const joined = new Uint8Array(buffer.length + value.length);
+      joined.set(buffer);
+      joined.set(value, buffer.length);
+      buffer = joined;
+    }
+    while (buffer.length >= 4) {
+      const headerLength = new DataView(buffer.buffer).getUint32(0);
+      if (buffer.length < 4 + headerLength) break;
+      const header: imageFrameHeader = JSON.parse(
+        decoder.decode(buffer.subarray(4, 4 + headerLength)),
+      );
+      const frameLength = 4 + headerLength + header.length;
+      if (buffer.length < frameLength) break;
+      onImage(
+        header,
+        header.status < 400
+          ? new Blob([buffer.slice(4 + headerLength, frameLength)], {
+              type: header.media_type,
+            })
+          : null,
+      );
+      buffer = buffer.slice(frameLength);
+    }
+    if (done) break;
+  }
+}
+
+export async function getTileInfo(path: string) {
+  const response = await fetch(
+    `${basePath}/tiles/info?file_name=${encodeURIComponent(path)}`,
+    {
+      method: "GET",
+      mode: "cors",
+    },
+  );
+  return response.json() as Promise<tileInfo>;
+}
+
+export function getTileUrl(
+  path: string,
+  level: number,
+  x: number,
+  y: number,
+) {
+  const fileName = encodeURIComponent(path);
+  return `${basePath}/tiles/${level}/${x}/${y}?file_name=${fileName}`;
+}
+
+export async function getRedactionJob(jobId: string) {
+  const response = await fetch(`${basePath}/jobs/${jobId}`, {
+    method: "GET",
+    mode: "cors",
+  });
+  return response.json();
+}
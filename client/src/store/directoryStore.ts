@@ -26,28 +26,47 @@ export const directoryData: Ref<DirectoryData> = ref({
   children: [],
   childrenImages: [],
   childrenYaml: [],
+  imageCount: 0,
+  imagesComplete: true,
 });
 
+// Only the first images are listed; the rest are counted
+const DIRECTORY_IMAGE_LIMIT = 100;
+
 export const loadingData = ref(false);
 
-export const updateDirectories = async (currentDirectory?: string) => {
-  directoryData.value.children = [];
-  directoryData.value.childrenImages = [];
-  directoryData.value.childrenYaml = [];
+export const updateDirectories = async (
+  currentDirectory?: string,
+  refresh = false,
+) => {
+  if (!refresh) {
+    directoryData.value.children = [];
+    directoryData.value.childrenImages = [];
+    directoryData.value.childrenYaml = [];
+  }
   const timeout = setTimeout(() => {
-    loadingData.value = true;
+    loadingData.value = !refresh;
   }, 100);
-  const data = await getDirectoryInfo(currentDirectory);
+  const data = await getDirectoryInfo(currentDirectory, DIRECTORY_IMAGE_LIMIT);
   clearTimeout(timeout);
   loadingData.value = false;
-  directoryData.value = await {
+  if (refresh && directoryData.value.directory !== data.directory) {
+    // The user navigated elsewhere in the meantime
+    return;
+  }
+  directoryData.value = {
     ...data,
     children: data.child_directories,
     childrenImages: data.child_images,
     childrenYaml: data.child_yaml_files,
+    imageCount: data.image_count,
+    imagesComplete: data.images_complete,
   };
-  loadingData.value = false;
   calculateVisibleItems();
+  if (!data.images_complete) {
+    // Images are still being identified on the server; list more once they are found
+    setTimeout(() => updateDirectories(data.directory, true), 1000);
+  }
 };
 
 export const visibleImages: Ref<Path[]> = ref([]);
@@ -83,6 +102,6 @@ export const calculateVisibleItems = () => {
       visibleItems.value,
     );
     remainingImages.value =
-      directoryData.value.childrenImages.length - visibleItems.value;
+      directoryData.value.imageCount - visibleItems.value;
   });
 };
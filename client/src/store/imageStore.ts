@@ -1,45 +1,84 @@
 import { reactive } from "vue";
 import { imagePlanResponse, ImagePlanParams } from "./types";
-import { getRedactionPlan, getImages } from "../api/rest";
+import { getRedactionPlan, getImageBatch } from "../api/rest";
 import { selectedDirectories } from "./directoryStore";
 import { redactionStateFlags } from "./redactionStore";
 
+// Images for a page that is no longer shown are abandoned, so the server can skip them
+let thumbnailController: AbortController | null = null;
+
 export const useRedactionPlan = reactive({
   imageRedactionPlan: {} as imagePlanResponse,
   currentDirectory: selectedDirectories.value.inputDirectory,
   async updateImageData(params: ImagePlanParams) {
+    const previousData =
+      params.update && this.currentDirectory === params.directory
+        ? this.imageRedactionPlan.data || {}
+        : {};
     this.currentDirectory = params.directory;
     this.imageRedactionPlan = await getRedactionPlan(params);
-    this.getThumbnail(this.imageRedactionPlan.data);
+    // Reuse images that were already loaded for rows that are still shown
+    const newImages: Record<string, Record<string, string>> = {};
+    Object.entries(this.imageRedactionPlan.data).forEach(([image, row]) => {
+      if (previousData[image]?.thumbnail) {
+        ["thumbnail", "label", "macro"].forEach((key) => {
+          row[key] = previousData[image][key];
+        });
+      } else {
+        newImages[image] = row;
+      }
+    });
+    this.getThumbnail(newImages);
+    if (!this.imageRedactionPlan.complete) {
+      // Plans are still being built on the server; refresh once more are ready
+      setTimeout(() => {
+        if (this.currentDirectory === params.directory) {
+          this.updateImageData({ ...params, update: true });
+        }
+      }, 1000);
+    }
   },
   async getThumbnail(imagedict: Record<string, Record<string, string>>) {
-    Object.keys(imagedict).forEach(async (image) => {
-      const keys = ["thumbnail", "label", "macro"];
-      for (let kidx=0; kidx < keys.length; kidx += 1) {
-        const key = keys[kidx];
-        const response = await getImages(
-          this.currentDirectory + "/" + image,
-          key,
-        );
-        if (response.status >= 400) {
-          this.imageRedactionPlan.data[image][key] = key === "thumbnail" ? "/thumbnailPlaceholder.svg" : "/associatedPlaceholder.svg";
-          return;
-        }
-        if (response.body) {
-          const reader = response.body.getReader();
-          const chunks = [];
-
-          while (true) {
-            const { done, value } = await reader.read();
-            if (done) break;
-            chunks.push(value);
+    const directory = this.currentDirectory;
+    const keys = ["thumbnail", "label", "macro"];
+    // Request every image of the page at once, so each file is only read once
+    const requests = Object.keys(imagedict).flatMap((image) =>
+      keys.map((key) => ({
+        file_name: directory + "/" + image,
+        image_key: key,
+      })),
+    );
+    if (!requests.length) {
+      return;
+    }
+    thumbnailController?.abort();
+    const controller = new AbortController();
+    thumbnailController = controller;
+    try {
+      await getImageBatch(
+        requests,
+        (header, image) => {
+          const name = header.file_name.slice(directory.length + 1);
+          const row = this.imageRedactionPlan.data?.[name];
+          if (!row || this.currentDirectory !== directory) {
+            return;
           }
-          const blob = new Blob(chunks);
-          const url = URL.createObjectURL(blob);
-          this.imageRedactionPlan.data[image][key]= url;
-        }
-      };
-    });
+          if (!image) {
+            row[header.image_key] =
+              header.image_key === "thumbnail"
+                ? "/thumbnailPlaceholder.svg"
+                : "/associatedPlaceholder.svg";
+            return;
+          }
+          row[header.image_key] = URL.createObjectURL(image);
+        },
+        controller.signal,
+      );
+    } catch (error) {
+      if (!controller.signal.aborted) {
+        throw error;
+      }
+    }
   },
 
   clearImageData() {
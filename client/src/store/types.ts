@@ -4,6 +4,8 @@ export type DirectoryData = {
   children: Path[];
   childrenImages: Path[];
   childrenYaml: Path[];
+  imageCount: number;
+  imagesComplete: boolean;
 };
 
 export interface ImagePlanParams {
@@ -12,13 +14,58 @@ export interface ImagePlanParams {
   limit?: number;
   offset?: number;
   update?: boolean;
+  missingRulesOnly?: boolean;
+  tag?: string;
+  action?: string;
+  filename?: string;
+  sortBy?: string;
+  descending?: boolean;
+  columns?: string[];
 }
 
+export type columnarPlanData = {
+  images: string[];
+  actions: Record<string, (string | null)[]>;
+  values: Record<string, unknown[]>;
+  details: Record<string, (Record<string, unknown> | null)[]>;
+  columns: Record<string, unknown[]>;
+};
+
 export type imagePlanResponse = {
   data: Record<string, Record<string, string>>;
   total: number;
   tags: string[];
   missing_rules: boolean;
+  complete: boolean;
+};
+
+export type imageRequest = {
+  file_name: string;
+  image_key: string;
+};
+
+export type imageFrameHeader = imageRequest & {
+  status: number;
+  length: number;
+  media_type?: string;
+  detail?: string;
+};
+
+export type tileLevel = {
+  level: number;
+  width: number;
+  height: number;
+  tile_width: number;
+  tile_height: number;
+  tiles_across: number;
+  tiles_down: number;
+  downsample: number;
+};
+
+export type tileInfo = {
+  width: number;
+  height: number;
+  levels: tileLevel[];
 };
 
 export interface Path {
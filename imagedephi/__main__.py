@@ -1,4 +1,8 @@
+import multiprocessing
+
 from imagedephi import main
 
 if __name__ == "__main__":
+    # Thumbnails are generated in worker processes, which need this in a frozen binary
+    multiprocessing.freeze_support()
     main.imagedephi()
@@ -1,92 +1,102 @@
 from __future__ import annotations
 
 import asyncio
-import os
 from pathlib import Path
-from typing import TYPE_CHECKING, Optional
-import urllib.parse
+from typing import Any, Optional
 
-from fastapi import APIRouter, HTTPException, WebSocket, WebSocketDisconnect
-from fastapi.responses import FileResponse, StreamingResponse
+from fastapi import APIRouter, HTTPException, Query, WebSocket, WebSocketDisconnect
+from fastapi.responses import FileResponse, Response, StreamingResponse
+from pydantic import BaseModel
 
-from imagedephi.redact import redact_images, show_redaction_plan
-from imagedephi.rules import FileFormat
-from imagedephi.utils.constants import MAX_ASSOCIATED_IMAGE_SIZE
-from imagedephi.utils.dicom import file_is_same_series_as
-from imagedephi.utils.directory import iter_image_dirs
-from imagedephi.utils.image import (
-    get_file_format_from_path,
-    get_image_bytes_from_dicom,
-    get_image_bytes_from_ifd,
-    get_image_bytes_from_tiff,
+from imagedephi.gui.associated_images import (
+    get_scheduled_associated_image,
+    iter_associated_image_frames,
 )
-from imagedephi.utils.progress_log import get_next_progress_message
-from imagedephi.utils.tiff import get_associated_image_svs, get_ifd_for_thumbnail, get_is_svs
-
-if TYPE_CHECKING:
-    from tifftools.tifftools import IFD
+from imagedephi.gui.directory_listing import directory_listings
+from imagedephi.gui.jobs import RedactionJob, job_manager
+from imagedephi.gui.plan_store import PlanLayout, plan_store
+from imagedephi.gui.tiles import TileError, get_tiled_image
+from imagedephi.redact import redact_images
+from imagedephi.redact.plan_session import PlanQuery
+from imagedephi.utils.associated_images import ASSOCIATED_IMAGE_KEYS, AssociatedImageError
+from imagedephi.utils.constants import MAX_ASSOCIATED_IMAGE_SIZE
+from imagedephi.utils.progress_log import ProgressSubscription, progress_broadcaster
 
 router = APIRouter()
 
 
-def _iter_yaml_files(directory: Path):
-    for child in directory.iterdir():
-        if child.is_file() and child.suffix == ".yaml":
-            yield child
+class PathEntry(BaseModel):
+    name: str
+    path: str
 
 
-class DirectoryData:
-    directory: Path
-    ancestors: list[dict[str, str | Path]]
-    child_directories: list[dict[str, str | Path]]
-    child_images: list[dict[str, str | Path]]
-    child_yaml_files: list[dict[str, str | Path]]
+class DirectoryData(BaseModel):
+    directory: str
+    ancestors: list[PathEntry]
+    child_directories: list[PathEntry]
+    child_images: list[PathEntry]
+    child_yaml_files: list[PathEntry]
+    image_count: int
+    file_count: int
+    images_complete: bool
 
-    def __init__(self, directory: Path):
-        self.directory = directory
+    @classmethod
+    def from_directory(
+        cls, directory: Path, limit: int | None = None, offset: int = 0
+    ) -> DirectoryData:
+        listing = directory_listings.get_listing(directory)
+        listing.wait_for_images(None if limit is None else (offset + 1) * limit)
+        page = listing.get_page(limit, offset)
 
-        self.ancestors = [
-            {"name": ancestor.name, "path": ancestor} for ancestor in reversed(directory.parents)
-        ]
-        self.ancestors.append({"name": directory.name, "path": directory})
+        def entries(names: list[str]) -> list[dict[str, str]]:
+            return [{"name": name, "path": str(directory / name)} for name in names]
 
-        self.child_directories = [
-            {"name": child.name, "path": child}
-            for child in directory.iterdir()
-            if child.is_dir() and os.access(child, os.R_OK)
+        ancestors = [
+            {"name": ancestor.name, "path": str(ancestor)}
+            for ancestor in reversed(directory.parents)
         ]
+        ancestors.append({"name": directory.name, "path": str(directory)})
+        # Validate plain values all at once, which is much faster than building each entry
+        return cls.model_validate(
+            {
+                "directory": str(directory),
+                "ancestors": ancestors,
+                "child_directories": entries(page["child_directories"]),
+                "child_images": entries(page["child_images"]),
+                "child_yaml_files": entries(page["child_yaml_files"]),
+                "image_count": page["image_count"],
+                "file_count": page["file_count"],
+                "images_complete": page["images_complete"],
+            }
+        )
 
-        self.child_images = [
-            {"name": image.name, "path": image} for image in list(iter_image_dirs([directory]))
-        ]
-        self.child_yaml_files = [
-            {"name": yaml_file.name, "path": yaml_file} for yaml_file in _iter_yaml_files(directory)
-        ]
+
+class DirectoryResponse(BaseModel):
+    directory_data: DirectoryData
 
 
-@router.get("/directory/")
+@router.get("/directory/", response_model=list[DirectoryResponse])
 def select_directory(
     directory: str = ("/"),
+    limit: Optional[int] = None,
+    offset: int = 0,
 ):
     directory_path = Path(directory)
     # TODO: if input_directory is specified but an empty string, it gets instantiated as the CWD
     if not directory_path.exists():
         raise HTTPException(status_code=404, detail="Input directory not found")
 
-    def image_url(path: str, key: str) -> str:
-        params = {"file_name": str(directory_path / path), "image_key": key}
-        return "image/?" + urllib.parse.urlencode(params, safe="")
-
-    return (
-        {
-            "directory_data": DirectoryData(directory_path),
-            "image_url": image_url,
-        },
-    )
+    # Images are identified in the background; until "images_complete" is set, only the images
+    # found so far are listed, and the listing can be requested again for more.
+    return [
+        DirectoryResponse(
+            directory_data=DirectoryData.from_directory(directory_path, limit, offset)
+        )
+    ]
 
 
 @router.get("/image/", response_class=FileResponse)
-def get_associated_image(
+async def get_associated_image(
     file_name: str = "",
     image_key: str = "",
     max_height=MAX_ASSOCIATED_IMAGE_SIZE,
@@ -98,82 +108,105 @@ def get_associated_image(
     if not Path(file_name).exists():
         raise HTTPException(status_code=404, detail=f"{file_name} does not exist")
 
-    if image_key not in ["macro", "label", "thumbnail"]:
+    if image_key not in ASSOCIATED_IMAGE_KEYS:
         raise HTTPException(
             status_code=400,
             detail=f"{image_key} is not a supported associated image key for {file_name}.",
         )
 
-    image_type = get_file_format_from_path(Path(file_name))
-    if image_type == FileFormat.SVS or image_type == FileFormat.TIFF:
-        ifd: IFD | None = None
-        if image_key == "thumbnail":
-            ifd = get_ifd_for_thumbnail(Path(file_name), int(max_width), int(max_height))
-            if not ifd:
-                try:
-                    # If the image is not tiled, no appropriate IFD was found. In this case
-                    # attempt to get a thumbnail using the entire image.
-                    jpeg_buffer = get_image_bytes_from_tiff(file_name, max_width, max_height)
-                    return StreamingResponse(jpeg_buffer, media_type="image/jpeg")
-                except Exception as e:
-                    raise HTTPException(
-                        status_code=422,  # unprocessable content
-                        detail=f"Could not generate thumbnail image for {file_name}: {e.args[0]}",
-                    )
-            else:
-                try:
-                    jpeg_buffer = get_image_bytes_from_ifd(ifd, file_name, max_width, max_height)
-                    return StreamingResponse(jpeg_buffer, media_type="image/jpeg")
-                except Exception as e:
-                    raise HTTPException(
-                        status_code=422,  # unprocessable content
-                        detail=f"Could not generate thumbnail image for {file_name}: {e.args[0]}",
-                    )
-
-        # image key is one of "macro", "label"
-        if not get_is_svs(Path(file_name)):
-            raise HTTPException(
-                status_code=404, detail=f"Image key {image_key} is not supported for {file_name}"
-            )
-
-        ifd = get_associated_image_svs(Path(file_name), image_key)
-        if not ifd:
-            raise HTTPException(
-                status_code=404, detail=f"No {image_key} image found for {file_name}"
-            )
-        try:
-            return get_image_bytes_from_ifd(ifd, file_name, max_height, max_width)
-        except Exception as e:
-            raise HTTPException(
-                status_code=422,  # unprocessable content
-                detail=f"Could not generate thumbnail image for {file_name}: {e.args[0]}",
-            )
-    elif image_type == FileFormat.DICOM:
-        path = Path(file_name)
-        related_files = [
-            child
-            for child in path.parent.iterdir()
-            if child != path and file_is_same_series_as(path, child)
-        ]
-        image_response = get_image_bytes_from_dicom(related_files, image_key, max_width, max_height)
-        if image_response:
-            return StreamingResponse(image_response, media_type="image/jpeg")
-        raise HTTPException(
-            status_code=404, detail=f"Could not retrieve {image_key} image for {file_name}"
+    try:
+        image_bytes = await get_scheduled_associated_image(
+            file_name, image_key, max_width, max_height
         )
+    except AssociatedImageError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    return Response(image_bytes, media_type="image/jpeg")
+
+
+class AssociatedImageRequest(BaseModel):
+    file_name: str
+    image_key: str
 
-    return HTTPException(
-        status_code=404, detail=f"Could not retrieve {image_key} image for {file_name}"
+
+@router.post("/images/")
+def get_associated_images(
+    image_requests: list[AssociatedImageRequest],
+    max_height=MAX_ASSOCIATED_IMAGE_SIZE,
+    max_width=MAX_ASSOCIATED_IMAGE_SIZE,
+):
+    """
+    Stream several associated images at once.
+
+    Images are extracted ahead of those from earlier requests. Each image is sent as a frame, in
+    the order the images are extracted: a 4 byte big-endian header length, a JSON header with
+    "file_name", "image_key", "status", "length" and either "media_type" or "detail", followed
+    by "length" bytes of image data.
+    """
+    return StreamingResponse(
+        iter_associated_image_frames(
+            [(request.file_name, request.image_key) for request in image_requests],
+            max_width,
+            max_height,
+        ),
+        media_type="application/octet-stream",
     )
 
 
-@router.get("/redaction_plan")
+@router.get("/tiles/info")
+def get_tile_info(file_name: str = ""):
+    """Describe the resolution levels and tile grid of an image, for a deep-zoom viewer."""
+    if not file_name:
+        raise HTTPException(status_code=400, detail="file_name is a required parameter")
+    try:
+        return get_tiled_image(Path(file_name)).info()
+    except TileError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+
+
+@router.get("/tiles/{level}/{x}/{y}")
+def get_tile(level: int, x: int, y: int, file_name: str = ""):
+    """Return one tile of an image as a JPEG. Level 0 is the full resolution image."""
+    if not file_name:
+        raise HTTPException(status_code=400, detail="file_name is a required parameter")
+    try:
+        tile_bytes = get_tiled_image(Path(file_name)).get_tile(level, x, y)
+    except TileError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    return Response(tile_bytes, media_type="image/jpeg")
+
+
+class ColumnarPlan(BaseModel):
+    images: list[str]
+    actions: dict[str, list[Optional[str]]]
+    values: dict[str, list[Any]]
+    details: dict[str, list[Optional[dict[str, Any]]]]
+    columns: dict[str, list[Any]]
+
+
+class RedactionPlanResponse(BaseModel):
+    # Report values are plain JSON values, which are encoded when reports are made
+    data: dict[str, dict[str, Any]] | ColumnarPlan
+    total: int
+    tags: list[str]
+    missing_rules: bool
+    complete: bool
+
+
+@router.get("/redaction_plan", response_model=RedactionPlanResponse)
 def get_redaction_plan(
     input_directory: str = ("/"),  # noqa: B008
     rules_path: Optional[str] = None,
     limit: int = 10,
     offset: int = 0,
     update: bool = True,
+    missing_rules_only: bool = False,
+    tag: Optional[str] = None,
+    action: Optional[str] = None,
+    filename: Optional[str] = None,
+    sort_by: Optional[str] = None,
+    descending: bool = False,
+    columns: Optional[list[str]] = Query(None),  # noqa: B008
+    layout: PlanLayout = PlanLayout.Rows,
 ):
     input_path = Path(input_directory)
     if not input_path.is_dir():
@@ -183,22 +216,30 @@ def get_redaction_plan(
     if rules_path and not Path(rules_path).is_file():
         rules_path = None
         print("Rules file not found")
-    if rules_path:
-        return show_redaction_plan(
-            [input_path], override_rules=Path(rules_path), limit=limit, offset=offset, update=update
-        )._asdict()
-
-    return show_redaction_plan([input_path], limit=limit, offset=offset, update=update)._asdict()
+    # "update" is set while paging through a directory that was already requested, in which
+    # case the cached plans are used as they are.
+    return plan_store.get_page(
+        input_path,
+        override_rules=Path(rules_path) if rules_path else None,
+        limit=limit,
+        offset=offset,
+        refresh=not update,
+        plan_query=PlanQuery(
+            missing_rules_only=missing_rules_only,
+            tag=tag,
+            action=action,
+            filename=filename,
+            sort_by=sort_by,
+            descending=descending,
+            columns=columns,
+        ),
+        layout=layout,
+    )
 
 
-@router.post("/redact/")
-def redact(
-    input_directory: str,  # noqa: B008
-    output_directory: str,  # noqa: B008
-    rules_path: Optional[str] = None,
-    rename: bool = True,
-    export_associated: bool = False,
-):
+def _get_redact_paths(
+    input_directory: str, output_directory: str, rules_path: str | None
+) -> tuple[Path, Path, Path | None]:
     input_path = Path(input_directory)
     output_path = Path(output_directory)
     if not input_path.is_dir():
@@ -208,46 +249,101 @@ def redact(
     if rules_path is not None and not Path(rules_path).is_file():
         rules_path = None
         print("Rules file not found")
+    return input_path, output_path, Path(rules_path) if rules_path else None
+
+
+@router.post("/redact/")
+def redact(
+    input_directory: str,  # noqa: B008
+    output_directory: str,  # noqa: B008
+    rules_path: Optional[str] = None,
+    rename: bool = True,
+    export_associated: bool = False,
+):
+    input_path, output_path, override_rules = _get_redact_paths(
+        input_directory, output_directory, rules_path
+    )
     # TODO: Add support for multiple input directories in the UI
-    if rules_path:
-        redact_images(
-            [input_path],
-            output_path,
-            override_rules=Path(rules_path),
-            rename=rename,
-            export_associated=export_associated,
-        )
-    else:
-        redact_images(
+    redact_images(
+        [input_path],
+        output_path,
+        override_rules=override_rules,
+        rename=rename,
+        export_associated=export_associated,
+    )
+
+
+def _get_job(job_id: str) -> RedactionJob:
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@router.post("/jobs")
+def create_job(
+    input_directory: str,  # noqa: B008
+    output_directory: str,  # noqa: B008
+    rules_path: Optional[str] = None,
+    rename: bool = True,
+    export_associated: bool = False,
+):
+    input_path, output_path, override_rules = _get_redact_paths(
+        input_directory, output_directory, rules_path
+    )
+    # TODO: Add support for multiple input directories in the UI
+    job = job_manager.submit(
+        RedactionJob(
             [input_path],
             output_path,
+            override_rules=override_rules,
             rename=rename,
             export_associated=export_associated,
         )
+    )
+    return job.status_report()
+
+
+@router.get("/jobs")
+def list_jobs():
+    return [job.status_report() for job in job_manager.jobs()]
+
+
+@router.get("/jobs/{job_id}")
+def get_job_status(job_id: str):
+    return _get_job(job_id).status_report()
+
+
+@router.get("/jobs/{job_id}/throughput")
+def get_job_throughput(job_id: str):
+    return _get_job(job_id).throughput_report()
+
+
+@router.post("/jobs/{job_id}/cancel")
+def cancel_job(job_id: str):
+    job = job_manager.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.status_report()
+
+
+async def _forward_progress(websocket: WebSocket, subscription: ProgressSubscription) -> None:
+    while True:
+        message = await subscription.get()
+        await websocket.send_json(message)
 
 
 @router.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
-    backoff = 1
 
-    while True:
+    with progress_broadcaster.subscribe() as subscription:
+        forward_task = asyncio.create_task(_forward_progress(websocket, subscription))
         try:
-            print("Client connected")
-            backoff = 1
-
+            # The client periodically sends pings; reading them is how a disconnect is detected
             while True:
-                message = get_next_progress_message()
-                if message is not None:
-                    message_dict = dict(
-                        count=message[0], max=message[1], redact_dir=message[2].name
-                    )
-                    await websocket.send_json(message_dict)
-                else:
-                    await asyncio.sleep(0.001)  # Add a small delay to avoid busy waiting
-
+                await websocket.receive_text()
         except WebSocketDisconnect:
-            print("Attempting to reconnect to client")
-            await asyncio.sleep(backoff)
-            backoff = min(backoff * 2, 60)
-            await websocket.accept()
+            pass
+        finally:
+            forward_task.cancel()
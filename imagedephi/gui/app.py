@@ -6,11 +6,19 @@ import os
 
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.responses import PlainTextResponse
-from fastapi.staticfiles import StaticFiles
 from starlette.background import BackgroundTask
+from starlette.middleware.gzip import DEFAULT_EXCLUDED_CONTENT_TYPES
 
 from imagedephi.gui.api import api
+from imagedephi.gui.jobs import job_manager
+from imagedephi.gui.static_files import PrecompressedStaticFiles
+from imagedephi.gui.thumbnail_scheduler import thumbnail_scheduler
+from imagedephi.utils.associated_images import close_slides
+
+# Large JSON responses, like redaction plans, are compressed; small ones aren't worth it
+GZIP_MINIMUM_SIZE = 4096
 
 shutdown_event = asyncio.Event()
 debug_mode = eval(str(os.environ.get("DEBUG")))
@@ -24,6 +32,12 @@ async def lifespan(app: FastAPI) -> AsyncGenerator[None, None]:
 
     yield
 
+    # Don't leave redaction jobs running in the background once the server stops
+    job_manager.shutdown()
+    thumbnail_scheduler.shutdown()
+    # Slides are only opened here if associated images aren't extracted in worker processes
+    close_slides()
+
     if app.state.last_exception is not None:
         # This will cause a "lifespan.shutdown.failed" event to be sent. Hypercorn will re-raise
         # this from "serve", allowing exceptions to propagate to the top level.
@@ -40,6 +54,13 @@ app = FastAPI(
 
 app.include_router(api.router)  # type: ignore
 
+app.add_middleware(
+    GZipMiddleware,
+    minimum_size=GZIP_MINIMUM_SIZE,
+    # Images are already compressed, including those streamed in frames
+    exclude_content_types=(*DEFAULT_EXCLUDED_CONTENT_TYPES, "application/octet-stream"),
+)
+
 if debug_mode:
     app.add_middleware(
         CORSMiddleware,
@@ -49,20 +70,18 @@ if debug_mode:
     )
 
 else:
-    app.mount(
-        "/",
-        StaticFiles(
-            directory=str(importlib.resources.files("imagedephi") / "web_static"), html=True
-        ),
-        name="home",
-    )
+    web_static = importlib.resources.files("imagedephi") / "web_static"
+    # Mount assets first, since the root mount would otherwise match their paths too
     app.mount(
         "/assets",
-        StaticFiles(
-            directory=str(importlib.resources.files("imagedephi") / "web_static" / "assets")
-        ),
+        PrecompressedStaticFiles(directory=str(web_static / "assets"), immutable=True),
         name="assets",
     )
+    app.mount(
+        "/",
+        PrecompressedStaticFiles(directory=str(web_static), html=True),
+        name="home",
+    )
 
 
 # This exception handler not be used when FastAPI debug flag is enabled,
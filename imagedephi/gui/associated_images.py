@@ -0,0 +1,93 @@
+from __future__ import annotations
+
+import asyncio
+from collections.abc import AsyncGenerator
+from functools import partial
+import json
+import struct
+from typing import Any
+
+from imagedephi.gui.thumbnail_scheduler import Priority, thumbnail_scheduler
+from imagedephi.utils.associated_images import (
+    AssociatedImageError,
+    get_associated_image_extractor,
+)
+from imagedephi.utils.constants import MAX_ASSOCIATED_IMAGE_SIZE
+
+# Each frame of a batch response is a big-endian header length, a JSON header, then the image
+FRAME_HEADER_LENGTH = struct.Struct(">I")
+
+
+def _extract_associated_image(
+    file_name: str, image_key: str, max_width: int, max_height: int
+) -> bytes:
+    # Files are parsed in the server process, where they're cached for each of their associated
+    # images, so worker processes only decode and resize
+    extract = get_associated_image_extractor(file_name, image_key, max_width, max_height)
+    return thumbnail_scheduler.run_in_process(extract)
+
+
+async def get_scheduled_associated_image(
+    file_name: str,
+    image_key: str,
+    max_width=MAX_ASSOCIATED_IMAGE_SIZE,
+    max_height=MAX_ASSOCIATED_IMAGE_SIZE,
+    priority: Priority | None = None,
+) -> bytes:
+    """Wait for an associated image to be extracted by the thumbnail scheduler."""
+    if priority is None:
+        priority = (thumbnail_scheduler.new_viewport(), 0)
+    return await thumbnail_scheduler.run(
+        (file_name, image_key, int(max_width), int(max_height)),
+        partial(_extract_associated_image, file_name, image_key, int(max_width), int(max_height)),
+        priority,
+    )
+
+
+def _encode_frame(header: dict[str, Any], body: bytes = b"") -> bytes:
+    header_bytes = json.dumps({**header, "length": len(body)}).encode()
+    return FRAME_HEADER_LENGTH.pack(len(header_bytes)) + header_bytes + body
+
+
+async def iter_associated_image_frames(
+    requests: list[tuple[str, str]],
+    max_width=MAX_ASSOCIATED_IMAGE_SIZE,
+    max_height=MAX_ASSOCIATED_IMAGE_SIZE,
+) -> AsyncGenerator[bytes, None]:
+    """
+    Extract the requested (file name, image key) pairs, and encode each result as a frame.
+
+    The requests form a new viewport, which is scheduled ahead of all earlier requests, in the
+    order given. Frames are produced as soon as each image is ready, with an error status and
+    detail if it failed. If the response is abandoned, any images not yet started are dropped.
+    """
+    generation = thumbnail_scheduler.new_viewport()
+
+    async def get_frame(position: int, file_name: str, image_key: str) -> bytes:
+        header: dict[str, Any] = {"file_name": file_name, "image_key": image_key}
+        try:
+            image_bytes = await get_scheduled_associated_image(
+                file_name, image_key, max_width, max_height, (generation, position)
+            )
+        except AssociatedImageError as e:
+            return _encode_frame({**header, "status": e.status_code, "detail": e.detail})
+        except Exception as e:
+            return _encode_frame(
+                {
+                    **header,
+                    "status": 422,
+                    "detail": f"Could not read {image_key} image for {file_name}: {e}",
+                }
+            )
+        return _encode_frame({**header, "status": 200, "media_type": "image/jpeg"}, image_bytes)
+
+    tasks = [
+        asyncio.create_task(get_frame(position, file_name, image_key))
+        for position, (file_name, image_key) in enumerate(requests)
+    ]
+    try:
+        for next_frame in asyncio.as_completed(tasks):
+            yield await next_frame
+    finally:
+        for task in tasks:
+            task.cancel()
@@ -0,0 +1,188 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+import os
+from pathlib import Path
+import threading
+from typing import Any
+
+from imagedephi.rules import FileFormat
+from imagedephi.utils.image import get_file_format_from_path
+
+MAX_CACHED_LISTINGS = 16
+LISTING_MAX_WORKERS = 2
+# Upper bound on how long a listing request waits for files to be identified as images
+LISTING_WAIT_TIMEOUT = 2.0
+
+FileSignature = tuple[int, int]
+
+
+def _get_file_signature(path: Path) -> FileSignature | None:
+    try:
+        stat = path.stat()
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _get_file_format(path: Path) -> FileFormat | None:
+    try:
+        return get_file_format_from_path(path)
+    except OSError:
+        # Don't list inaccessible files as images
+        return None
+
+
+@dataclass
+class DirectoryListing:
+    """
+    The contents of a directory, with files identified as images in the background.
+
+    Files are identified in name order, so the images found so far are always the first images
+    of the directory.
+    """
+
+    directory: Path
+    mtime_ns: int
+    child_directories: list[str]
+    child_files: list[str]
+    child_yaml_files: list[str]
+    # Formats identified by a previous listing of the same directory, which may be reused
+    previous_formats: dict[str, tuple[FileSignature | None, FileFormat | None]] = field(
+        default_factory=dict
+    )
+    condition: threading.Condition = field(default_factory=threading.Condition)
+    file_formats: dict[str, tuple[FileSignature | None, FileFormat | None]] = field(
+        default_factory=dict
+    )
+    child_images: list[str] = field(default_factory=list)
+    working: bool = False
+    stopped: bool = False
+
+    @classmethod
+    def scan(cls, directory: Path, mtime_ns: int) -> DirectoryListing:
+        child_directories = []
+        child_files = []
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir():
+                        if os.access(entry.path, os.R_OK):
+                            child_directories.append(entry.name)
+                    elif entry.is_file():
+                        child_files.append(entry.name)
+                except OSError:
+                    continue
+        child_files.sort()
+        return cls(
+            directory,
+            mtime_ns,
+            sorted(child_directories),
+            child_files,
+            [name for name in child_files if name.endswith(".yaml")],
+        )
+
+    @property
+    def complete(self) -> bool:
+        return len(self.file_formats) == len(self.child_files)
+
+    def work(self) -> None:
+        """Identify the format of each file, until all are done or the listing is replaced."""
+        for name in self.child_files[len(self.file_formats) :]:
+            if self.stopped:
+                break
+            path = self.directory / name
+            signature = _get_file_signature(path)
+            previous = self.previous_formats.get(name)
+            if previous is not None and signature is not None and previous[0] == signature:
+                file_format = previous[1]
+            else:
+                file_format = _get_file_format(path)
+            with self.condition:
+                self.file_formats[name] = (signature, file_format)
+                if file_format is not None:
+                    self.child_images.append(name)
+                self.condition.notify_all()
+        with self.condition:
+            self.working = False
+            self.condition.notify_all()
+
+    def wait_for_images(self, count: int | None, timeout: float = LISTING_WAIT_TIMEOUT) -> None:
+        """Block until `count` images are found, or all files are identified."""
+        with self.condition:
+            self.condition.wait_for(
+                lambda: self.complete
+                or (count is not None and len(self.child_images) >= count)
+                or not self.working,
+                timeout=timeout,
+            )
+
+    def get_page(self, limit: int | None, offset: int) -> dict[str, Any]:
+        with self.condition:
+            if limit is None:
+                images = self.child_images[offset:]
+            else:
+                images = self.child_images[offset * limit : (offset + 1) * limit]
+            return {
+                "child_directories": self.child_directories,
+                "child_images": images,
+                "child_yaml_files": self.child_yaml_files,
+                "image_count": len(self.child_images),
+                "file_count": len(self.child_files),
+                "images_complete": self.complete,
+            }
+
+
+class DirectoryListingCache:
+    """Cache directory listings, until the modification time of the directory changes."""
+
+    def __init__(
+        self,
+        max_cached_listings: int = MAX_CACHED_LISTINGS,
+        max_workers: int = LISTING_MAX_WORKERS,
+    ) -> None:
+        self.max_cached_listings = max_cached_listings
+        self._lock = threading.Lock()
+        self._listings: OrderedDict[Path, DirectoryListing] = OrderedDict()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="directory-listing"
+        )
+
+    def get_listing(self, directory: Path) -> DirectoryListing:
+        key = directory.resolve()
+        mtime_ns = key.stat().st_mtime_ns
+        with self._lock:
+            listing = self._listings.get(key)
+            if listing is not None:
+                self._listings.move_to_end(key)
+                if listing.mtime_ns == mtime_ns:
+                    return listing
+        new_listing = DirectoryListing.scan(key, mtime_ns)
+        with self._lock:
+            current = self._listings.get(key)
+            if current is not None and current.mtime_ns == mtime_ns:
+                # Another request listed the directory in the meantime
+                return current
+            if current is not None:
+                current.stopped = True
+                with current.condition:
+                    new_listing.previous_formats = dict(current.file_formats)
+            self._listings[key] = new_listing
+            self._listings.move_to_end(key)
+            while len(self._listings) > self.max_cached_listings:
+                _, evicted = self._listings.popitem(last=False)
+                evicted.stopped = True
+            new_listing.working = True
+        self._executor.submit(new_listing.work)
+        return new_listing
+
+    def clear(self) -> None:
+        with self._lock:
+            for listing in self._listings.values():
+                listing.stopped = True
+            self._listings.clear()
+
+
+directory_listings = DirectoryListingCache()
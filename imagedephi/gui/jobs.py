@@ -0,0 +1,222 @@
+from __future__ import annotations
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from enum import Enum
+from pathlib import Path
+import threading
+import time
+from typing import Any
+from uuid import uuid4
+
+from imagedephi.gui.plan_store import plan_store
+from imagedephi.redact import redact_images
+from imagedephi.utils.logger import logger
+from imagedephi.utils.progress_log import progress_broadcaster
+
+# Redaction is mostly disk-bound, so only a few jobs should run at once
+JOB_MAX_WORKERS = 2
+# Finished jobs are kept around so clients can query their outcome, but only a bounded number
+MAX_FINISHED_JOBS = 100
+
+
+class JobStatus(Enum):
+    Queued = "queued"
+    Running = "running"
+    Completed = "completed"
+    Failed = "failed"
+    Cancelled = "cancelled"
+
+
+FINISHED_JOB_STATUSES = {JobStatus.Completed, JobStatus.Failed, JobStatus.Cancelled}
+
+
+class RedactionJob:
+    """A single run of `redact_images`, with its own progress and cancellation state."""
+
+    id: str
+    input_paths: list[Path]
+    output_dir: Path
+    override_rules: Path | None
+    rename: bool
+    export_associated: bool
+
+    status: JobStatus
+    count: int
+    max: int
+    redact_dir: Path | None
+    error: str | None
+    created: float
+    started: float | None
+    finished: float | None
+
+    def __init__(
+        self,
+        input_paths: list[Path],
+        output_dir: Path,
+        override_rules: Path | None = None,
+        rename: bool = True,
+        export_associated: bool = False,
+    ) -> None:
+        self.id = uuid4().hex
+        self.input_paths = input_paths
+        self.output_dir = output_dir
+        self.override_rules = override_rules
+        self.rename = rename
+        self.export_associated = export_associated
+
+        self.status = JobStatus.Queued
+        # "count" is the number of images that have been started, including the current one
+        self.count = 0
+        self.max = 0
+        self.redact_dir = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.cancel_event = threading.Event()
+        self.future: Future[None] | None = None
+
+    @property
+    def finished_count(self) -> int:
+        if self.status == JobStatus.Completed:
+            return self.max
+        if self.status == JobStatus.Cancelled:
+            # Cancellation is only checked between images, so the last started image was finished
+            return self.count
+        return max(self.count - 1, 0)
+
+    def status_report(self) -> dict[str, Any]:
+        return {
+            "job_id": self.id,
+            "status": self.status.value,
+            "count": self.count,
+            "max": self.max,
+            "redact_dir": self.redact_dir.name if self.redact_dir else None,
+            "error": self.error,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+        }
+
+    def throughput_report(self) -> dict[str, Any]:
+        elapsed = 0.0
+        if self.started is not None:
+            elapsed = (self.finished or time.time()) - self.started
+        images_per_second = self.finished_count / elapsed if elapsed > 0 else 0.0
+        remaining = self.max - self.finished_count
+        eta = remaining / images_per_second if images_per_second and remaining else None
+        return {
+            "job_id": self.id,
+            "status": self.status.value,
+            "finished_count": self.finished_count,
+            "max": self.max,
+            "elapsed": elapsed,
+            "images_per_second": images_per_second,
+            "eta": None if self.status in FINISHED_JOB_STATUSES else eta,
+        }
+
+    def publish(self) -> None:
+        progress_broadcaster.publish(
+            self.id, self.status_report(), final=self.status in FINISHED_JOB_STATUSES
+        )
+
+    def _on_progress(self, count: int, max: int, redact_dir: Path) -> None:
+        self.count = count
+        self.max = max
+        self.redact_dir = redact_dir
+        self.publish()
+
+    def run(self) -> None:
+        if self.cancel_event.is_set():
+            self.status = JobStatus.Cancelled
+            self.finished = time.time()
+            self.publish()
+            return
+        self.status = JobStatus.Running
+        self.started = time.time()
+        self.publish()
+        try:
+            # Images that were already planned for display aren't planned again
+            plans = {}
+            for input_path in self.input_paths:
+                plans.update(plan_store.take_plans(input_path, self.override_rules))
+            self.redact_dir = redact_images(
+                self.input_paths,
+                self.output_dir,
+                override_rules=self.override_rules,
+                rename=self.rename,
+                export_associated=self.export_associated,
+                progress_callback=self._on_progress,
+                cancel_event=self.cancel_event,
+                plans=plans,
+            )
+        except Exception as e:
+            logger.error(f"Redaction job {self.id} failed: {e}")
+            self.error = str(e.args[0] if len(e.args) else e)
+            self.status = JobStatus.Failed
+        else:
+            self.status = JobStatus.Cancelled if self.cancel_event.is_set() else JobStatus.Completed
+        self.finished = time.time()
+        self.publish()
+
+
+class JobManager:
+    """Run redaction jobs on a pool of background workers."""
+
+    def __init__(self, max_workers: int = JOB_MAX_WORKERS) -> None:
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._jobs: dict[str, RedactionJob] = {}
+        self._executor: ThreadPoolExecutor | None = None
+
+    def submit(self, job: RedactionJob) -> RedactionJob:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix="redaction-job"
+                )
+            self._prune_finished_jobs()
+            self._jobs[job.id] = job
+            job.future = self._executor.submit(job.run)
+        job.publish()
+        return job
+
+    def _prune_finished_jobs(self) -> None:
+        finished = [job for job in self._jobs.values() if job.status in FINISHED_JOB_STATUSES]
+        # Jobs are stored in creation order, so the oldest are removed first
+        for job in finished[: max(len(finished) - MAX_FINISHED_JOBS + 1, 0)]:
+            del self._jobs[job.id]
+
+    def get(self, job_id: str) -> RedactionJob | None:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def jobs(self) -> list[RedactionJob]:
+        with self._lock:
+            return list(self._jobs.values())
+
+    def cancel(self, job_id: str) -> RedactionJob | None:
+        job = self.get(job_id)
+        if job is None:
+            return None
+        job.cancel_event.set()
+        if job.future is not None and job.future.cancel():
+            # The job never started, so it won't report its own cancellation
+            job.status = JobStatus.Cancelled
+            job.finished = time.time()
+            job.publish()
+        return job
+
+    def shutdown(self) -> None:
+        """Cancel all jobs and wait for running ones to stop."""
+        with self._lock:
+            executor = self._executor
+            self._executor = None
+            jobs = list(self._jobs.values())
+        for job in jobs:
+            job.cancel_event.set()
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+job_manager = JobManager()
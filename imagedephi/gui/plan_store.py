@@ -0,0 +1,350 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from enum import Enum
+import hashlib
+from pathlib import Path
+import threading
+from typing import Any
+
+from imagedephi.redact.build_redaction_plan import build_redaction_plan, get_changed_rule_keys
+from imagedephi.redact.plan_session import PlanQuery, PlanSession, to_columnar
+from imagedephi.redact.plan_template import PlanTemplateCache
+from imagedephi.redact.redact import (
+    _get_user_rules,
+    get_base_rules,
+    get_unprocessable_image_message,
+)
+from imagedephi.redact.redaction_plan import RedactionPlan, ReportDetail
+from imagedephi.rules import Ruleset
+from imagedephi.utils.directory import iter_image_dirs
+
+# Each cached directory holds a report for every image, so only keep a few around
+MAX_CACHED_PLANS = 4
+PLAN_MAX_WORKERS = 2
+# Upper bound on how long a page request waits for its rows to be planned
+PAGE_WAIT_TIMEOUT = 30.0
+
+FileSignature = tuple[int, int]
+
+
+class PlanLayout(Enum):
+    # A report dictionary for each image
+    Rows = "rows"
+    # A list of images, and a list of values for each tag with one entry per image
+    Columns = "columns"
+
+
+def _get_file_signature(path: Path) -> FileSignature | None:
+    try:
+        stat = path.stat()
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def get_ruleset_hash(override_rules: Path | None, profile: str = "") -> str:
+    """Return a digest identifying the rules that a plan is built with."""
+    digest = hashlib.sha256(profile.encode())
+    if override_rules is not None:
+        digest.update(override_rules.read_bytes())
+    return digest.hexdigest()
+
+
+@dataclass
+class DirectoryPlan:
+    """
+    Redaction plans for every image in a directory, built in the background.
+
+    Reports are kept in the order they should be displayed, so that any page can be served as soon
+    as the images before it have been planned. The plans themselves are kept too, with their parsed
+    headers released, so that a redaction of the directory doesn't need to plan them again.
+    """
+
+    directory: Path
+    base_rules: Ruleset
+    override_rules: Ruleset | None
+    condition: threading.Condition = field(default_factory=threading.Condition)
+    image_paths: dict[Path, FileSignature | None] = field(default_factory=dict)
+    # Every report is needed to sort the whole directory, so none are evicted
+    session: PlanSession = field(default_factory=lambda: PlanSession(max_images=None))
+    pending: list[Path] = field(default_factory=list)
+    working: bool = False
+    plan_templates: PlanTemplateCache = field(default_factory=PlanTemplateCache)
+    # The rules that each planned image's plan depends on. Images with the same tags share a set.
+    rule_keys: dict[Path, frozenset[str]] = field(default_factory=dict)
+    _rule_key_sets: dict[frozenset[str], frozenset[str]] = field(default_factory=dict)
+    plans: dict[Path, RedactionPlan] = field(default_factory=dict)
+
+    @property
+    def complete(self) -> bool:
+        return not self.pending and not self.working
+
+    def refresh(self) -> bool:
+        """
+        Compare the directory contents with the cached plans.
+
+        Return whether any images need to be planned again. Only new images, and images whose
+        modification time or size changed, are planned again.
+        """
+        current_paths = {
+            image_path: _get_file_signature(image_path)
+            for image_path in iter_image_dirs([self.directory])
+        }
+        with self.condition:
+            for image_path in list(self.image_paths):
+                if image_path not in current_paths:
+                    self._remove(image_path)
+            for image_path, signature in current_paths.items():
+                if self.image_paths.get(image_path, ()) != signature:
+                    self._remove(image_path)
+                    self.image_paths[image_path] = signature
+                    if image_path not in self.pending:
+                        self.pending.append(image_path)
+            # Plan images in display order, so the first pages are ready first
+            self.pending.sort(key=lambda image_path: image_path.name)
+            return bool(self.pending)
+
+    def reuse_reports(self, previous: DirectoryPlan) -> int:
+        """
+        Copy reports from a plan of the same directory that was made with other rules.
+
+        Only reports of images whose plans don't depend on any of the changed rules are copied.
+        Those images aren't planned again unless they change. Return the number of reports copied.
+        """
+        changed_rule_keys = get_changed_rule_keys(
+            (previous.base_rules, previous.override_rules), (self.base_rules, self.override_rules)
+        )
+        if changed_rule_keys is None:
+            return 0
+        reused = []
+        with previous.condition:
+            for image_path, rule_keys in previous.rule_keys.items():
+                if image_path in previous.pending or not rule_keys.isdisjoint(changed_rule_keys):
+                    continue
+                image_report = previous.session.get_image_report(image_path.name)
+                if image_report is not None:
+                    reused.append(
+                        (image_path, previous.image_paths[image_path], rule_keys, image_report)
+                    )
+        with self.condition:
+            for image_path, signature, rule_keys, (tags, comprehensive) in reused:
+                self.image_paths[image_path] = signature
+                self.rule_keys[image_path] = self._rule_key_sets.setdefault(rule_keys, rule_keys)
+                self.session.add_image_report(image_path.name, tags, comprehensive)
+        return len(reused)
+
+    def _remove(self, image_path: Path) -> None:
+        self.image_paths.pop(image_path, None)
+        self.rule_keys.pop(image_path, None)
+        self.plans.pop(image_path, None)
+        self.session.remove(image_path)
+        if image_path in self.pending:
+            self.pending.remove(image_path)
+
+    def work(self) -> None:
+        """Plan pending images until none remain."""
+        while True:
+            with self.condition:
+                if not self.pending:
+                    self.working = False
+                    self.condition.notify_all()
+                    return
+                image_path = self.pending.pop(0)
+                signature = self.image_paths.get(image_path)
+            redaction_plan, report, comprehensive, message, rule_keys = self._plan_image(image_path)
+            with self.condition:
+                # The image may have been changed or removed while it was being planned
+                if self.image_paths.get(image_path, ()) == signature and (
+                    image_path not in self.pending
+                ):
+                    # Some images, such as DICOM associated images marked for deletion, aren't
+                    # reported
+                    if image_path.name in report:
+                        self.session.add_report(
+                            image_path.name, dict(report[image_path.name]), comprehensive
+                        )
+                        self.rule_keys[image_path] = self._rule_key_sets.setdefault(
+                            rule_keys, rule_keys
+                        )
+                    if redaction_plan is not None:
+                        self.plans[image_path] = redaction_plan
+                    elif message is not None:
+                        self.session.add_unprocessable_image(image_path, message)
+                self.condition.notify_all()
+
+    def _plan_image(
+        self, image_path: Path
+    ) -> tuple[RedactionPlan | None, dict[str, Any], bool, str | None, frozenset[str]]:
+        try:
+            redaction_plan = build_redaction_plan(
+                image_path, self.base_rules, self.override_rules, plan_templates=self.plan_templates
+            )
+            # Reports are sent to the browser for every image, so long values are truncated
+            report = redaction_plan.report_plan(ReportDetail.Summary)
+        except Exception as e:
+            return None, {}, False, get_unprocessable_image_message(image_path, e), frozenset()
+        # Every plan of the directory is kept, so only their decisions are held onto
+        redaction_plan.release()
+        return (
+            redaction_plan,
+            report,
+            redaction_plan.is_comprehensive(),
+            None,
+            frozenset(redaction_plan.rule_keys),
+        )
+
+    def take_plans(self) -> dict[Path, RedactionPlan]:
+        """Remove and return the plans made so far, which may then be executed."""
+        with self.condition:
+            plans = self.plans
+            self.plans = {}
+        return plans
+
+    def wait_for_rows(self, count: int, timeout: float = PAGE_WAIT_TIMEOUT) -> None:
+        """Block until at least `count` images are planned, or all planning is done."""
+        with self.condition:
+            self.condition.wait_for(
+                lambda: self.complete or self.session.total >= count,
+                timeout=timeout,
+            )
+
+    def get_page(
+        self,
+        limit: int,
+        offset: int,
+        plan_query: PlanQuery | None = None,
+        layout: PlanLayout = PlanLayout.Rows,
+    ) -> dict[str, Any]:
+        plan_query = plan_query or PlanQuery()
+        with self.condition:
+            complete = self.complete
+            data, total = self.session.query(plan_query, limit, offset)
+            if not complete and not plan_query.filtered:
+                # Not every image has been planned, so estimate with the images that might be
+                total = len(self.image_paths) - len(self.session.unprocessable_image_messages)
+            return {
+                "data": to_columnar(data) if layout == PlanLayout.Columns else data,
+                "total": total,
+                "tags": self.session.tags_used,
+                "missing_rules": self.session.missing_rules,
+                "complete": complete,
+            }
+
+
+class PlanStore:
+    """Cache redaction plans for directories, keyed by directory and the rules used."""
+
+    def __init__(
+        self, max_cached_plans: int = MAX_CACHED_PLANS, max_workers: int = PLAN_MAX_WORKERS
+    ) -> None:
+        self.max_cached_plans = max_cached_plans
+        self._lock = threading.Lock()
+        self._plans: OrderedDict[tuple[Path, str], DirectoryPlan] = OrderedDict()
+        # Plans don't modify their base rules, so each profile's rules are only parsed once
+        self._base_rules: dict[str, Ruleset] = {}
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="redaction-plan"
+        )
+
+    def _get_base_rules(self, profile: str) -> Ruleset:
+        with self._lock:
+            base_rules = self._base_rules.get(profile)
+        if base_rules is None:
+            base_rules = get_base_rules(profile)
+            with self._lock:
+                base_rules = self._base_rules.setdefault(profile, base_rules)
+        return base_rules
+
+    def _get_directory_plan(
+        self, directory: Path, override_rules: Path | None, profile: str
+    ) -> tuple[DirectoryPlan, bool]:
+        key = (directory.resolve(), get_ruleset_hash(override_rules, profile))
+        with self._lock:
+            directory_plan = self._plans.get(key)
+            if directory_plan is not None:
+                self._plans.move_to_end(key)
+                return directory_plan, False
+        directory_plan = DirectoryPlan(
+            directory,
+            self._get_base_rules(profile),
+            _get_user_rules(override_rules) if override_rules else None,
+        )
+        with self._lock:
+            # When rules are edited, the most recent plan for the directory has the old rules
+            previous = next(
+                (
+                    previous_plan
+                    for (previous_directory, _), previous_plan in reversed(self._plans.items())
+                    if previous_directory == key[0]
+                ),
+                None,
+            )
+        if previous is not None:
+            directory_plan.reuse_reports(previous)
+        with self._lock:
+            # Another request may have created the same plan in the meantime
+            directory_plan = self._plans.setdefault(key, directory_plan)
+            self._plans.move_to_end(key)
+            while len(self._plans) > self.max_cached_plans:
+                self._plans.popitem(last=False)
+        return directory_plan, True
+
+    def _start(self, directory_plan: DirectoryPlan) -> None:
+        with directory_plan.condition:
+            if directory_plan.working or not directory_plan.pending:
+                return
+            directory_plan.working = True
+        self._executor.submit(directory_plan.work)
+
+    def get_page(
+        self,
+        directory: Path,
+        override_rules: Path | None = None,
+        profile: str = "",
+        limit: int = 10,
+        offset: int = 0,
+        refresh: bool = True,
+        plan_query: PlanQuery | None = None,
+        layout: PlanLayout = PlanLayout.Rows,
+    ) -> dict[str, Any]:
+        """
+        Return one page of the sorted redaction plan for a directory.
+
+        Planning continues in the background, and the page is returned once enough images have
+        been planned to fill it. Until all images are planned, the result is marked incomplete;
+        images that are found to have missing rules later are still sorted ahead of others.
+        If `refresh` is set, or the directory hasn't been seen before, new or modified images are
+        planned again.
+
+        `plan_query` filters, sorts and projects the images before they are paged, and `layout`
+        chooses how each page is laid out. When filtering, the total counts matching images.
+        """
+        directory_plan, created = self._get_directory_plan(directory, override_rules, profile)
+        if refresh or created:
+            directory_plan.refresh()
+        self._start(directory_plan)
+        directory_plan.wait_for_rows((offset + 1) * limit)
+        return directory_plan.get_page(limit, offset, plan_query, layout)
+
+    def take_plans(
+        self, directory: Path, override_rules: Path | None = None, profile: str = ""
+    ) -> dict[Path, RedactionPlan]:
+        """
+        Remove and return the plans made for a directory with the given rules, if any.
+
+        The plans aren't made again, but the reports of the directory are kept.
+        """
+        key = (directory.resolve(), get_ruleset_hash(override_rules, profile))
+        with self._lock:
+            directory_plan = self._plans.get(key)
+        return directory_plan.take_plans() if directory_plan is not None else {}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._plans.clear()
+
+
+plan_store = PlanStore()
@@ -0,0 +1,88 @@
+from __future__ import annotations
+
+import mimetypes
+import os
+from typing import Any
+
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+from starlette.types import Scope
+
+# Precompressed variants are written next to each asset by the client build, most preferred first
+PRECOMPRESSED_ENCODINGS = [("br", ".br"), ("gzip", ".gz")]
+
+# Asset file names include a hash of their content, so a cached copy never goes stale
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Other files, like "index.html", keep their names, so browsers must check for a newer version
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+
+def _accepted_encodings(request_headers: Headers) -> set[str]:
+    accepted = set()
+    for value in request_headers.get("accept-encoding", "").split(","):
+        encoding, _, params = value.partition(";")
+        name, _, quality = params.partition("=")
+        try:
+            if name.strip() == "q" and float(quality) == 0:
+                # The client explicitly refuses this encoding
+                continue
+        except ValueError:
+            pass
+        accepted.add(encoding.strip().lower())
+    return accepted
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    """
+    Serve static files, preferring a precompressed variant that the client accepts.
+
+    A variant is a file with the same name plus an encoding suffix, like "index.js.br". If
+    `immutable` is set, responses may be cached indefinitely, otherwise clients must revalidate.
+    """
+
+    def __init__(self, *args: Any, immutable: bool = False, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.cache_control = IMMUTABLE_CACHE_CONTROL if immutable else REVALIDATE_CACHE_CONTROL
+
+    def file_response(
+        self,
+        full_path: str | os.PathLike[str],
+        stat_result: os.stat_result,
+        scope: Scope,
+        status_code: int = 200,
+    ) -> Response:
+        request_headers = Headers(scope=scope)
+        headers = {"Cache-Control": self.cache_control, "Vary": "Accept-Encoding"}
+        media_type = mimetypes.guess_type(str(full_path))[0] or "text/plain"
+
+        response = None
+        accepted = _accepted_encodings(request_headers)
+        for encoding, suffix in PRECOMPRESSED_ENCODINGS:
+            if encoding not in accepted:
+                continue
+            compressed_path = f"{full_path}{suffix}"
+            try:
+                compressed_stat = os.stat(compressed_path)
+            except OSError:
+                continue
+            response = FileResponse(
+                compressed_path,
+                status_code=status_code,
+                headers={**headers, "Content-Encoding": encoding},
+                media_type=media_type,
+                stat_result=compressed_stat,
+            )
+            break
+        if response is None:
+            response = FileResponse(
+                full_path,
+                status_code=status_code,
+                headers=headers,
+                media_type=media_type,
+                stat_result=stat_result,
+            )
+
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
@@ -0,0 +1,201 @@
+from __future__ import annotations
+
+import asyncio
+from collections.abc import Callable, Hashable
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import heapq
+import itertools
+import multiprocessing
+import os
+import threading
+from typing import Any, TypeVar
+
+T = TypeVar("T")
+
+# Decoding and resizing are CPU-bound, so only run a few at once
+THUMBNAIL_MAX_WORKERS = min(4, os.cpu_count() or 1)
+
+# Tasks are ordered by newest viewport first, then by position within the viewport
+Priority = tuple[int, int]
+
+
+def _queue_order(priority: Priority) -> tuple[int, int]:
+    """Return a key that orders more urgent priorities first."""
+    generation, position = priority
+    return -generation, position
+
+
+class ThumbnailTask:
+    """A unit of work shared by every request for the same key."""
+
+    def __init__(self, key: Hashable, fn: Callable[[], Any], priority: Priority) -> None:
+        self.key = key
+        self.fn = fn
+        self.priority = priority
+        self.future: Future[Any] = Future()
+        self.waiters = 0
+
+
+class ThumbnailScheduler:
+    """
+    Run thumbnail work on a bounded pool of workers, by priority.
+
+    Every call to `new_viewport` starts a new generation of requests, and requests from the most
+    recent generation are always run first. Identical requests are coalesced, so that work for a
+    key runs once while it is queued or in progress, and work that no request is waiting for
+    anymore is dropped before it starts.
+
+    Work runs in worker threads, which can share caches of parsed files. Work can pass decoding
+    and resizing images to `run_in_process`, which by default uses a pool of worker processes, so
+    that it doesn't hold the GIL of the server process.
+    """
+
+    def __init__(
+        self, max_workers: int = THUMBNAIL_MAX_WORKERS, use_processes: bool = True
+    ) -> None:
+        self.max_workers = max_workers
+        self.use_processes = use_processes
+        self._process_pool: ProcessPoolExecutor | None = None
+        self._condition = threading.Condition()
+        self._generation = 0
+        self._sequence = itertools.count()
+        self._queue: list[tuple[int, int, int, ThumbnailTask]] = []
+        self._tasks: dict[Hashable, ThumbnailTask] = {}
+        self._workers: list[threading.Thread] = []
+        self._stopped = False
+
+    def new_viewport(self) -> int:
+        """Return a generation that takes priority over all earlier ones."""
+        with self._condition:
+            self._generation += 1
+            return self._generation
+
+    def submit(self, key: Hashable, fn: Callable[[], Any], priority: Priority) -> ThumbnailTask:
+        """
+        Queue `fn` to run for `key`, unless the same key is already queued or in progress.
+
+        Each call must be matched by a call to `release` once the result is no longer needed.
+        """
+        with self._condition:
+            task = self._tasks.get(key)
+            if task is None or task.future.done():
+                task = ThumbnailTask(key, fn, priority)
+                self._tasks[key] = task
+                self._push(task)
+            elif _queue_order(priority) < _queue_order(task.priority) and (
+                not task.future.running()
+            ):
+                # A newer viewport, or an earlier position, asked for the same work, so move it up
+                # the queue. Less urgent requests never move it down.
+                task.priority = priority
+                self._push(task)
+            task.waiters += 1
+            self._start_worker()
+            return task
+
+    def release(self, task: ThumbnailTask) -> None:
+        """Stop waiting for a task, and drop it if nothing else is waiting for it."""
+        with self._condition:
+            task.waiters -= 1
+            if task.waiters <= 0 and task.future.cancel():
+                self._forget(task)
+
+    async def run(self, key: Hashable, fn: Callable[[], Any], priority: Priority) -> Any:
+        """Wait for the result of `fn` for `key`, which is cancelled if the caller is."""
+        task = self.submit(key, fn, priority)
+        try:
+            # Shield the shared future, so one cancelled caller doesn't cancel the others
+            return await asyncio.shield(asyncio.wrap_future(task.future))
+        finally:
+            self.release(task)
+
+    def _push(self, task: ThumbnailTask) -> None:
+        heapq.heappush(self._queue, (*_queue_order(task.priority), next(self._sequence), task))
+        self._condition.notify()
+
+    def _forget(self, task: ThumbnailTask) -> None:
+        if self._tasks.get(task.key) is task:
+            del self._tasks[task.key]
+
+    def _start_worker(self) -> None:
+        if self._stopped or len(self._workers) >= self.max_workers:
+            return
+        if len(self._workers) >= len(self._tasks):
+            return
+        worker = threading.Thread(target=self._work, name="thumbnail-scheduler", daemon=True)
+        self._workers.append(worker)
+        worker.start()
+
+    def _next_task(self) -> ThumbnailTask | None:
+        with self._condition:
+            while True:
+                if self._stopped:
+                    return None
+                while self._queue:
+                    negative_generation, position, _, task = heapq.heappop(self._queue)
+                    if task.priority != (-negative_generation, position) or task.future.done():
+                        # The task was moved up the queue, and this is its old entry
+                        continue
+                    if task.future.set_running_or_notify_cancel():
+                        return task
+                self._condition.wait()
+
+    def _get_process_pool(self) -> ProcessPoolExecutor:
+        with self._condition:
+            if self._process_pool is None:
+                self._process_pool = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    # Forking a server process with running threads isn't safe
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            return self._process_pool
+
+    def run_in_process(self, fn: Callable[[], T]) -> T:
+        """Return the result of `fn`, from a worker process unless processes aren't used."""
+        if not self.use_processes:
+            return fn()
+        process_pool = self._get_process_pool()
+        try:
+            return process_pool.submit(fn).result()
+        except BrokenProcessPool:
+            # A worker process died, so start a new pool for later work
+            with self._condition:
+                if self._process_pool is process_pool:
+                    self._process_pool = None
+            raise
+
+    def _work(self) -> None:
+        while (task := self._next_task()) is not None:
+            try:
+                result = task.fn()
+            except Exception as e:
+                task.future.set_exception(e)
+            else:
+                task.future.set_result(result)
+            finally:
+                with self._condition:
+                    self._forget(task)
+
+    def shutdown(self) -> None:
+        """Cancel all queued work, and stop the workers once their current work is done."""
+        with self._condition:
+            self._stopped = True
+            for *_, task in self._queue:
+                if task.future.cancel():
+                    self._forget(task)
+            self._queue.clear()
+            workers = self._workers
+            self._workers = []
+            self._condition.notify_all()
+        for worker in workers:
+            worker.join()
+        with self._condition:
+            process_pool = self._process_pool
+            self._process_pool = None
+            self._stopped = False
+        if process_pool is not None:
+            process_pool.shutdown(wait=True, cancel_futures=True)
+
+
+thumbnail_scheduler = ThumbnailScheduler()
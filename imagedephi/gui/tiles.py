@@ -0,0 +1,272 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+from dataclasses import dataclass
+from io import BytesIO
+from pathlib import Path
+import threading
+from typing import TYPE_CHECKING, Any, BinaryIO, cast
+
+from PIL import Image, UnidentifiedImageError
+import tifftools
+
+from imagedephi.utils.image import get_file_format_from_path
+from imagedephi.utils.tiff import is_tiled, iter_ifds, read_tiff_info
+
+if TYPE_CHECKING:
+    from tifftools.tifftools import IFD, TagEntry
+
+# Each cached image holds an open file and its parsed header
+MAX_CACHED_TILED_IMAGES = 16
+
+JPEG_COMPRESSION = 7
+# JPEG 2000 tiles, as written by Aperio and others, are complete codestreams
+JPEG_2000_COMPRESSIONS = {33003, 33004, 33005, 34712}
+# Other tiles are decoded as a TIFF image of one tile: none, LZW, Deflate and PackBits
+TIFF_DECODED_COMPRESSIONS = {1, 5, 8, 32773, 32946}
+# Tags describing how tile data is decoded, which are copied to single tile images
+TILE_DECODING_TAGS = [
+    tifftools.Tag.BitsPerSample,
+    tifftools.Tag.Compression,
+    tifftools.Tag.Photometric,
+    tifftools.Tag.SamplesPerPixel,
+    tifftools.Tag.PlanarConfig,
+    tifftools.Tag.Predictor,
+    tifftools.Tag.SampleFormat,
+    tifftools.Tag.ExtraSamples,
+    tifftools.Tag.ColorMap,
+]
+SEPARATE_PLANAR_CONFIG = 2
+RGB_PHOTOMETRIC = 2
+JPEG_SOI = b"\xff\xd8"
+# An Adobe APP14 marker with no color transform, so decoders don't treat RGB data as YCbCr
+ADOBE_RGB_MARKER = b"\xff\xee\x00\x0eAdobe\x00d\x00\x00\x00\x00\x00"
+
+
+class TileError(Exception):
+    def __init__(self, status_code: int, detail: str) -> None:
+        super().__init__(status_code, detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+def _get_tag_value(ifd: IFD, tag: tifftools.TiffTag, default: Any = None) -> Any:
+    entry = ifd["tags"].get(tag.value)
+    return entry["data"][0] if entry else default
+
+
+@dataclass
+class PyramidLevel:
+    ifd: IFD
+    width: int
+    height: int
+    tile_width: int
+    tile_height: int
+
+    @property
+    def tiles_across(self) -> int:
+        return -(-self.width // self.tile_width)
+
+    @property
+    def tiles_down(self) -> int:
+        return -(-self.height // self.tile_height)
+
+
+class TiledImage:
+    """
+    The tiled resolution levels of a TIFF image, with an open file to read tiles from.
+
+    Level 0 is the full resolution image, and each following level has a lower resolution.
+    """
+
+    def __init__(self, image_path: Path) -> None:
+        if get_file_format_from_path(image_path) is None:
+            raise TileError(404, f"{image_path} is not a tiled TIFF image")
+        ifds = read_tiff_info(image_path)["ifds"]
+        levels = [
+            PyramidLevel(
+                ifd=ifd,
+                width=int(_get_tag_value(ifd, tifftools.Tag.ImageWidth)),
+                height=int(_get_tag_value(ifd, tifftools.Tag.ImageLength)),
+                tile_width=int(_get_tag_value(ifd, tifftools.Tag.TileWidth)),
+                tile_height=int(_get_tag_value(ifd, tifftools.Tag.TileLength)),
+            )
+            for ifd in iter_ifds(ifds)
+            if is_tiled(ifd)
+        ]
+        if not levels:
+            raise TileError(404, f"{image_path} is not a tiled TIFF image")
+        for level in levels:
+            compression = _get_tag_value(level.ifd, tifftools.Tag.Compression, 1)
+            if compression not in (
+                {JPEG_COMPRESSION} | JPEG_2000_COMPRESSIONS | TIFF_DECODED_COMPRESSIONS
+            ):
+                raise TileError(415, f"Tiles with compression {compression} aren't supported")
+            if _get_tag_value(level.ifd, tifftools.Tag.PlanarConfig) == SEPARATE_PLANAR_CONFIG:
+                raise TileError(415, "Tiles with separate color planes aren't supported")
+        levels.sort(key=lambda level: level.width, reverse=True)
+        base = levels[0]
+        # Associated images may also be tiled, but they don't have the base image's aspect ratio
+        self.levels = [
+            level
+            for level in levels
+            if abs(level.width / base.width - level.height / base.height) < 0.02
+        ]
+        self.image_path = image_path
+        # Requests for tiles are handled in several threads, which share the file position
+        self._file: BinaryIO = open(image_path, "rb")
+        self._file_lock = threading.Lock()
+
+    def close(self) -> None:
+        with self._file_lock:
+            self._file.close()
+
+    def _read(self, offset: int, byte_count: int) -> bytes:
+        with self._file_lock:
+            # An image may be closed while a request still uses it, once it leaves the cache
+            if self._file.closed:
+                self._file = open(self.image_path, "rb")
+            self._file.seek(offset)
+            return self._file.read(byte_count)
+
+    def info(self) -> dict[str, Any]:
+        base = self.levels[0]
+        return {
+            "width": base.width,
+            "height": base.height,
+            "levels": [
+                {
+                    "level": index,
+                    "width": level.width,
+                    "height": level.height,
+                    "tile_width": level.tile_width,
+                    "tile_height": level.tile_height,
+                    "tiles_across": level.tiles_across,
+                    "tiles_down": level.tiles_down,
+                    "downsample": base.width / level.width,
+                }
+                for index, level in enumerate(self.levels)
+            ],
+        }
+
+    def get_tile(self, level_index: int, x: int, y: int) -> bytes:
+        """
+        Return a tile as a JPEG.
+
+        JPEG tiles are returned as they are stored, without decoding them. Other tiles, and tiles
+        at the edges of the image, which are stored with padding, are decoded and encoded again.
+        Tiles that aren't JPEG or JPEG 2000 codestreams are decoded as a TIFF image of one tile.
+        """
+        if not 0 <= level_index < len(self.levels):
+            raise TileError(404, f"No level {level_index} in {self.image_path}")
+        level = self.levels[level_index]
+        if not (0 <= x < level.tiles_across and 0 <= y < level.tiles_down):
+            raise TileError(404, f"No tile {x}, {y} at level {level_index} in {self.image_path}")
+        tile_index = y * level.tiles_across + x
+        offset = int(level.ifd["tags"][tifftools.Tag.TileOffsets.value]["data"][tile_index])
+        byte_count = int(level.ifd["tags"][tifftools.Tag.TileByteCounts.value]["data"][tile_index])
+        data = self._read(offset, byte_count)
+
+        compression = _get_tag_value(level.ifd, tifftools.Tag.Compression, 1)
+        if compression == JPEG_COMPRESSION:
+            data = self._complete_jpeg(level.ifd, data)
+        elif compression in TIFF_DECODED_COMPRESSIONS:
+            data = self._single_tile_tiff(level, data)
+        crop_width = min(level.tile_width, level.width - x * level.tile_width)
+        crop_height = min(level.tile_height, level.height - y * level.tile_height)
+        is_edge = crop_width < level.tile_width or crop_height < level.tile_height
+        if data.startswith(JPEG_SOI) and not is_edge:
+            return data
+
+        try:
+            tile_image: Image.Image = Image.open(BytesIO(data))
+            tile_image.load()
+        except (UnidentifiedImageError, OSError) as e:
+            raise TileError(422, f"Could not decode tile from {self.image_path}: {e}")
+        if is_edge:
+            tile_image = tile_image.crop((0, 0, crop_width, crop_height))
+        if tile_image.mode not in ("RGB", "L"):
+            tile_image = tile_image.convert("RGB")
+        jpeg_buffer = BytesIO()
+        tile_image.save(jpeg_buffer, "JPEG", quality=90)
+        return jpeg_buffer.getvalue()
+
+    @staticmethod
+    def _single_tile_tiff(level: PyramidLevel, data: bytes) -> bytes:
+        """Make a TIFF image containing only one tile of a level."""
+        tags = {
+            tag.value: level.ifd["tags"][tag.value]
+            for tag in TILE_DECODING_TAGS
+            if tag.value in level.ifd["tags"]
+        }
+        # Tile data is copied from its offset, and an offset of 0 would mean there's no tile
+        tile_offset = 8
+        for tag, value in [
+            (tifftools.Tag.ImageWidth, level.tile_width),
+            (tifftools.Tag.ImageLength, level.tile_height),
+            (tifftools.Tag.TileWidth, level.tile_width),
+            (tifftools.Tag.TileLength, level.tile_height),
+            (tifftools.Tag.TileOffsets, tile_offset),
+            (tifftools.Tag.TileByteCounts, len(data)),
+        ]:
+            tags[tag.value] = cast(
+                "TagEntry", {"datatype": tifftools.Datatype.LONG.value, "data": [value]}
+            )
+        tile_ifd = cast(
+            "IFD",
+            {
+                "tags": tags,
+                "path_or_fobj": BytesIO(bytes(tile_offset) + data),
+                "size": tile_offset + len(data),
+            },
+        )
+        tile_tiff = BytesIO()
+        tifftools.write_tiff(tile_ifd, tile_tiff)
+        return tile_tiff.getvalue()
+
+    @staticmethod
+    def _complete_jpeg(ifd: IFD, data: bytes) -> bytes:
+        """Make a JPEG tile readable on its own, by splicing in the shared JPEG tables."""
+        tables = ifd["tags"].get(tifftools.Tag.JPEGTables.value)
+        if tables and data.startswith(JPEG_SOI):
+            table_bytes = tables["data"]
+            assert isinstance(table_bytes, bytes)
+            # Both the tables and the tile are complete JPEG streams, so drop the tables' end
+            # marker and the tile's start marker
+            data = table_bytes[:-2] + data[2:]
+        if _get_tag_value(ifd, tifftools.Tag.Photometric) == RGB_PHOTOMETRIC:
+            data = JPEG_SOI + ADOBE_RGB_MARKER + data[2:]
+        return data
+
+
+_tiled_images: OrderedDict[tuple[Path, int, int], TiledImage] = OrderedDict()
+_tiled_image_lock = threading.Lock()
+
+
+def get_tiled_image(image_path: Path) -> TiledImage:
+    """Return a tiled image, reusing a recently opened one if the file hasn't changed."""
+    try:
+        stat = image_path.stat()
+    except OSError:
+        raise TileError(404, f"{image_path} does not exist")
+    key = (image_path.resolve(), stat.st_mtime_ns, stat.st_size)
+    with _tiled_image_lock:
+        tiled_image = _tiled_images.get(key)
+        if tiled_image is not None:
+            _tiled_images.move_to_end(key)
+            return tiled_image
+    try:
+        tiled_image = TiledImage(image_path)
+    except tifftools.TifftoolsError:
+        raise TileError(404, f"{image_path} is not a tiled TIFF image")
+    with _tiled_image_lock:
+        cached_image = _tiled_images.setdefault(key, tiled_image)
+        evicted_images = []
+        while len(_tiled_images) > MAX_CACHED_TILED_IMAGES:
+            evicted_images.append(_tiled_images.popitem(last=False)[1])
+    if cached_image is not tiled_image:
+        # Another request opened the same image first
+        evicted_images.append(tiled_image)
+    for evicted_image in evicted_images:
+        evicted_image.close()
+    return cached_image
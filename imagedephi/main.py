@@ -6,6 +6,7 @@ import importlib.resources
 import logging
 from pathlib import Path
 import shutil
+import sqlite3
 import sys
 import webbrowser
 
@@ -20,10 +21,22 @@ import yaml
 
 from imagedephi.command_file import CommandFile
 from imagedephi.gui.app import app
-from imagedephi.redact import ProfileChoice, redact_images, show_redaction_plan
+from imagedephi.redact import (
+    ProfileChoice,
+    index_images,
+    redact_images,
+    show_redaction_plan,
+    take_census,
+)
 from imagedephi.utils.cli import FallthroughGroup, run_coroutine
 from imagedephi.utils.directory import iter_image_dirs
 from imagedephi.utils.logger import logger
+from imagedephi.utils.metadata_index import (
+    DEFAULT_METADATA_INDEX_PATH,
+    MetadataIndex,
+    get_metadata_index,
+    set_metadata_index,
+)
 from imagedephi.utils.network import unused_tcp_port, wait_for_port
 from imagedephi.utils.os import launched_from_windows_explorer
 
@@ -197,6 +210,14 @@ def set_logging_config(v: int, q: int, log_file: Path | None = None):
 )
 @click.version_option(prog_name="ImageDePHI")
 @global_options
+@click.option(
+    "--metadata-index",
+    type=click.Path(dir_okay=False, path_type=Path),
+    default=DEFAULT_METADATA_INDEX_PATH,
+    show_default="in the user application directory",
+    help="Index of image metadata, created by the 'index' command. If the index exists, the"
+    " metadata of unchanged images is read from it.",
+)
 def imagedephi(
     verbose: int,
     quiet: int,
@@ -205,10 +226,17 @@ def imagedephi(
     profile: str,
     recursive: bool,
     require_all: bool,
+    metadata_index: Path,
 ) -> None:
     """Redact microscopy whole slide images."""
     if verbose or quiet or log_file:
         set_logging_config(verbose, quiet, log_file)
+    set_metadata_index(None)
+    if metadata_index.is_file():
+        try:
+            set_metadata_index(MetadataIndex(metadata_index))
+        except sqlite3.Error as e:
+            logger.warning(f"Could not open metadata index {metadata_index}: {e}")
 
 
 @imagedephi.command(no_args_is_help=True)
@@ -478,6 +506,103 @@ def plan(
         sys.exit(1)
 
 
+@imagedephi.command(no_args_is_help=True)
+@click.argument(
+    "input-paths",
+    type=click.Path(exists=True, readable=True, path_type=Path),
+    required=True,
+    nargs=-1,
+)
+@click.option(
+    "-r", "--recursive", is_flag=True, help="Apply the command to images in subdirectories"
+)
+@click.pass_context
+def index(ctx, input_paths: list[Path], recursive: bool) -> None:
+    """
+    Index the metadata of images, so that later commands don't read it again.
+
+    Images are only read again once they change. Indexed images that no longer exist in the given
+    directories are removed from the index.
+    """
+    metadata_index = get_metadata_index()
+    if metadata_index is None:
+        metadata_index = MetadataIndex(ctx.parent.params["metadata_index"])
+        set_metadata_index(metadata_index)
+    image_count = index_images(input_paths, recursive or ctx.parent.params["recursive"])
+    removed_count = sum(
+        metadata_index.prune(input_path) for input_path in input_paths if input_path.is_dir()
+    )
+    click.echo(
+        f"Indexed {image_count} image(s) in {metadata_index.index_path}"
+        + (f", and removed {removed_count} missing image(s)." if removed_count else ".")
+    )
+
+
+@imagedephi.command(no_args_is_help=True)
+@global_options
+@click.argument(
+    "input-paths",
+    type=click.Path(exists=True, readable=True, path_type=Path),
+    required=True,
+    nargs=-1,
+)
+@click.option("--fail-fast", is_flag=True, help="Stop at the first tag without a rule.")
+@click.pass_context
+def census(
+    ctx,
+    input_paths: list[Path],
+    profile: str,
+    override_rules: Path | None,
+    recursive: bool,
+    require_all: bool,
+    quiet,
+    verbose,
+    log_file,
+    fail_fast: bool,
+) -> None:
+    """
+    List the distinct tags in images, with whether the rules cover them.
+
+    Only the headers of images are read, and each distinct tag is checked against the rules once.
+    Tags without a rule are listed first, and the command fails if there are any.
+    """
+    params = _check_parent_params(
+        ctx, profile, override_rules, recursive, require_all, quiet, verbose, log_file
+    )
+    set_logging_config(params["verbose"], params["quiet"], params["log_file"])
+
+    tag_census = take_census(
+        input_paths,
+        override_rules=params["override_rules"],
+        recursive=params["recursive"],
+        profile=params["profile"],
+        fail_fast=fail_fast,
+    )
+    entries = sorted(
+        tag_census.entries.values(),
+        key=lambda entry: (entry.covered, entry.file_format.value, entry.section, entry.label),
+    )
+    click.echo("rule\tformat\tsection\ttag\timages\texample")
+    for entry in entries:
+        click.echo(
+            f"{'covered' if entry.covered else 'missing'}\t{entry.file_format.value}"
+            f"\t{entry.section}\t{entry.label}\t{entry.count}\t{entry.example}"
+        )
+
+    for message in tag_census.unprocessable.values():
+        click.echo(message, err=True)
+    uncovered = tag_census.uncovered
+    click.echo(
+        f"Scanned {tag_census.image_count} image(s), and found {len(entries)} distinct tag(s), "
+        f"{len(uncovered)} without a rule.",
+        err=True,
+    )
+    if not tag_census.complete:
+        click.echo("Stopped at the first tag without a rule.", err=True)
+    if uncovered:
+        sys.exit(1)
+
+
 @imagedephi.command
 @click.option(
     "--port",
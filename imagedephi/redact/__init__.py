@@ -1,3 +1,16 @@
-from .redact import ProfileChoice, redact_images, show_redaction_plan
+from .census import TagCensus, take_census
+from .plan_session import PlanSession
+from .redact import ProfileChoice, index_images, redact_images, show_redaction_plan
+from .redaction_plan import ReportDetail
 
-__all__ = ["iter_image_dirs", "redact_images", "show_redaction_plan", "ProfileChoice"]
+__all__ = [
+    "index_images",
+    "iter_image_dirs",
+    "redact_images",
+    "show_redaction_plan",
+    "take_census",
+    "PlanSession",
+    "ProfileChoice",
+    "ReportDetail",
+    "TagCensus",
+]
@@ -1,11 +1,11 @@
 from pathlib import Path
 
-from imagedephi.rules import FileFormat, Ruleset
+from imagedephi.rules import DicomRules, FileFormat, Ruleset, SvsRules, TiffRules
 from imagedephi.utils.image import get_file_format_from_path
-from imagedephi.utils.tiff import get_is_svs
 
 from .dicom import DicomRedactionPlan
-from .redaction_plan import RedactionPlan
+from .plan_template import PlanTemplateCache
+from .redaction_plan import RedactionPlan, rule_key
 from .svs import SvsRedactionPlan
 from .tiff import TiffRedactionPlan, UnsupportedFileTypeError
 
@@ -14,38 +14,112 @@ class ImageDePHIRedactionError(Exception):
     """Thrown when the program encounters problems with current configuration and image files."""
 
 
+def get_svs_rules(base_rules: Ruleset, override_rules: Ruleset | None = None) -> SvsRules:
+    # Copies share their rule dictionaries with the base rules, so merged dictionaries are new
+    merged_svs_rules = base_rules.svs.copy()
+    if override_rules:
+        merged_svs_rules.metadata = {**merged_svs_rules.metadata, **override_rules.svs.metadata}
+        merged_svs_rules.associated_images = {
+            **merged_svs_rules.associated_images,
+            **override_rules.svs.associated_images,
+        }
+        merged_svs_rules.image_description = {
+            **merged_svs_rules.image_description,
+            **override_rules.svs.image_description,
+        }
+    return merged_svs_rules
+
+
+def get_tiff_rules(base_rules: Ruleset, override_rules: Ruleset | None = None) -> TiffRules:
+    merged_tiff_rules = base_rules.tiff.copy()
+    if override_rules:
+        merged_tiff_rules.metadata = {**merged_tiff_rules.metadata, **override_rules.tiff.metadata}
+        merged_tiff_rules.associated_images = {
+            **merged_tiff_rules.associated_images,
+            **override_rules.tiff.associated_images,
+        }
+    return merged_tiff_rules
+
+
+def get_dicom_rules(base_rules: Ruleset, override_rules: Ruleset | None = None) -> DicomRules:
+    dicom_rules = base_rules.dicom.copy()
+    if override_rules:
+        dicom_rules.metadata = {**dicom_rules.metadata, **override_rules.dicom.metadata}
+        dicom_rules.custom_metadata_action = override_rules.dicom.custom_metadata_action
+        dicom_rules.associated_images = {
+            **dicom_rules.associated_images,
+            **override_rules.dicom.associated_images,
+        }
+    return dicom_rules
+
+
+def get_changed_rule_keys(
+    old_rules: tuple[Ruleset, Ruleset | None], new_rules: tuple[Ruleset, Ruleset | None]
+) -> set[str] | None:
+    """
+    Return the keys of rules that differ between two pairs of base and override rules.
+
+    Keys match those of `RedactionPlan.rule_keys`, so a plan made with the old rules is also the
+    plan for the new rules if none of its keys changed. Return `None` if the rules differ in a way
+    that could change any plan, like the strict setting or a fallback action.
+    """
+    (old_base, old_override), (new_base, new_override) = old_rules, new_rules
+    old_strict = old_override.strict if old_override else old_base.strict
+    new_strict = new_override.strict if new_override else new_base.strict
+    if old_strict != new_strict:
+        return None
+
+    changed_rule_keys = set()
+    for file_format, get_rules in [
+        (FileFormat.SVS, get_svs_rules),
+        (FileFormat.TIFF, get_tiff_rules),
+        (FileFormat.DICOM, get_dicom_rules),
+    ]:
+        old_format_rules = get_rules(old_base, old_override)
+        new_format_rules = get_rules(new_base, new_override)
+        for section in type(new_format_rules).model_fields:
+            old_value = getattr(old_format_rules, section)
+            new_value = getattr(new_format_rules, section)
+            if old_value == new_value:
+                continue
+            if section == "associated_images":
+                # Plans depend on all associated image rules at once
+                changed_rule_keys.add(rule_key(file_format, section))
+            elif isinstance(new_value, dict):
+                changed_rule_keys.update(
+                    rule_key(file_format, section, key)
+                    for key in old_value.keys() | new_value.keys()
+                    if old_value.get(key) != new_value.get(key)
+                )
+            else:
+                return None
+    return changed_rule_keys
+
+
 def build_redaction_plan(
     image_path: Path,
     base_rules: Ruleset,
     override_rules: Ruleset | None = None,
     dcm_uid_map: dict[str, str] | None = None,
+    plan_templates: PlanTemplateCache | None = None,
 ) -> RedactionPlan:
     file_format = get_file_format_from_path(image_path)
     strict = override_rules.strict if override_rules else base_rules.strict
-    if file_format == FileFormat.TIFF:
-        if get_is_svs(image_path):
-            merged_svs_rules = base_rules.svs.copy()
-            if override_rules:
-                merged_svs_rules.metadata.update(override_rules.svs.metadata)
-                merged_svs_rules.associated_images.update(override_rules.svs.associated_images)
-                merged_svs_rules.image_description.update(override_rules.svs.image_description)
-            return SvsRedactionPlan(image_path, merged_svs_rules, strict)
-        else:
-            merged_tiff_rules = base_rules.tiff.copy()
-            if override_rules:
-                merged_tiff_rules.metadata.update(override_rules.tiff.metadata)
-                merged_tiff_rules.associated_images.update(override_rules.tiff.associated_images)
-            return TiffRedactionPlan(image_path, merged_tiff_rules, strict)
+    if file_format == FileFormat.SVS:
+        return SvsRedactionPlan(
+            image_path, get_svs_rules(base_rules, override_rules), strict, plan_templates
+        )
+    elif file_format == FileFormat.TIFF:
+        return TiffRedactionPlan(
+            image_path, get_tiff_rules(base_rules, override_rules), strict, plan_templates
+        )
     elif file_format == FileFormat.DICOM:
         if strict:
             raise ImageDePHIRedactionError(
                 "strict redaction is not currently supported for DICOM images"
             )
-        dicom_rules = base_rules.dicom.copy()
-        if override_rules:
-            dicom_rules.metadata.update(override_rules.dicom.metadata)
-            dicom_rules.custom_metadata_action = override_rules.dicom.custom_metadata_action
-            dicom_rules.associated_images.update(override_rules.dicom.associated_images)
-        return DicomRedactionPlan(image_path, dicom_rules, dcm_uid_map)
+        return DicomRedactionPlan(
+            image_path, get_dicom_rules(base_rules, override_rules), dcm_uid_map
+        )
     else:
         raise UnsupportedFileTypeError(f"File format for {image_path} not supported.")
@@ -0,0 +1,201 @@
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import pydicom
+from pydicom.datadict import keyword_for_tag
+from pydicom.tag import BaseTag, Tag
+import tifftools
+import tifftools.constants
+from tqdm import tqdm
+from tqdm.contrib.logging import logging_redirect_tqdm
+
+from imagedephi.rules import ConcreteMetadataRule, DicomRules, FileFormat, SvsRules, TiffRules
+from imagedephi.utils.directory import iter_image_dirs
+from imagedephi.utils.image import get_file_format_from_path
+from imagedephi.utils.logger import logger
+from imagedephi.utils.metadata_index import get_indexed
+from imagedephi.utils.tiff import IfdTraversal, read_tiff_info
+
+from .build_redaction_plan import (
+    ImageDePHIRedactionError,
+    get_dicom_rules,
+    get_svs_rules,
+    get_tiff_rules,
+)
+from .dicom import DicomRedactionPlan, get_element_rule
+from .redact import (
+    _get_user_rules,
+    generator_to_list_with_progress,
+    get_base_rules,
+    get_unprocessable_image_message,
+)
+from .svs import MalformedAperioFileError, SvsDescription, get_description_key_rule
+from .tiff import UnsupportedFileTypeError, check_tag_supported, get_tag_rule
+
+# Scanning is mostly waiting to read headers, so threads overlap the reads of many files
+CENSUS_MAX_WORKERS = 8
+
+CensusTag = tifftools.TiffTag | BaseTag | str
+
+
+@dataclass
+class CensusEntry:
+    """A distinct tag found by a census, with the number of images it's in and an example."""
+
+    file_format: FileFormat
+    section: str
+    label: str
+    covered: bool
+    count: int = 0
+    example: Path | None = None
+
+
+@dataclass
+class TagCensus:
+    """
+    The distinct tags found in the headers of a set of images.
+
+    Entries are keyed by file format, the section of rules that applies to the tag, and a label
+    for the tag. Images that couldn't be read, or that plans don't support, are listed in
+    `unprocessable` instead, with the same message as plans. `complete` is unset if the census
+    stopped before scanning every image.
+    """
+
+    entries: dict[tuple[FileFormat, str, str], CensusEntry] = field(default_factory=dict)
+    image_count: int = 0
+    unprocessable: dict[Path, str] = field(default_factory=dict)
+    complete: bool = True
+
+    @property
+    def uncovered(self) -> list[CensusEntry]:
+        return [entry for entry in self.entries.values() if not entry.covered]
+
+
+def _read_dicom_tags(image_path: Path) -> list[int]:
+    dicom_data = pydicom.dcmread(image_path, stop_before_pixels=True)
+    return [int(element.tag) for element, _ in DicomRedactionPlan._iter_dicom_elements(dicom_data)]
+
+
+def read_census_tags(
+    image_path: Path, strict: bool = False
+) -> tuple[FileFormat, dict[tuple[str, str], CensusTag]]:
+    """
+    Return the format of an image and the distinct tags in its header, by section and label.
+
+    Only headers are read, through the metadata index if one is in use. Keys of Aperio
+    ImageDescription metadata are included unless `strict` is set, as plans handle them. Like
+    plans, this raises an `UnsupportedFileTypeError` for tags of files that can't be redacted.
+    """
+    file_format = get_file_format_from_path(image_path)
+    tags: dict[tuple[str, str], CensusTag] = {}
+    if file_format == FileFormat.DICOM:
+        if strict:
+            raise ImageDePHIRedactionError(
+                "strict redaction is not currently supported for DICOM images"
+            )
+        for tag_id in get_indexed(image_path, "dicom_tags", _read_dicom_tags):
+            element_tag = Tag(tag_id)
+            keyword = keyword_for_tag(element_tag)
+            label = f"{keyword} {element_tag}" if keyword else str(element_tag)
+            tags["metadata", label] = element_tag
+    elif file_format in (FileFormat.SVS, FileFormat.TIFF):
+        image_description_tag = tifftools.constants.Tag["ImageDescription"]
+        descriptions = set()
+        for tag, ifd in IfdTraversal(read_tiff_info(image_path)["ifds"]).tag_entries:
+            check_tag_supported(tag)
+            tags["metadata", f"{tag.name} ({tag.value})"] = tag
+            if file_format == FileFormat.SVS and tag.value == image_description_tag.value:
+                descriptions.add(str(ifd["tags"][tag.value]["data"]))
+        if not strict:
+            for description in descriptions:
+                try:
+                    svs_description = SvsDescription(description)
+                except ValueError:
+                    raise MalformedAperioFileError()
+                for key in svs_description.metadata:
+                    tags["image_description", key] = key
+    else:
+        raise UnsupportedFileTypeError(f"File format for {image_path} not supported.")
+    return file_format, tags
+
+
+def get_census_rule(
+    tag: CensusTag, rules: TiffRules | DicomRules, strict: bool = False
+) -> ConcreteMetadataRule | None:
+    """Return the rule that plans would use for a tag found by a census, or `None` if none."""
+    if isinstance(tag, BaseTag):
+        return get_element_rule(tag, rules) if isinstance(rules, DicomRules) else None
+    if isinstance(rules, DicomRules):
+        return None
+    if isinstance(tag, str):
+        return get_description_key_rule(tag, rules) if isinstance(rules, SvsRules) else None
+    return get_tag_rule(tag, rules, strict)
+
+
+def take_census(
+    input_paths: list[Path],
+    override_rules: Path | None = None,
+    recursive: bool = False,
+    profile: str = "",
+    fail_fast: bool = False,
+    max_workers: int = CENSUS_MAX_WORKERS,
+) -> TagCensus:
+    """
+    Find the distinct tags in the headers of the images in `input_paths`, and check their rules.
+
+    Headers are read in parallel, without building a plan for each image. Each distinct tag is
+    checked against the rules once, when it's first found. If `fail_fast` is set, the census stops
+    at the first tag without a rule.
+    """
+    base_rules = get_base_rules(profile)
+    override_ruleset = _get_user_rules(override_rules) if override_rules else None
+    strict = override_ruleset.strict if override_ruleset else base_rules.strict
+    format_rules: dict[FileFormat, TiffRules | DicomRules] = {
+        FileFormat.SVS: get_svs_rules(base_rules, override_ruleset),
+        FileFormat.TIFF: get_tiff_rules(base_rules, override_ruleset),
+        FileFormat.DICOM: get_dicom_rules(base_rules, override_ruleset),
+    }
+    with logging_redirect_tqdm(loggers=[logger]):
+        image_paths = generator_to_list_with_progress(
+            iter_image_dirs(input_paths, recursive),
+            progress_bar_desc="Collecting files to scan...",
+        )
+
+    census = TagCensus()
+    with logging_redirect_tqdm(loggers=[logger]), ThreadPoolExecutor(max_workers) as executor:
+        futures = {
+            executor.submit(read_census_tags, image_path, strict): image_path
+            for image_path in image_paths
+        }
+        for future in tqdm(
+            as_completed(futures), total=len(futures), desc="Scanning headers", position=0
+        ):
+            image_path = futures[future]
+            try:
+                file_format, tags = future.result()
+            # Handle and report errors without stopping the census
+            except Exception as e:
+                census.unprocessable[image_path] = get_unprocessable_image_message(image_path, e)
+                continue
+            census.image_count += 1
+            found_uncovered = False
+            for (section, label), tag in tags.items():
+                entry = census.entries.get((file_format, section, label))
+                if entry is None:
+                    rule = get_census_rule(tag, format_rules[file_format], strict)
+                    entry = CensusEntry(file_format, section, label, rule is not None)
+                    census.entries[file_format, section, label] = entry
+                    found_uncovered |= not entry.covered
+                entry.count += 1
+                # Images finish in any order, so report the same example for each run
+                if entry.example is None or image_path < entry.example:
+                    entry.example = image_path
+            if fail_fast and found_uncovered:
+                executor.shutdown(wait=False, cancel_futures=True)
+                break
+
+    census.complete = census.image_count + len(census.unprocessable) == len(image_paths)
+    return census
@@ -3,7 +3,7 @@ from __future__ import annotations
 from collections.abc import Generator
 from datetime import date, datetime
 from pathlib import Path
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Any
 from uuid import uuid4
 
 import pydicom
@@ -11,6 +11,8 @@ from pydicom import valuerep
 from pydicom.datadict import keyword_for_tag
 from pydicom.dataelem import DataElement
 from pydicom.dataset import Dataset
+from pydicom.multival import MultiValue
+from pydicom.sequence import Sequence
 from pydicom.tag import BaseTag
 
 from imagedephi.rules import (
@@ -24,7 +26,14 @@ from imagedephi.rules import (
 )
 from imagedephi.utils.logger import logger
 
-from .redaction_plan import RedactionPlan
+from .redaction_plan import (
+    PlanOutdatedError,
+    RedactionPlan,
+    ReportDetail,
+    file_signature,
+    report_tag_entry,
+    rule_key,
+)
 
 if TYPE_CHECKING:
     from .redaction_plan import RedactionPlanReport
@@ -57,6 +66,54 @@ for vr in valuerep.BYTES_VR:
 WSI_IMAGE_TYPE_INDEX = 2
 
 
+def _report_value(value: Any) -> Any:
+    """Convert an element value to a plain JSON-compatible value, for reports."""
+    if value is None or isinstance(value, bool):
+        return value
+    if isinstance(value, int):
+        return int(value)
+    if isinstance(value, float):
+        return float(value)
+    if isinstance(value, Sequence):
+        return f"{len(value)} item(s)"
+    if isinstance(value, (list, MultiValue)):
+        return [_report_value(item) for item in value]
+    return str(value)
+
+
+def get_element_rule(tag: BaseTag, rules: DicomRules) -> ConcreteMetadataRule | None:
+    """Return the rule for a DICOM element by its keyword or tag, or `None` if none applies."""
+    custom_metadata_key = "CustomMetadataItem"
+    keyword = keyword_for_tag(tag)
+    # Check keyword and (gggg,eeee) representation
+    tag_in_rules = keyword in rules.metadata or str(tag) in rules.metadata
+    if not tag_in_rules:
+        # For custom metadata, attempt to fall back to the custom_metadata_action (this can
+        # be overriden by rules for individual tags). If the custom metadata action is to
+        # use the rules, skip generating these on-the-fly rules.
+        if tag.group % 2 == 1:
+            if rules.custom_metadata_action == "delete":
+                return DeleteRule(key_name=custom_metadata_key, action="delete")
+            elif rules.custom_metadata_action == "keep":
+                return KeepRule(key_name=custom_metadata_key, action="keep")
+        return None
+
+    rule_name = keyword if keyword in rules.metadata else str(tag)
+    rule = rules.metadata[rule_name]
+    if rule.action in [
+        "keep",
+        "delete",
+        "replace",
+        "check_type",
+        "empty",
+        "replace_uid",
+        "replace_dummy",
+        "modify_date",
+    ]:
+        return rule
+    return None
+
+
 class DicomRedactionPlan(RedactionPlan):
     """
     Represents a plan of action for redacting metadata from DICOM images.
@@ -66,7 +123,6 @@ class DicomRedactionPlan(RedactionPlan):
 
     file_format = FileFormat.DICOM
     image_path: Path
-    dicom_data: pydicom.FileDataset
     image_type: str
     metadata_redaction_steps: dict[int, ConcreteMetadataRule]
     no_match_tags: list[BaseTag]
@@ -90,11 +146,14 @@ class DicomRedactionPlan(RedactionPlan):
 
     def __init__(self, image_path: Path, rules: DicomRules, uid_map: dict[str, str] | None) -> None:
         self.image_path = image_path
-        self.dicom_data = pydicom.dcmread(image_path)
+        self._file_signature = file_signature(image_path)
+        self._dicom_data: pydicom.FileDataset | None = pydicom.dcmread(image_path)
+        self._executed = False
         self.image_type = str(self.dicom_data.ImageType[WSI_IMAGE_TYPE_INDEX])
 
         self.metadata_redaction_steps = {}
         self.no_match_tags = []
+        self.rule_keys = {rule_key(self.file_format, "associated_images")}
 
         # Determine what, if any, action to take with this file's
         # image data. Currently only matters for label and overview
@@ -107,43 +166,26 @@ class DicomRedactionPlan(RedactionPlan):
         self.uid_map = uid_map if uid_map else {}
 
         for element, _ in DicomRedactionPlan._iter_dicom_elements(self.dicom_data):
-            custom_metadata_key = "CustomMetadataItem"
             keyword = keyword_for_tag(element.tag)
-            # Check keyword and (gggg,eeee) representation
-            tag_in_rules = keyword in rules.metadata or str(element.tag) in rules.metadata
-            if not tag_in_rules:
-                # For custom metadata, attempt to fall back to the custom_metadata_action (this can
-                # be overriden by rules for individual tags). If the custom metadata action is to
-                # use the rules, skip generating these on-the-fly rules.
-                if element.tag.group % 2 == 1 and rules.custom_metadata_action != "use_rule":
-                    if rules.custom_metadata_action == "delete":
-                        self.metadata_redaction_steps[element.tag] = DeleteRule(
-                            key_name=custom_metadata_key, action="delete"
-                        )
-                    elif rules.custom_metadata_action == "keep":
-                        self.metadata_redaction_steps[element.tag] = KeepRule(
-                            key_name=custom_metadata_key, action="keep"
-                        )
-                else:
-                    self.no_match_tags.append(element.tag)
-                continue
-
-            rule_key = keyword if keyword in rules.metadata else str(element.tag)
-            rule = rules.metadata[rule_key]
-            if rule.action in [
-                "keep",
-                "delete",
-                "replace",
-                "check_type",
-                "empty",
-                "replace_uid",
-                "replace_dummy",
-                "modify_date",
-            ]:
+            self.rule_keys.add(rule_key(self.file_format, "metadata", keyword))
+            self.rule_keys.add(rule_key(self.file_format, "metadata", str(element.tag)))
+            rule = get_element_rule(element.tag, rules)
+            if rule:
                 self.metadata_redaction_steps[element.tag] = rule
             else:
                 self.no_match_tags.append(element.tag)
-                continue
+
+    @property
+    def dicom_data(self) -> pydicom.FileDataset:
+        if self._dicom_data is None:
+            if file_signature(self.image_path) != self._file_signature:
+                raise PlanOutdatedError(f"{self.image_path} changed after it was planned")
+            self._dicom_data = pydicom.dcmread(self.image_path)
+        return self._dicom_data
+
+    def release(self) -> None:
+        if not self._executed:
+            self._dicom_data = None
 
     def passes_type_check(self, element: DataElement) -> bool:
         return isinstance(element.value, VR_TO_EXPECTED_TYPE[element.VR])
@@ -165,7 +207,7 @@ class DicomRedactionPlan(RedactionPlan):
             return rule.action
         return "delete"
 
-    def report_plan(self) -> RedactionPlanReport:
+    def report_plan(self, detail: ReportDetail = ReportDetail.Full) -> RedactionPlanReport:
         logger.debug("DICOM Metadata Redaction Plan\n")
         if self.associated_image_rule:
             if self.associated_image_rule.action == "delete":
@@ -181,10 +223,14 @@ class DicomRedactionPlan(RedactionPlan):
             if rule:
                 operation = self.determine_redaction_operation(rule, element)
                 logger.debug(f"DICOM Tag {element.tag} - {rule.key_name}: {operation}")
-                report[self.image_path.name][f"{element.tag}_{rule.key_name}"] = {
-                    "action": operation,
-                    "value": element.value,
-                }
+                # Values are converted to plain JSON values, so reports can be serialized directly
+                binary = isinstance(element.value, bytes)
+                report[self.image_path.name][f"{element.tag}_{rule.key_name}"] = report_tag_entry(
+                    operation,
+                    element.value if binary else _report_value(element.value),
+                    detail,
+                    binary=binary,
+                )
         self.report_missing_rules(report)
         return report
 
@@ -246,6 +292,7 @@ class DicomRedactionPlan(RedactionPlan):
                 raise NotImplementedError(
                     "Only 'delete' is supported for associated DICOM images at this time."
                 )
+        self._executed = True
         for element, dataset in DicomRedactionPlan._iter_dicom_elements(self.dicom_data):
             rule = self.metadata_redaction_steps[element.tag]
             if rule is not None:
@@ -0,0 +1,423 @@
+from __future__ import annotations
+
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from collections.abc import ItemsView, Iterable, Iterator, Mapping, ValuesView
+from dataclasses import dataclass
+from pathlib import Path
+import sys
+import threading
+from typing import Any, get_args
+
+from imagedephi.rules import RedactionOperation
+
+from .redaction_plan import EXCLUDED_REPORT_TAGS
+
+# Reports for individual images are evicted beyond this many, least recently used first
+DEFAULT_MAX_SESSION_IMAGES = 10_000
+
+# Report keys describing the status of an image rather than one of its tags
+STATUS_REPORT_KEYS = ["missing_tags", "comprehensive"]
+
+# Actions are stored as one byte codes, which index this list
+REPORT_ACTIONS: list[str] = list(get_args(RedactionOperation))
+_ACTION_CODES = {action: code for code, action in enumerate(REPORT_ACTIONS)}
+# Code for report entries that are stored as they are, rather than as a tag action and value
+_PLAIN_ENTRY = 0xFF
+# Placeholder for tag entries reported without a value
+_NO_VALUE = object()
+
+
+def _custom_sort(item):
+    key, value = item
+    if key == "missing_tags":
+        return (0, key)
+    elif isinstance(value, dict) and value["action"] == "delete":
+        return (1, key)
+    else:
+        return (2, key)
+
+
+def sort_image_tags(tags: dict[str, Any]) -> OrderedDict[str, Any]:
+    """Remove tags excluded from reports, and sort the rest by action and tag name."""
+    for tag in EXCLUDED_REPORT_TAGS:
+        tags.pop(tag, None)
+    return OrderedDict(sorted(tags.items(), key=_custom_sort))
+
+
+def image_sort_key(image_name: str, tags: Mapping[str, Any]) -> tuple[int, str]:
+    """Sort images with missing tags first, then by image name."""
+    return (0 if "missing_tags" in tags else 1, image_name)
+
+
+class _ImageReportItems(ItemsView[str, Any]):
+    _mapping: ImageReport
+
+    def __iter__(self) -> Iterator[tuple[str, Any]]:
+        report = self._mapping
+        return ((key, report._entry(index)) for index, key in enumerate(report._keys))
+
+
+class _ImageReportValues(ValuesView[Any]):
+    _mapping: ImageReport
+
+    def __iter__(self) -> Iterator[Any]:
+        report = self._mapping
+        return (report._entry(index) for index in range(len(report._keys)))
+
+
+class ImageReport(Mapping[str, Any]):
+    """
+    A compact, read-only copy of the report for one image.
+
+    Reports for large cohorts are mostly made of small dicts, one per tag, which cost far more
+    memory than their contents. This stores the report keys (interned, so that each name is
+    shared by every image), a one byte action code per tag and the tag values in flat sequences.
+    Entries are rebuilt in their original form as they are accessed, and `to_dict` rebuilds the
+    whole report.
+    """
+
+    __slots__ = ("_keys", "_actions", "_values", "_extras")
+
+    def __init__(self, tags: Mapping[str, Any]) -> None:
+        keys = []
+        actions = bytearray()
+        values = []
+        extras: dict[int, dict[str, Any]] = {}
+        for index, (key, entry) in enumerate(tags.items()):
+            keys.append(sys.intern(key))
+            code = (
+                _ACTION_CODES.get(entry.get("action", ""), _PLAIN_ENTRY)
+                if isinstance(entry, dict)
+                else _PLAIN_ENTRY
+            )
+            actions.append(code)
+            if code == _PLAIN_ENTRY:
+                values.append(entry)
+                continue
+            values.append(entry.get("value", _NO_VALUE))
+            if len(entry) > (1 if values[-1] is _NO_VALUE else 2):
+                # Keep other details, like the size of binary values, as they are
+                extras[index] = {
+                    name: detail
+                    for name, detail in entry.items()
+                    if name not in ("action", "value")
+                }
+        self._keys = tuple(keys)
+        self._actions = bytes(actions)
+        self._values = tuple(values)
+        self._extras = extras or None
+
+    def _entry(self, index: int) -> Any:
+        code = self._actions[index]
+        value = self._values[index]
+        if code == _PLAIN_ENTRY:
+            return value
+        entry: dict[str, Any] = {"action": REPORT_ACTIONS[code]}
+        if value is not _NO_VALUE:
+            entry["value"] = value
+        if self._extras and index in self._extras:
+            entry.update(self._extras[index])
+        return entry
+
+    def __getitem__(self, key: str) -> Any:
+        try:
+            index = self._keys.index(key)
+        except ValueError:
+            raise KeyError(key)
+        return self._entry(index)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._keys
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._keys)
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    # Looking up a key scans the keys, so entries are iterated by position instead
+    def items(self) -> ItemsView[str, Any]:
+        return _ImageReportItems(self)
+
+    def values(self) -> ValuesView[Any]:
+        return _ImageReportValues(self)
+
+    def to_dict(self) -> OrderedDict[str, Any]:
+        return OrderedDict((key, self._entry(index)) for index, key in enumerate(self._keys))
+
+
+@dataclass
+class PlanQuery:
+    """
+    Select, order and project the image reports of a session.
+
+    `sort_by` may be "name", or the name of a tag to sort by its value. By default, images with
+    missing rules are listed first. If `columns` is given, only those tags are included in each
+    report, along with the status of the image.
+    """
+
+    missing_rules_only: bool = False
+    tag: str | None = None
+    action: str | None = None
+    filename: str | None = None
+    sort_by: str | None = None
+    descending: bool = False
+    columns: list[str] | None = None
+
+    @property
+    def filtered(self) -> bool:
+        return bool(self.missing_rules_only or self.tag or self.action or self.filename)
+
+    def matches(self, image_name: str, tags: Mapping[str, Any]) -> bool:
+        if self.missing_rules_only and "missing_tags" not in tags:
+            return False
+        if self.filename and self.filename.lower() not in image_name.lower():
+            return False
+        if self.tag is not None:
+            if self.tag not in tags:
+                return False
+            candidates: Iterable[Any] = [tags[self.tag]]
+        else:
+            candidates = tags.values()
+        if self.action is not None:
+            return any(
+                isinstance(value, dict) and value.get("action") == self.action
+                for value in candidates
+            )
+        return True
+
+    def sort(self, items: list[tuple[str, ImageReport]]) -> list[tuple[str, ImageReport]]:
+        """Order `(image name, report)` items, which are given in the default order."""
+        if self.sort_by is None:
+            return items[::-1] if self.descending else items
+        if self.sort_by == "name":
+            return sorted(items, key=lambda item: item[0], reverse=self.descending)
+        present = []
+        missing = []
+        for image_name, tags in items:
+            value = tags.get(self.sort_by)
+            if isinstance(value, dict):
+                present.append((str(value.get("value", "")), image_name, tags))
+            else:
+                missing.append((image_name, tags))
+        present.sort(key=lambda item: item[:2], reverse=self.descending)
+        # Images without a value for the tag are always listed last, in either direction
+        missing.sort(key=lambda item: item[0])
+        return [(image_name, tags) for _, image_name, tags in present] + missing
+
+    def project(self, tags: ImageReport) -> OrderedDict[str, Any]:
+        if self.columns is None:
+            return tags.to_dict()
+        return OrderedDict(
+            (key, value)
+            for key, value in tags.items()
+            if key in self.columns or key in STATUS_REPORT_KEYS
+        )
+
+
+def to_columnar(reports: OrderedDict[str, OrderedDict[str, Any]]) -> dict[str, Any]:
+    """
+    Convert image reports to a columnar layout.
+
+    Each tag reported for any image has an entry in `actions` and, if it has a value for any
+    image, in `values`, with one item per image. Other details of tag entries, like the size of
+    binary values, are listed in `details`, and entries that aren't tag actions, like the status
+    of the image, in `columns`. Items are `None` for images that don't report that key.
+    """
+    images = list(reports)
+    layout: dict[str, dict[str, list[Any]]] = {
+        "actions": {},
+        "values": {},
+        "details": {},
+        "columns": {},
+    }
+
+    def set_item(part: str, key: str, index: int, value: Any) -> None:
+        column = layout[part].get(key)
+        if column is None:
+            column = layout[part][key] = [None] * len(images)
+        column[index] = value
+
+    for index, tags in enumerate(reports.values()):
+        for key, entry in tags.items():
+            if not isinstance(entry, dict) or entry.get("action") not in _ACTION_CODES:
+                set_item("columns", key, index, entry)
+                continue
+            set_item("actions", key, index, entry["action"])
+            if "value" in entry:
+                set_item("values", key, index, entry["value"])
+            details = {
+                name: detail for name, detail in entry.items() if name not in ("action", "value")
+            }
+            if details:
+                set_item("details", key, index, details)
+    return {"images": images, **layout}
+
+
+class PlanSession:
+    """
+    Collect the redaction plan reports for a set of images.
+
+    A session may be shared between threads. Only the `max_images` most recently used image
+    reports are retained, and pages and totals only include those. Other summary information
+    (tags seen, images with missing rules and images that could not be processed) covers every
+    image added to the session, and evicted images are listed in `evicted_images`. Reports are
+    retained as compact `ImageReport` records, and are returned as dicts.
+    """
+
+    def __init__(self, max_images: int | None = DEFAULT_MAX_SESSION_IMAGES) -> None:
+        self.max_images = max_images
+        self._lock = threading.RLock()
+        self._reports: OrderedDict[str, ImageReport] = OrderedDict()
+        self._sorted_index: list[tuple[int, str]] = []
+        self._evicted_images: set[str] = set()
+        self._incomplete_images: set[str] = set()
+        self._tags_used: OrderedDict[str, None] = OrderedDict()
+        self._unprocessable_image_messages: dict[Path, str] = {}
+
+    def add_report(self, image_name: str, tags: dict[str, Any], comprehensive: bool) -> None:
+        """Add or replace the report for a single image."""
+        self.add_image_report(image_name, ImageReport(sort_image_tags(tags)), comprehensive)
+
+    def add_image_report(
+        self, image_name: str, sorted_tags: ImageReport, comprehensive: bool
+    ) -> None:
+        """Add or replace the report for a single image, from the report of another session."""
+        with self._lock:
+            self._remove_report(image_name)
+            self._reports[image_name] = sorted_tags
+            insort(self._sorted_index, image_sort_key(image_name, sorted_tags))
+            self._evicted_images.discard(image_name)
+            if not comprehensive:
+                self._incomplete_images.add(image_name)
+            self._tags_used.update(dict.fromkeys(sorted_tags))
+            if self.max_images is not None:
+                while len(self._reports) > self.max_images:
+                    evicted_name, evicted_tags = self._reports.popitem(last=False)
+                    self._remove_from_index(evicted_name, evicted_tags)
+                    self._evicted_images.add(evicted_name)
+
+    def add_unprocessable_image(self, image_path: Path, message: str) -> None:
+        with self._lock:
+            self._unprocessable_image_messages[image_path] = message
+
+    def remove(self, image_path: Path) -> None:
+        """Forget everything known about an image."""
+        with self._lock:
+            self._remove_report(image_path.name)
+            self._evicted_images.discard(image_path.name)
+            self._incomplete_images.discard(image_path.name)
+            self._unprocessable_image_messages.pop(image_path, None)
+
+    def _remove_report(self, image_name: str) -> None:
+        tags = self._reports.pop(image_name, None)
+        if tags is not None:
+            self._remove_from_index(image_name, tags)
+        self._incomplete_images.discard(image_name)
+
+    def _remove_from_index(self, image_name: str, tags: ImageReport) -> None:
+        sort_key = image_sort_key(image_name, tags)
+        index = bisect_left(self._sorted_index, sort_key)
+        if index < len(self._sorted_index) and self._sorted_index[index] == sort_key:
+            del self._sorted_index[index]
+
+    def get_report(self, image_name: str) -> OrderedDict[str, Any] | None:
+        with self._lock:
+            tags = self._reports.get(image_name)
+            if tags is None:
+                return None
+            self._reports.move_to_end(image_name)
+            return tags.to_dict()
+
+    def get_image_report(self, image_name: str) -> tuple[ImageReport, bool] | None:
+        """Return the report for an image, and whether the image's plan is comprehensive."""
+        with self._lock:
+            tags = self._reports.get(image_name)
+            if tags is None:
+                return None
+            return tags, image_name not in self._incomplete_images
+
+    def get_page(
+        self, limit: int | None = None, offset: int | None = None
+    ) -> OrderedDict[str, OrderedDict[str, Any]]:
+        """Return retained reports, sorted with images that have missing rules first."""
+        with self._lock:
+            return OrderedDict(
+                (image_name, tags.to_dict()) for image_name, tags in self._page_items(limit, offset)
+            )
+
+    def _page_items(self, limit: int | None, offset: int | None) -> list[tuple[str, ImageReport]]:
+        if limit is not None and offset is not None:
+            page_keys = self._sorted_index[offset * limit : (offset + 1) * limit]
+        else:
+            page_keys = self._sorted_index
+        return [(image_name, self._reports[image_name]) for _, image_name in page_keys]
+
+    def query(
+        self, plan_query: PlanQuery, limit: int | None = None, offset: int | None = None
+    ) -> tuple[OrderedDict[str, OrderedDict[str, Any]], int]:
+        """
+        Return retained reports selected by `plan_query`, and how many reports matched in total.
+
+        Without a filter or sort order, this uses the same order as `get_page`.
+        """
+        with self._lock:
+            if not plan_query.filtered and plan_query.sort_by is None and not plan_query.descending:
+                items = self._page_items(limit, offset)
+                total = len(self._sorted_index)
+            else:
+                items = [
+                    (image_name, self._reports[image_name])
+                    for _, image_name in self._sorted_index
+                    if plan_query.matches(image_name, self._reports[image_name])
+                ]
+                items = plan_query.sort(items)
+                total = len(items)
+                if limit is not None and offset is not None:
+                    items = items[offset * limit : (offset + 1) * limit]
+        return (
+            OrderedDict((image_name, plan_query.project(tags)) for image_name, tags in items),
+            total,
+        )
+
+    def clear(self) -> None:
+        with self._lock:
+            self._reports.clear()
+            self._sorted_index.clear()
+            self._evicted_images.clear()
+            self._incomplete_images.clear()
+            self._tags_used.clear()
+            self._unprocessable_image_messages.clear()
+
+    @property
+    def total(self) -> int:
+        """The number of images with a retained report, which is the number that can be paged."""
+        with self._lock:
+            return len(self._reports)
+
+    @property
+    def evicted_images(self) -> list[str]:
+        """Images whose reports were evicted, and so aren't included in pages."""
+        with self._lock:
+            return sorted(self._evicted_images)
+
+    @property
+    def tags_used(self) -> list[str]:
+        with self._lock:
+            return list(self._tags_used)
+
+    @property
+    def missing_rules(self) -> bool:
+        with self._lock:
+            return bool(self._incomplete_images)
+
+    @property
+    def incomplete_images(self) -> list[str]:
+        with self._lock:
+            return sorted(self._incomplete_images)
+
+    @property
+    def unprocessable_image_messages(self) -> list[str]:
+        with self._lock:
+            return list(self._unprocessable_image_messages.values())
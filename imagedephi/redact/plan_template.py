@@ -0,0 +1,66 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+from collections.abc import Hashable
+from dataclasses import dataclass, field
+import threading
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import tifftools
+
+    from imagedephi.rules import ConcreteMetadataRule
+
+# Each template is small, but images from many different scanners shouldn't grow the cache forever
+MAX_PLAN_TEMPLATES = 64
+
+
+@dataclass
+class PlanTemplate:
+    """The rules resolved for the tags of an image, which any image with the same tags can reuse."""
+
+    metadata_redaction_steps: dict[int, ConcreteMetadataRule]
+    no_match_tags: list[tifftools.TiffTag]
+    rule_keys: frozenset[str]
+    # Only used for Aperio (.svs) images
+    description_redaction_steps: dict[str, ConcreteMetadataRule] = field(default_factory=dict)
+    no_match_description_keys: set[str] = field(default_factory=set)
+
+
+class PlanTemplateCache:
+    """
+    Plan templates of previously planned images, keyed by the structure of their metadata.
+
+    Images from the same scanner usually have the same tags in each IFD, so the rules for those
+    tags only need to be resolved once. Checks that depend on tag values still run for every
+    image. A cache must only be used with plans built from the same rules.
+    """
+
+    def __init__(self, max_templates: int = MAX_PLAN_TEMPLATES) -> None:
+        self.max_templates = max_templates
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._templates: OrderedDict[Hashable, PlanTemplate] = OrderedDict()
+
+    def get(self, signature: Hashable) -> PlanTemplate | None:
+        with self._lock:
+            template = self._templates.get(signature)
+            if template is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._templates.move_to_end(signature)
+            return template
+
+    def add(self, signature: Hashable, template: PlanTemplate) -> None:
+        with self._lock:
+            self._templates[signature] = template
+            self._templates.move_to_end(signature)
+            if len(self._templates) > self.max_templates:
+                self._templates.popitem(last=False)
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
@@ -1,7 +1,7 @@
 from __future__ import annotations
 
-from collections import OrderedDict, namedtuple
-from collections.abc import Generator
+from collections import namedtuple
+from collections.abc import Callable, Generator
 from csv import DictWriter
 import datetime
 from enum import Enum
@@ -10,7 +10,8 @@ from io import BytesIO
 import logging
 from pathlib import Path
 from shutil import copy2
-from typing import TYPE_CHECKING, Any, Dict, NamedTuple, TypeVar
+import threading
+from typing import TYPE_CHECKING, NamedTuple, TypeVar
 
 from PIL import Image, ImageDraw, ImageFont
 import tifftools
@@ -20,7 +21,7 @@ from tqdm.contrib.logging import logging_redirect_tqdm
 import yaml
 
 from imagedephi.rules import FileFormat, Ruleset
-from imagedephi.utils.dicom import file_is_same_series_as
+from imagedephi.utils.dicom import file_is_same_series_as, get_series_uid
 from imagedephi.utils.directory import iter_image_dirs
 from imagedephi.utils.image import (
     get_file_format_from_path,
@@ -30,23 +31,24 @@ from imagedephi.utils.image import (
 )
 from imagedephi.utils.logger import logger
 from imagedephi.utils.progress_log import push_progress
-from imagedephi.utils.tiff import get_associated_image_svs, get_ifd_for_thumbnail
+from imagedephi.utils.tiff import (
+    find_associated_image_svs,
+    find_ifd_for_thumbnail,
+    read_tiff_info,
+)
 
 from .build_redaction_plan import build_redaction_plan
+from .plan_session import PlanSession
+from .plan_template import PlanTemplateCache
+from .redaction_plan import RedactionPlan, ReportDetail
 from .svs import MalformedAperioFileError
-from .tiff import UnsupportedFileTypeError
 
 if TYPE_CHECKING:
     from .redaction_plan import TagRedactionPlan
 
 MAX_ASSOCIATED_OUTPUT_SIZE = 500
 
-tags_used: OrderedDict[str, dict[str, Any]] = OrderedDict()
-redaction_plan_report: Dict[str, Dict[str, Any]] = {}
-unprocessable_image_messages: list[str] = []
-
 T = TypeVar("T")
-missing_rules = False
 
 
 class ProfileChoice(Enum):
@@ -105,14 +107,23 @@ def create_redact_dir_and_manifest(
     Create output directories and manifest file.
 
     `identifier` should be a unique string for the new directory. If no value
-    is supplied, a timestamp is used.
+    is supplied, a timestamp is used. If another run already created a directory with
+    the same timestamp, a numeric suffix is added to keep the runs apart.
     """
-    redact_dir = base_output_dir / f"Redacted_{time_stamp}"
-    associated_dir = base_output_dir / f"Associated_{time_stamp}"
-    manifest_file = base_output_dir / f"Redacted_{time_stamp}_manifest.csv"
-
+    run_name = time_stamp
+    attempt = 1
     try:
-        redact_dir.mkdir(parents=True)
+        while True:
+            redact_dir = base_output_dir / f"Redacted_{run_name}"
+            try:
+                redact_dir.mkdir(parents=True)
+            except FileExistsError:
+                attempt += 1
+                run_name = f"{time_stamp}_{attempt}"
+            else:
+                break
+        associated_dir = base_output_dir / f"Associated_{run_name}"
+        manifest_file = base_output_dir / f"Redacted_{run_name}_manifest.csv"
         if associated:
             associated_dir.mkdir()
         manifest_file.touch()
@@ -156,14 +167,15 @@ def get_associated_outputs(
     """Return encoded JPEGs from the associated images contained in `file_name`."""
     image_type = get_file_format_from_path(Path(file_name))
     if image_type == FileFormat.SVS or image_type == FileFormat.TIFF:
-        if ifd := get_associated_image_svs(Path(file_name), "label"):
+        ifds = read_tiff_info(file_name)["ifds"]
+        if ifd := find_associated_image_svs(ifds, "label"):
             try:
                 label = get_image_bytes_from_ifd(ifd, file_name, max_height, max_width)
             except Exception:
                 label = missing_image(text=["label", "missing"])
         else:
             label = missing_image(text=["label", "missing"])
-        ifd = get_ifd_for_thumbnail(Path(file_name), int(max_width), int(max_height))
+        ifd = find_ifd_for_thumbnail(ifds, int(max_width), int(max_height))
         if not ifd:
             try:
                 thumbnail = get_image_bytes_from_tiff(file_name, max_width, max_height)
@@ -174,7 +186,7 @@ def get_associated_outputs(
                 thumbnail = get_image_bytes_from_ifd(ifd, file_name, max_width, max_height)
             except Exception:
                 thumbnail = missing_image(text=["thumbnail", "missing"])
-        if ifd := get_associated_image_svs(Path(file_name), "macro"):
+        if ifd := find_associated_image_svs(ifds, "macro"):
             try:
                 macro = get_image_bytes_from_ifd(ifd, file_name, max_height, max_width)
             except Exception:
@@ -190,17 +202,30 @@ def get_associated_outputs(
             if child != path and file_is_same_series_as(path, child)
         ]
         try:
-            label = get_image_bytes_from_dicom(related_files, "label", max_width, max_height)
+            label = get_image_bytes_from_dicom(
+                related_files, "label", max_width, max_height
+            ) or missing_image(text=["label", "missing"])
         except Exception:
             label = missing_image(text=["label", "missing"])
         try:
-            overview = get_image_bytes_from_dicom(related_files, "overview", max_width, max_height)
+            overview = get_image_bytes_from_dicom(
+                related_files, "overview", max_width, max_height
+            ) or missing_image(text=["overview", "missing"])
         except Exception:
             overview = missing_image(text=["overview", "missing"])
         return dict(label=label, thumbnail=overview)
     return dict()
 
 
+def log_plan_template_usage(plan_templates: PlanTemplateCache) -> None:
+    lookups = plan_templates.hits + plan_templates.misses
+    if lookups:
+        logger.info(
+            f"Reused resolved rules for {plan_templates.hits} of {lookups} TIFF images "
+            f"({plan_templates.hit_rate:.0%})."
+        )
+
+
 def redact_images(
     input_paths: list[Path],
     output_dir: Path,
@@ -211,8 +236,20 @@ def redact_images(
     recursive: bool = False,
     export_associated: bool = False,
     index: int = 1,
-) -> None:
+    progress_callback: Callable[[int, int, Path], None] = push_progress,
+    cancel_event: threading.Event | None = None,
+    plans: dict[Path, RedactionPlan] | None = None,
+) -> Path:
+    """
+    Redact images found in `input_paths`, writing the results to a new directory in `output_dir`.
 
+    Progress is reported through `progress_callback`. If `cancel_event` is set while images are
+    being redacted, no further images are processed, and the manifests only list images that were
+    already handled. Return the directory containing the redacted images.
+
+    `plans` may hold unexecuted plans that were already made for some images with the same rules,
+    which are used instead of planning those images again, unless the image changed since.
+    """
     time_stamp = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
 
     # Keep track of information about this run to write to a persistent log file (csv?)
@@ -243,20 +280,29 @@ def redact_images(
     redact_dir, associated_dir, manifest_file = create_redact_dir_and_manifest(
         output_dir, export_associated, time_stamp
     )
-    failed_dir = output_dir / f"Failed_{time_stamp}"
-    failed_manifest_file = (
-        output_dir / f"Failed_{time_stamp}" / f"Failed_{time_stamp}_manifest.yaml"
-    )
+    run_name = redact_dir.name.removeprefix("Redacted_")
+    failed_dir = output_dir / f"Failed_{run_name}"
+    failed_manifest_file = output_dir / f"Failed_{run_name}" / f"Failed_{run_name}_manifest.yaml"
 
     dcm_uid_map: dict[str, str] = {}
+    plan_templates = PlanTemplateCache()
 
     with logging_redirect_tqdm(loggers=[logger]):
         for image_file in tqdm(images_to_redact, desc="Redacting images", position=0, leave=True):
-            push_progress(output_file_counter, output_file_max, redact_dir)
+            if cancel_event is not None and cancel_event.is_set():
+                logger.info("Redaction cancelled")
+                break
+            progress_callback(output_file_counter, output_file_max, redact_dir)
             try:
-                redaction_plan = build_redaction_plan(
-                    image_file, base_rules, override_ruleset, dcm_uid_map=dcm_uid_map
-                )
+                redaction_plan = plans.pop(image_file, None) if plans else None
+                if redaction_plan is None or redaction_plan.is_outdated():
+                    redaction_plan = build_redaction_plan(
+                        image_file,
+                        base_rules,
+                        override_ruleset,
+                        dcm_uid_map=dcm_uid_map,
+                        plan_templates=plan_templates,
+                    )
             # Handle and report other errors without stopping the process
             except Exception as e:
                 logger.error(
@@ -308,9 +354,9 @@ def redact_images(
                     copy2(image_file, failed_img)
                 img_dict = {
                     image_file.name: {
-                        "missing_tags": redaction_plan.report_plan()[image_file.name].get(
-                            "missing_tags", []
-                        )
+                        "missing_tags": redaction_plan.report_plan(ReportDetail.Decisions)[
+                            image_file.name
+                        ].get("missing_tags", [])
                     }
                 }
                 failed_images["failed_images"].append(img_dict)
@@ -363,33 +409,34 @@ def redact_images(
                     associated_parent_dir.mkdir(parents=True, exist_ok=True)
                     associated_path = associated_parent_dir / f"{output_path.name}.{image}.jpg"
                     associated_path.write_bytes(jpeg.getbuffer())
-                if output_file_counter == output_file_max:
-                    logger.info("Redactions completed")
-                    if failed_img_counter:
-                        # Ensure that the logged index is the correct starting point
-                        with open(failed_manifest_file, "a") as manifest:
-                            yaml.dump(
-                                failed_images,
-                                manifest,
-                                explicit_start=True,
-                                default_flow_style=False,
-                            )
-                            manifest.write("failed_images_count: " + str(failed_img_counter) + "\n")
-                            index += 1
-
-                            yaml_command = f"""command: imagedephi run {failed_dir} --output-dir {redact_dir.parent} --index {index}"""  # noqa
-                            options = [
-                                f" --override-rules {override_rules}" if override_rules else "",
-                                " --overwrite" if overwrite else "",
-                                f" --profile {profile}" if profile != "default" else "",
-                                " --recursive" if recursive else "",
-                                " --skip-rename" if not rename else "",
-                            ]
-                            yaml_command += " ".join(filter(None, options))
-                            command = yaml.safe_load(yaml_command)
-                            yaml.dump(command, manifest, width=float("inf"))
                 index += 1
             output_file_counter += 1
+        else:
+            logger.info("Redactions completed")
+    if failed_img_counter:
+        # Write the failed manifest however the run ended, so the failed images can be re-run.
+        # `index` is the next index after the images that were redacted.
+        with open(failed_manifest_file, "a") as manifest:
+            yaml.dump(
+                failed_images,
+                manifest,
+                explicit_start=True,
+                default_flow_style=False,
+            )
+            manifest.write("failed_images_count: " + str(failed_img_counter) + "\n")
+
+            yaml_command = f"""command: imagedephi run {failed_dir} --output-dir {redact_dir.parent} --index {index}"""  # noqa
+            options = [
+                f" --override-rules {override_rules}" if override_rules else "",
+                " --overwrite" if overwrite else "",
+                f" --profile {profile}" if profile not in ("", "default") else "",
+                " --recursive" if recursive else "",
+                " --skip-rename" if not rename else "",
+            ]
+            yaml_command += " ".join(filter(None, options))
+            command = yaml.safe_load(yaml_command)
+            yaml.dump(command, manifest, width=float("inf"))
+    log_plan_template_usage(plan_templates)
     logger.info(f"Writing manifest to {manifest_file}")
     with open(manifest_file, "w") as manifest:
         fieldnames = ["input_path", "output_path", "detail"]
@@ -397,55 +444,43 @@ def redact_images(
         writer.writeheader()
         for row in run_summary:
             writer.writerow(row)
+    return redact_dir
 
 
-def _custom_sort(item):
-    key, value = item
-    if key == "missing_tags":
-        return (0, key)
-    elif isinstance(value, dict) and value["action"] == "delete":
-        return (1, key)
-    else:
-        return (2, key)
-
-
-def _sort_data(data):
+def index_images(input_paths: list[Path], recursive: bool = False) -> int:
     """
-    Sort images based on the presence of missing tags and then by image name.
+    Read the metadata of images found in `input_paths` through the metadata index in use.
 
-    Sort tags within each image based on the action and tag name.
+    Images that can't be read are logged and skipped. Return the number of images indexed.
     """
-    sorted_data = {}
-    # List of tags that can't be edited and should be excluded from the redaction plan
-    excluded_tags = [
-        "BigTIFF",
-        "FreeByteCounts",
-        "FreeOffsets",
-        "JPEGIFByteCount",
-        "JPEGIFOffset",
-        "JPEGTables",
-        "NewSubfileType",
-        "Photometric",
-        "PlanarConfig",
-        "Predictor",
-        "StripByteCounts",
-        "StripOffsets",
-        "TileByteCounts",
-        "TileOffsets",
-    ]
-
-    for image_name, tags in data.items():
-        # Remove excluded tags
-        for tag in excluded_tags:
-            tags.pop(tag, None)
-        # Sort tags within each image
-        sorted_tags = OrderedDict(sorted(tags.items(), key=_custom_sort))
-        tags_used.update(sorted_tags)
-        sorted_data[image_name] = sorted_tags
-    sorted_data = OrderedDict(
-        sorted(sorted_data.items(), key=lambda x: (0 if "missing_tags" in x[1] else 1, x[0]))
-    )
-    return sorted_data
+    with logging_redirect_tqdm(loggers=[logger]):
+        image_paths = generator_to_list_with_progress(
+            iter_image_dirs(input_paths, recursive),
+            progress_bar_desc="Collecting files to index...",
+        )
+        image_count = 0
+        for image_path in tqdm(image_paths, desc="Indexing images", position=0, leave=True):
+            try:
+                if get_file_format_from_path(image_path) == FileFormat.DICOM:
+                    get_series_uid(image_path)
+                else:
+                    read_tiff_info(image_path)
+            except Exception as e:
+                logger.error(
+                    f"{image_path.name} could not be indexed. {e.args[0] if len(e.args) else e}"
+                )
+                continue
+            image_count += 1
+    return image_count
+
+
+def get_unprocessable_image_message(image_path: Path, error: Exception) -> str:
+    """Describe why a redaction plan could not be built for an image."""
+    if isinstance(error, tifftools.TifftoolsError):
+        return f"Could not open {image_path} as a tiff."
+    if isinstance(error, MalformedAperioFileError):
+        return f"{image_path} could not be processed as a valid Aperio file."
+    return f"{image_path} could not be processed. {error.args[0] if len(error.args) else error}"
 
 
 def show_redaction_plan(
@@ -457,7 +492,17 @@ def show_redaction_plan(
     limit: int | None = None,
     offset: int | None = None,
     update: bool = True,
+    session: PlanSession | None = None,
+    detail: ReportDetail = ReportDetail.Full,
 ) -> NamedTuple:
+    """
+    Build and log the redaction plan for each image found in `input_paths`.
+
+    Reports are collected in `session`, or a new session if none is given. Unless `update` is set,
+    any reports already in the session are discarded first. Returns one page of the sorted
+    reports if `limit` and `offset` are given, or all of them otherwise. `detail` sets how much
+    of each tag value is reported.
+    """
     base_rules = get_base_rules(profile)
     override_ruleset = None
     if override_rules:
@@ -472,69 +517,40 @@ def show_redaction_plan(
         # For a single image, log all details of the plan
         logger.setLevel(logging.DEBUG)
 
-    global tags_used
-    global missing_rules
-    missing_rules = False
-
-    def _create_redaction_plan_report():
-        global missing_rules
-        global unprocessable_image_messages
-        unprocessable_image_messages = []
-        with logging_redirect_tqdm(loggers=[logger]):
-            for image_path in tqdm(image_paths, desc="Reporting plan", position=0, leave=True):
-                try:
-                    redaction_plan = build_redaction_plan(image_path, base_rules, override_ruleset)
-                except tifftools.TifftoolsError:
-                    unprocessable_image_messages.append(f"Could not open {image_path} as a tiff.")
-                    continue
-                except MalformedAperioFileError:
-                    unprocessable_image_messages.append(
-                        f"{image_path} could not be processed as a valid Aperio file."
-                    )
-                    continue
-                except UnsupportedFileTypeError as e:
-                    unprocessable_image_messages.append(
-                        f"{image_path} could not be processed. {e.args[0]}"
-                    )
-                    continue
-                # Handle and report other errors without stopping the process
-                except Exception as e:
-                    unprocessable_image_messages.append(
-                        f"{image_path} could not be processed. {e.args[0]}"
-                    )
-                    continue
-                logger.info(f"Redaction plan for {image_path.name}:")
-                redaction_plan_report.update(redaction_plan.report_plan())  # type: ignore
-                if not redaction_plan.is_comprehensive():
-                    missing_rules = True
-                    if require_all:
-                        break
-
-    if not update:
-        global redaction_plan_report
-        redaction_plan_report = {}
-        global tags_used
-        tags_used = OrderedDict()
-        _create_redaction_plan_report()
-    else:
-
-        _create_redaction_plan_report()
+    if session is None:
+        session = PlanSession()
+    elif not update:
+        session.clear()
+    plan_templates = PlanTemplateCache()
 
-    total = len(redaction_plan_report)  # type: ignore
-    sorted_dict = _sort_data(redaction_plan_report)  # type: ignore
-    if limit is not None and offset is not None:
-        sorted_dict = OrderedDict(list(sorted_dict.items())[offset * limit : (offset + 1) * limit])
+    with logging_redirect_tqdm(loggers=[logger]):
+        for image_path in tqdm(image_paths, desc="Reporting plan", position=0, leave=True):
+            try:
+                redaction_plan = build_redaction_plan(
+                    image_path, base_rules, override_ruleset, plan_templates=plan_templates
+                )
+            # Handle and report errors without stopping the process
+            except Exception as e:
+                session.add_unprocessable_image(
+                    image_path, get_unprocessable_image_message(image_path, e)
+                )
+                continue
+            logger.info(f"Redaction plan for {image_path.name}:")
+            comprehensive = redaction_plan.is_comprehensive()
+            for image_name, tags in redaction_plan.report_plan(detail).items():  # type: ignore
+                session.add_report(image_name, tags, comprehensive)
+            if not comprehensive and require_all:
+                break
+
+    log_plan_template_usage(plan_templates)
+    unprocessable_image_messages = session.unprocessable_image_messages
     images_plan = namedtuple("images_plan", ["data", "total", "tags", "missing_rules"])
 
     for input_path in input_paths:
         if input_path.is_dir():
             # Provide a summary if the input path is a directory of images
             logger.info(f"ImageDePHI summary for {input_path}:")
-            incomplete = [
-                file_path
-                for file_path in redaction_plan_report
-                if not redaction_plan_report[file_path]["comprehensive"]
-            ]
+            incomplete = session.incomplete_images
             logger.info(
                 f"{len(image_paths) - (len(incomplete) + len(unprocessable_image_messages))}"
                 " images able to be redacted with the provided rule set."
@@ -561,7 +577,15 @@ def show_redaction_plan(
     # Report exceptions outside of the directory level report
     for message in unprocessable_image_messages:
         logger.info(f"\t{message}")
+    evicted = session.evicted_images
+    if evicted:
+        logger.info(
+            f"Reports for {len(evicted)} image(s) were not retained, and aren't included in "
+            "the returned plan."
+        )
 
     # Reset logging level if it was changed
     logger.setLevel(starting_logging_level)
-    return images_plan(sorted_dict, total, list(tags_used), missing_rules)
+    return images_plan(
+        session.get_page(limit, offset), session.total, session.tags_used, session.missing_rules
+    )
@@ -1,8 +1,11 @@
 from __future__ import annotations
 
 import abc
+import binascii
+from enum import Enum
+import hashlib
 from pathlib import Path
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Any
 
 from imagedephi.rules import FileFormat
 
@@ -15,12 +18,103 @@ if TYPE_CHECKING:
 
     RedactionPlanReport = dict[str, dict[str, int | str | list[str] | TagRedactionPlan]]
 
+# List of tags that can't be edited and should be excluded from the redaction plan
+EXCLUDED_REPORT_TAGS = {
+    "BigTIFF",
+    "FreeByteCounts",
+    "FreeOffsets",
+    "JPEGIFByteCount",
+    "JPEGIFOffset",
+    "JPEGTables",
+    "NewSubfileType",
+    "Photometric",
+    "PlanarConfig",
+    "Predictor",
+    "StripByteCounts",
+    "StripOffsets",
+    "TileByteCounts",
+    "TileOffsets",
+}
+
+# At the summary detail level, longer values are truncated
+MAX_REPORT_STRING_LENGTH = 256
+MAX_REPORT_LIST_LENGTH = 16
+MAX_REPORT_BINARY_BYTES = 32
+
+
+class PlanOutdatedError(Exception):
+    """Thrown when an image changes between planning its redaction and executing the plan."""
+
+
+def file_signature(image_path: Path) -> tuple[int, int]:
+    stat = image_path.stat()
+    return stat.st_mtime_ns, stat.st_size
+
+
+class ReportDetail(Enum):
+    """How much of each tag value to include in a redaction plan report."""
+
+    # Only the action taken for each tag
+    Decisions = "decisions"
+    # Values, with large values truncated, and binary values identified by length and digest
+    Summary = "summary"
+    # Complete values
+    Full = "full"
+
+
+def report_tag_entry(
+    action: str, value: Any, detail: ReportDetail, binary: bool = False
+) -> TagRedactionPlan:
+    """Build the report entry for a tag, including as much of its value as `detail` allows."""
+    if detail == ReportDetail.Decisions:
+        return {"action": action}
+    if binary:
+        if detail == ReportDetail.Full:
+            return {
+                "action": action,
+                "binary": {"value": f"0x{binascii.hexlify(value).decode()}", "bytes": len(value)},
+            }
+        return {
+            "action": action,
+            "binary": {
+                "value": f"0x{binascii.hexlify(value[:MAX_REPORT_BINARY_BYTES]).decode()}",
+                "bytes": len(value),
+                "sha256": hashlib.sha256(value).hexdigest(),
+            },
+        }
+    if detail == ReportDetail.Summary:
+        if isinstance(value, str) and len(value) > MAX_REPORT_STRING_LENGTH:
+            return {
+                "action": action,
+                "value": value[:MAX_REPORT_STRING_LENGTH],
+                "length": len(value),
+            }
+        if isinstance(value, list) and len(value) > MAX_REPORT_LIST_LENGTH:
+            return {"action": action, "value": value[:MAX_REPORT_LIST_LENGTH], "count": len(value)}
+    return {"action": action, "value": value}
+
+
+def rule_key(file_format: FileFormat, section: str, key: str | None = None) -> str:
+    """
+    Identify a rule that a plan looked up, or a whole section of rules.
+
+    Sections are the rule dictionaries of each format, such as "metadata".
+    """
+    return (
+        f"{file_format.value}.{section}" if key is None else f"{file_format.value}.{section}.{key}"
+    )
+
 
 class RedactionPlan:
     file_format: FileFormat
+    image_path: Path
+    _file_signature: tuple[int, int]
+    # Every rule looked up to make the plan, identified by `rule_key`. The plan is the same for any
+    # rules that only differ in other rules.
+    rule_keys: set[str]
 
     @abc.abstractmethod
-    def report_plan(self) -> RedactionPlanReport: ...
+    def report_plan(self, detail: ReportDetail = ReportDetail.Full) -> RedactionPlanReport: ...
 
     @abc.abstractmethod
     def execute_plan(self) -> None: ...
@@ -35,3 +129,18 @@ class RedactionPlan:
 
     @abc.abstractmethod
     def save(self, output_path: Path, overwrite: bool) -> None: ...
+
+    def release(self) -> None:
+        """
+        Drop the parsed file, keeping only the decisions needed to execute the plan.
+
+        The file is read again when it is next needed, and `PlanOutdatedError` is raised if it
+        changed since the plan was made. Plans that were already executed keep their changes.
+        """
+
+    def is_outdated(self) -> bool:
+        """Return whether the image changed since the plan was made."""
+        try:
+            return file_signature(self.image_path) != self._file_signature
+        except OSError:
+            return True
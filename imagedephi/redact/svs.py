@@ -1,6 +1,7 @@
 from __future__ import annotations
 
-import binascii
+from collections.abc import Hashable
+import copy
 from pathlib import Path
 from typing import TYPE_CHECKING
 
@@ -13,9 +14,13 @@ from imagedephi.rules import (
     MetadataReplaceRule,
     RedactionOperation,
     SvsRules,
+    TiffRules,
 )
 from imagedephi.utils.logger import logger
+from imagedephi.utils.tiff import IfdTraversal
 
+from .plan_template import PlanTemplate, PlanTemplateCache
+from .redaction_plan import EXCLUDED_REPORT_TAGS, ReportDetail, report_tag_entry, rule_key
 from .tiff import TiffRedactionPlan
 
 if TYPE_CHECKING:
@@ -23,6 +28,9 @@ if TYPE_CHECKING:
 
     from .redaction_plan import RedactionPlanReport
 
+# First characters of the values which int or float may accept, besides digits
+NUMERIC_VALUE_PREFIXES = set("+-.nNiI")
+
 
 class SvsDescription:
     prefix: str
@@ -30,15 +38,19 @@ class SvsDescription:
 
     def try_get_numeric_value(self, value: str) -> str | int | float:
         """Given an ImageDescription value, return a number version of it if applicable."""
-        try:
-            int(value)
-            return int(value)
-        except ValueError:
+        # Only values starting like a number, "nan" or "inf" can be converted, so most text
+        # values skip the exceptions of failed conversions
+        if not value[:1].isdigit() and value[:1] not in NUMERIC_VALUE_PREFIXES:
+            return value
+        if "." not in value:
             try:
-                float(value)
-                return float(value)
+                return int(value)
             except ValueError:
-                return value
+                pass
+        try:
+            return float(value)
+        except ValueError:
+            return value
 
     def __init__(self, svs_description_string: str):
         description_components = svs_description_string.split("|")
@@ -46,15 +58,19 @@ class SvsDescription:
 
         self.metadata = {}
         for metadata_component in description_components[1:]:
-            key, value = [token.strip() for token in metadata_component.split("=")]
-            self.metadata[key] = self.try_get_numeric_value(value)
+            key, value = metadata_component.split("=")
+            self.metadata[key.strip()] = self.try_get_numeric_value(value.strip())
 
     def __str__(self) -> str:
-        components = [self.prefix]
-        components = components + [
-            " = ".join([key, str(self.metadata[key])]) for key in self.metadata.keys()
-        ]
-        return "|".join(components)
+        return "|".join(
+            [self.prefix, *(f"{key} = {value}" for key, value in self.metadata.items())]
+        )
+
+    def copy(self) -> SvsDescription:
+        """Return a copy of this description, which can be redacted separately."""
+        svs_description = copy.copy(self)
+        svs_description.metadata = dict(self.metadata)
+        return svs_description
 
 
 class MalformedAperioFileError(Exception):
@@ -63,6 +79,14 @@ class MalformedAperioFileError(Exception):
     ...
 
 
+def get_description_key_rule(key: str, rules: SvsRules) -> ConcreteMetadataRule | None:
+    """Return the rule for a key of Aperio ImageDescription metadata, or `None` if none applies."""
+    key_rule = rules.image_description.get(key, None)
+    if key_rule and key_rule.action in ["keep", "delete", "replace", "check_type", "modify_date"]:
+        return key_rule if key_rule.key_name == key else None
+    return None
+
+
 class SvsRedactionPlan(TiffRedactionPlan):
     """
     Represents a plan of action for redacting files in Aperio (.svs) format.
@@ -82,35 +106,82 @@ class SvsRedactionPlan(TiffRedactionPlan):
         image_path: Path,
         rules: SvsRules,
         strict: bool = False,
+        plan_templates: PlanTemplateCache | None = None,
     ) -> None:
         self.rules = rules
         self.image_redaction_steps = {}
         self.description_redaction_steps = {}
         self.no_match_description_keys = set()
-        super().__init__(image_path, rules, strict)
+        # Parsed descriptions, keyed by their ImageDescription strings
+        self._svs_descriptions: dict[str, SvsDescription] = {}
+        super().__init__(image_path, rules, strict, plan_templates)
+
+    def _resolve_metadata_rules(self, rules: TiffRules) -> None:
+        super()._resolve_metadata_rules(rules)
 
         # For strict mode redactions, treat Aperio (.svs) images as if they were
         # plain tiffs. Skip special handling of image description metadata.
-        if not strict:
+        if not self.strict:
             image_description_tag = tifftools.constants.Tag["ImageDescription"]
             if image_description_tag.value not in self.metadata_redaction_steps:
                 raise MalformedAperioFileError()
             del self.metadata_redaction_steps[image_description_tag.value]
 
-            ifds = self.tiff_info["ifds"]
-            for tag, ifd in self._iter_tiff_tag_entries(ifds):
+            for tag, ifd in self.traversal.tag_entries:
                 if tag.value != image_description_tag.value:
                     continue
 
-                svs_description = SvsDescription(str(ifd["tags"][tag.value]["data"]))
-
-                for key in svs_description.metadata.keys():
-                    key_rule = rules.image_description.get(key, None)
-                    if key_rule and self.is_match(key_rule, key):
+                for key in self.get_svs_description(ifd).metadata:
+                    self.rule_keys.add(rule_key(self.file_format, "image_description", key))
+                    # Pyramid levels share most keys, which only need to be resolved once
+                    if (
+                        key in self.description_redaction_steps
+                        or key in self.no_match_description_keys
+                    ):
+                        continue
+                    key_rule = get_description_key_rule(key, self.rules)
+                    if key_rule:
                         self.description_redaction_steps[key] = key_rule
                     else:
                         self.no_match_description_keys.add(key)
 
+    def _template_signature(self) -> Hashable:
+        signature = super()._template_signature()
+        if self.strict:
+            return signature
+        image_description_tag = tifftools.constants.Tag["ImageDescription"]
+        description_keys = tuple(
+            tuple(self.get_svs_description(ifd).metadata)
+            for tag, ifd in self.traversal.tag_entries
+            if tag.value == image_description_tag.value
+        )
+        return signature, description_keys
+
+    def _to_template(self) -> PlanTemplate:
+        template = super()._to_template()
+        template.description_redaction_steps = dict(self.description_redaction_steps)
+        template.no_match_description_keys = set(self.no_match_description_keys)
+        return template
+
+    def _apply_template(self, template: PlanTemplate) -> None:
+        super()._apply_template(template)
+        self.description_redaction_steps = dict(template.description_redaction_steps)
+        self.no_match_description_keys = set(template.no_match_description_keys)
+
+    def get_svs_description(self, ifd: IFD) -> SvsDescription:
+        """Return the parsed Aperio ImageDescription of an IFD, parsing each string only once."""
+        description = str(ifd["tags"][tifftools.constants.Tag["ImageDescription"].value]["data"])
+        svs_description = self._svs_descriptions.get(description)
+        if svs_description is None:
+            svs_description = SvsDescription(description)
+            self._svs_descriptions[description] = svs_description
+        return svs_description
+
+    def release(self) -> None:
+        if not self._executed:
+            self._svs_descriptions.clear()
+        super().release()
+
     def get_associated_image_key_for_ifd(self, ifd: IFD) -> str:
         """
         Given a associated image IFD, return its semantic type.
@@ -212,48 +283,41 @@ class SvsRedactionPlan(TiffRedactionPlan):
                     if report is not None:
                         report[self.image_path.name]["missing_description_keys"].append(key)
 
-    def report_plan(
-        self,
-    ) -> RedactionPlanReport:
+    def report_plan(self, detail: ReportDetail = ReportDetail.Full) -> RedactionPlanReport:
         logger.debug("Aperio (.svs) Metadata Redaction Plan\n")
         offset = -1
         ifd_count = 0
         report: RedactionPlanReport = {}
         report[self.image_path.name] = {}
-        for tag, ifd in self._iter_tiff_tag_entries(self.tiff_info["ifds"]):
+        for tag, ifd in self.traversal.tag_entries:
             if ifd["offset"] != offset:
                 offset = ifd["offset"]
                 ifd_count += 1
                 logger.debug(f"IFD {ifd_count}:")
             if tag.value == tifftools.constants.Tag["ImageDescription"] and not self.strict:
-                image_description = SvsDescription(str(ifd["tags"][tag.value]["data"]))
+                image_description = self.get_svs_description(ifd)
                 for key_name, _data in image_description.metadata.items():
                     rule = self.description_redaction_steps[key_name]
                     operation = self.determine_redaction_operation(rule, image_description)
                     logger.debug(f"SVS Image Description - {key_name}: {operation}")
-                    report[self.image_path.name][key_name] = {"action": operation, "value": _data}
+                    report[self.image_path.name][key_name] = report_tag_entry(
+                        operation, _data, detail
+                    )
                 continue
             if tag.value not in self.no_match_tags:
                 rule = self.metadata_redaction_steps[tag.value]
+                if rule.key_name in EXCLUDED_REPORT_TAGS:
+                    # Structural tags can be very large, and aren't reported
+                    continue
                 operation = self.determine_redaction_operation(rule, ifd)
                 logger.debug(f"Tiff Tag {tag.value} - {rule.key_name}: {operation}")
-                if (
-                    ifd["tags"][tag.value]["datatype"]
-                    == tifftools.constants.Datatype.UNDEFINED.value
-                ):
-                    encoded_value: dict[str, str | int] = {
-                        "value": f"0x{binascii.hexlify(ifd['tags'][tag.value]['data']).decode('utf-8')}",  # type: ignore # noqa: E501
-                        "bytes": len(ifd["tags"][tag.value]["data"]),
-                    }
-                    report[self.image_path.name][rule.key_name] = {
-                        "action": operation,
-                        "binary": encoded_value,
-                    }
-                else:
-                    report[self.image_path.name][rule.key_name] = {
-                        "action": operation,
-                        "value": ifd["tags"][tag.value]["data"],
-                    }
+                entry = ifd["tags"][tag.value]
+                report[self.image_path.name][rule.key_name] = report_tag_entry(
+                    operation,
+                    entry["data"],
+                    detail,
+                    binary=entry["datatype"] == tifftools.constants.Datatype.UNDEFINED.value,
+                )
         self.report_missing_rules(report)
         logger.debug("Aperio (.svs) Associated Image Redaction Plan\n")
         # Report the number of associated images found in the image that match each associated
@@ -276,7 +340,8 @@ class SvsRedactionPlan(TiffRedactionPlan):
 
     def _redact_svs_image_description(self, ifd: IFD) -> None:
         image_description_tag = tifftools.constants.Tag["ImageDescription"]
-        image_description = SvsDescription(str(ifd["tags"][image_description_tag.value]["data"]))
+        # The cached description is kept as it was, for reports
+        image_description = self.get_svs_description(ifd).copy()
 
         # We may be modifying the dictionary as we iterate over its keys,
         # hence the need for a list
@@ -287,13 +352,13 @@ class SvsRedactionPlan(TiffRedactionPlan):
         ifd["tags"][image_description_tag.value]["data"] = str(image_description)
 
     def execute_plan(self) -> None:
-        ifds = self.tiff_info["ifds"]
-        new_ifds = self._redact_associated_images(ifds)
+        self._executed = True
+        self._redact_associated_images()
+        self._traversal = IfdTraversal(self.tiff_info["ifds"])
         image_description_tag = tifftools.constants.Tag["ImageDescription"]
-        for tag, ifd in self._iter_tiff_tag_entries(new_ifds):
+        for tag, ifd in self._traversal.tag_entries:
             rule = self.metadata_redaction_steps.get(tag.value)
             if rule is not None:
                 self.apply(rule, ifd)
             elif tag.value == image_description_tag.value and not self.strict:
                 self._redact_svs_image_description(ifd)
-        self.tiff_info["ifds"] = new_ifds
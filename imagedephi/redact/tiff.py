@@ -1,14 +1,15 @@
 from __future__ import annotations
 
-import binascii
-from collections.abc import Generator
+from array import array
+from collections import OrderedDict
+from collections.abc import Hashable
 from io import BytesIO
 from pathlib import Path
 import re
+import threading
 from typing import TYPE_CHECKING, Any
 
-from PIL import Image, TiffTags
-from PIL.TiffImagePlugin import ImageFileDirectory_v2
+from PIL import Image
 import tifftools
 import tifftools.constants
 
@@ -24,9 +25,18 @@ from imagedephi.rules import (
     TiffRules,
 )
 from imagedephi.utils.logger import logger
-from imagedephi.utils.tiff import get_tiff_tag
-
-from .redaction_plan import RedactionPlan
+from imagedephi.utils.tiff import IfdRole, IfdTraversal, get_tiff_tag, read_tiff_info
+
+from .plan_template import PlanTemplate, PlanTemplateCache
+from .redaction_plan import (
+    EXCLUDED_REPORT_TAGS,
+    PlanOutdatedError,
+    RedactionPlan,
+    ReportDetail,
+    file_signature,
+    report_tag_entry,
+    rule_key,
+)
 
 if TYPE_CHECKING:
     from tifftools.tifftools import IFD, TiffInfo
@@ -34,10 +44,121 @@ if TYPE_CHECKING:
     from .redaction_plan import RedactionPlanReport
 
 
+# Target size of the uncompressed strips of blank replacement images, as PIL uses by default
+BLANK_IMAGE_STRIP_SIZE = 64 * 1024
+# Each cached blank image is only a few strips, but sizes from many scanners shouldn't pile up
+MAX_CACHED_BLANK_IMAGES = 32
+
+_blank_images: OrderedDict[tuple[int, int], tuple[bytes, IFD]] = OrderedDict()
+_blank_images_lock = threading.Lock()
+
+
+def _encode_blank_image(width: int, length: int) -> tuple[bytes, IFD]:
+    """
+    Encode a blank, JPEG compressed RGB image, without allocating the full image.
+
+    Every strip of a blank image encodes to the same bytes, except a shorter last strip. Only one
+    full strip and the last strip are encoded, and the IFD repeats the full strip for the rest.
+    """
+    # Choose strips as PIL does for a full image; JPEG compressed strips are a multiple of 8 rows
+    rows_per_strip = min(max(-(-(BLANK_IMAGE_STRIP_SIZE // (width * 3)) // 8) * 8, 8), length)
+    strip_count = -(-length // rows_per_strip)
+    last_strip_rows = length - rows_per_strip * (strip_count - 1)
+    sample_length = rows_per_strip + last_strip_rows if strip_count > 1 else length
+
+    stream = BytesIO()
+    Image.new("RGB", (width, sample_length)).save(
+        stream,
+        "TIFF",
+        compression="jpeg",
+        tiffinfo={tifftools.constants.Tag["RowsPerStrip"].value: rows_per_strip},
+    )
+    ifd = tifftools.read_tiff(stream)["ifds"][0]
+
+    tags = ifd["tags"]
+    height_entry = tags[tifftools.constants.Tag["ImageHeight"].value]
+    if length > 0xFFFF:
+        # The full height doesn't fit in the SHORT that PIL wrote for the sample
+        height_entry["datatype"] = tifftools.constants.Datatype.LONG.value
+    height_entry["data"] = [length]
+    for tag in (
+        tifftools.constants.Tag["StripOffsets"],
+        tifftools.constants.Tag["StripByteCounts"],
+    ):
+        strips: list[int | float] = [int(value) for value in tags[tag.value]["data"]]
+        tags[tag.value]["data"] = [strips[0]] * (strip_count - 1) + [strips[-1]]
+    return stream.getvalue(), ifd
+
+
+def get_blank_image_ifd(width: int, length: int) -> IFD:
+    """
+    Return a new IFD with a blank RGB image of the given size.
+
+    Blank images are cached by size, so replacing associated images of the same size in many files
+    only encodes them once. Each returned IFD has its own entries and data stream, and can be
+    modified by the caller.
+    """
+    key = (width, length)
+    with _blank_images_lock:
+        cached = _blank_images.get(key)
+        if cached is not None:
+            _blank_images.move_to_end(key)
+    if cached is None:
+        cached = _encode_blank_image(width, length)
+        with _blank_images_lock:
+            _blank_images[key] = cached
+            if len(_blank_images) > MAX_CACHED_BLANK_IMAGES:
+                _blank_images.popitem(last=False)
+
+    data, ifd = cached
+    new_ifd = ifd.copy()
+    new_ifd["tags"] = {tag_value: entry.copy() for tag_value, entry in ifd["tags"].items()}
+    new_ifd["path_or_fobj"] = BytesIO(data)
+    return new_ifd
+
+
 class UnsupportedFileTypeError(Exception):
     """Thrown when a file can be opened by tifftools but not redacted."""
 
 
+def check_tag_supported(tag: tifftools.TiffTag) -> None:
+    """Raise an `UnsupportedFileTypeError` if a tag marks a file that can't be redacted."""
+    if tag.value == tifftools.constants.Tag["ImageJMetadata"].value:
+        raise UnsupportedFileTypeError("Redaction for ImageJ files is not supported")
+    if tag.value == tifftools.constants.Tag["NDPI_FORMAT_FLAG"].value:
+        raise UnsupportedFileTypeError("Redaction for NDPI files is not supported")
+
+
+def tag_rule_matches(rule: ConcreteMetadataRule, tag: tifftools.TiffTag) -> bool:
+    if rule.action in ["keep", "delete", "replace", "check_type", "modify_date"]:
+        rule_tag = get_tiff_tag(rule.key_name)
+        return rule_tag.value == tag.value
+    return False
+
+
+def get_tag_rule(
+    tag: tifftools.TiffTag, rules: TiffRules, strict: bool = False
+) -> ConcreteMetadataRule | None:
+    """
+    Return the rule for a tag, looked up by its name and then its alternate names.
+
+    In strict mode, a tag without a rule for its name gets a rule for the fallback action instead.
+    Return `None` if no rule applies.
+    """
+    for name in [tag.name] + list(tag.get("altnames", set())):
+        tag_rule = rules.metadata.get(name, None)
+        if tag_rule and tag_rule_matches(tag_rule, tag):
+            return tag_rule
+        elif strict:
+            # If there's no rule defined for this tag and we're in
+            # strict mode, use the fallback action to create a rule on
+            # the fly.
+            if rules.metadata_fallback_action == "keep":
+                return KeepRule(key_name=tag.name, action=rules.metadata_fallback_action)
+            return DeleteRule(key_name=tag.name, action="delete")
+    return None
+
+
 class TiffRedactionPlan(RedactionPlan):
     """
     Represents a plan of action for redacting metadata from TIFF images.
@@ -48,7 +169,6 @@ class TiffRedactionPlan(RedactionPlan):
 
     file_format = FileFormat.TIFF
     image_path: Path
-    tiff_info: TiffInfo
     metadata_redaction_steps: dict[int, ConcreteMetadataRule]
     image_redaction_steps: dict[int, ConcreteImageRule]
     no_match_tags: list[tifftools.TiffTag]
@@ -60,47 +180,6 @@ class TiffRedactionPlan(RedactionPlan):
         """Determine if an IFD represents a tiled image."""
         return tifftools.Tag.TileWidth.value in ifd["tags"]
 
-    @staticmethod
-    def _iter_ifds(
-        ifds: list[IFD],
-        tag_set=tifftools.constants.Tag,
-    ) -> Generator[IFD, None, None]:
-        for ifd in ifds:
-            for tag_id, entry in ifd["tags"].items():
-                tag: tifftools.TiffTag = tifftools.constants.get_or_create_tag(
-                    tag_id,
-                    tagSet=tag_set,
-                    datatype=tifftools.Datatype[entry["datatype"]],
-                )
-                if tag.isIFD():
-                    # entry['ifds'] contains a list of lists
-                    # see tifftools.read_tiff
-                    for sub_ifds in entry.get("ifds", []):
-                        yield from TiffRedactionPlan._iter_ifds(sub_ifds, tag.get("tagset"))
-            yield ifd
-
-    @staticmethod
-    def _iter_tiff_tag_entries(
-        ifds: list[IFD],
-        tag_set=tifftools.constants.Tag,
-    ) -> Generator[tuple[tifftools.TiffTag, IFD], None, None]:
-        for ifd in ifds:
-            for tag_id, entry in sorted(ifd["tags"].items()):
-                tag: tifftools.TiffTag = tifftools.constants.get_or_create_tag(
-                    tag_id,
-                    tagSet=tag_set,
-                    datatype=tifftools.Datatype[entry["datatype"]],
-                )
-                if not tag.isIFD():
-                    yield tag, ifd
-                else:
-                    # entry['ifds'] contains a list of lists
-                    # see tifftools.read_tiff
-                    for sub_ifds in entry.get("ifds", []):
-                        yield from TiffRedactionPlan._iter_tiff_tag_entries(
-                            sub_ifds, tag.get("tagset")
-                        )
-
     def get_associated_image_key_for_ifd(self, ifd: IFD) -> str:
         """
         Given a associated image IFD, return its semantic type.
@@ -109,57 +188,97 @@ class TiffRedactionPlan(RedactionPlan):
         """
         return "default"
 
-    def __init__(self, image_path: Path, rules: TiffRules, strict: bool = False) -> None:
+    def __init__(
+        self,
+        image_path: Path,
+        rules: TiffRules,
+        strict: bool = False,
+        plan_templates: PlanTemplateCache | None = None,
+    ) -> None:
         self.image_path = image_path
-        self.tiff_info = tifftools.read_tiff(str(image_path))
+        self._file_signature = file_signature(image_path)
+        self._tiff_info: TiffInfo | None = read_tiff_info(image_path)
+        self._traversal: IfdTraversal | None = None
+        self._executed = False
         self.strict = strict
 
         self.metadata_redaction_steps = {}
         self.image_redaction_steps = {}
         self.no_match_tags = []
-        ifds = self.tiff_info["ifds"]
-
-        for tag, _ in self._iter_tiff_tag_entries(ifds):
-            if tag.value == tifftools.constants.Tag["ImageJMetadata"].value:
-                raise UnsupportedFileTypeError("Redaction for ImageJ files is not supported")
-
-            if tag.value == tifftools.constants.Tag["NDPI_FORMAT_FLAG"].value:
-                raise UnsupportedFileTypeError("Redaction for NDPI files is not supported")
-            tag_rule = None
-            for name in [tag.name] + list(tag.get("altnames", set())):
-                tag_rule = rules.metadata.get(name, None)
-                if tag_rule and self.is_match(tag_rule, tag):
-                    self.metadata_redaction_steps[tag.value] = tag_rule
-                    break
-                elif strict:
-                    # If there's no rule defined for this tag and we're in
-                    # strict mode, use the fallback action to create a rule on
-                    # the fly.
-                    if rules.metadata_fallback_action == "keep":
-                        fallback_rule: ConcreteMetadataRule = KeepRule(
-                            key_name=tag.name, action=rules.metadata_fallback_action
-                        )
-                    else:
-                        fallback_rule = DeleteRule(key_name=tag.name, action="delete")
-                    self.metadata_redaction_steps[tag.value] = fallback_rule
-                    break
-            else:
-                self.no_match_tags.append(tag)
+        self.rule_keys = set()
+
+        # Images with the same tags resolve to the same rules, so a previous resolution is reused
+        template = None
+        if plan_templates is not None:
+            signature = (type(self), strict, self._template_signature())
+            template = plan_templates.get(signature)
+        if template is not None:
+            self._apply_template(template)
+        else:
+            self._resolve_metadata_rules(rules)
+            if plan_templates is not None:
+                plan_templates.add(signature, self._to_template())
 
-        for ifd in self._iter_ifds(ifds):
-            if not self.is_tiled(ifd):
+        for visited in self.traversal.ifds:
+            if visited.role != IfdRole.Pyramid:
+                ifd = visited.ifd
                 associated_image_key = self.get_associated_image_key_for_ifd(ifd)
                 associated_image_rule = rules.associated_images.get(associated_image_key, None)
                 if not associated_image_rule:
                     associated_image_rule = rules.associated_images["default"]
                 # IFD offset is a useful unique identifier for the IFD itself
                 self.image_redaction_steps[ifd["offset"]] = associated_image_rule
+                # Which rule is used can depend on every associated image rule
+                self.rule_keys.add(rule_key(self.file_format, "associated_images"))
+
+    def _resolve_metadata_rules(self, rules: TiffRules) -> None:
+        for tag, _ in self.traversal.tag_entries:
+            check_tag_supported(tag)
+            names = [tag.name] + list(tag.get("altnames", set()))
+            self.rule_keys.update(rule_key(self.file_format, "metadata", name) for name in names)
+            tag_rule = get_tag_rule(tag, rules, self.strict)
+            if tag_rule:
+                self.metadata_redaction_steps[tag.value] = tag_rule
+            else:
+                self.no_match_tags.append(tag)
+
+    def _template_signature(self) -> Hashable:
+        """Return a key for everything that metadata rules are resolved from."""
+        return tuple((tag.value, tag.name) for tag, _ in self.traversal.tag_entries)
+
+    def _to_template(self) -> PlanTemplate:
+        return PlanTemplate(
+            dict(self.metadata_redaction_steps),
+            list(self.no_match_tags),
+            frozenset(self.rule_keys),
+        )
+
+    def _apply_template(self, template: PlanTemplate) -> None:
+        self.metadata_redaction_steps = dict(template.metadata_redaction_steps)
+        self.no_match_tags = list(template.no_match_tags)
+        self.rule_keys = set(template.rule_keys)
+
+    @property
+    def tiff_info(self) -> TiffInfo:
+        if self._tiff_info is None:
+            if file_signature(self.image_path) != self._file_signature:
+                raise PlanOutdatedError(f"{self.image_path} changed after it was planned")
+            self._tiff_info = read_tiff_info(self.image_path)
+        return self._tiff_info
+
+    @property
+    def traversal(self) -> IfdTraversal:
+        if self._traversal is None:
+            self._traversal = IfdTraversal(self.tiff_info["ifds"])
+        return self._traversal
+
+    def release(self) -> None:
+        if not self._executed:
+            self._tiff_info = None
+            self._traversal = None
 
     def is_match(self, rule: ConcreteMetadataRule, tag: tifftools.TiffTag) -> bool:
-        if rule.action in ["keep", "delete", "replace", "check_type", "modify_date"]:
-            rule_tag = get_tiff_tag(rule.key_name)
-            return rule_tag.value == tag.value
-        return False
+        return tag_rule_matches(rule, tag)
 
     def passes_type_check(
         self, metadata_value: Any, valid_types: list[type], expected_count: int
@@ -173,6 +292,12 @@ class TiffRedactionPlan(RedactionPlan):
             b) is a list whose length is equal to the expected count, and each element of
                said list is of the expected type or types.
         """
+        if isinstance(metadata_value, array):
+            # Every item of an array has the same type, so only one needs to be checked
+            item_type = float if metadata_value.typecode in "fd" else int
+            return len(metadata_value) == expected_count and issubclass(
+                item_type, tuple(valid_types)
+            )
         if isinstance(metadata_value, list):
             return len(metadata_value) == expected_count and all(
                 isinstance(item, tuple(valid_types)) for item in metadata_value
@@ -262,40 +387,31 @@ class TiffRedactionPlan(RedactionPlan):
                 if report is not None:
                     report[self.image_path.name]["missing_tags"].append({tag.value: tag.name})
 
-    def report_plan(
-        self,
-    ) -> RedactionPlanReport:
+    def report_plan(self, detail: ReportDetail = ReportDetail.Full) -> RedactionPlanReport:
         logger.debug("Tiff Metadata Redaction Plan\n")
         offset = -1
         ifd_count = 0
         report: RedactionPlanReport = {}
         report[self.image_path.name] = {}
-        for tag, ifd in self._iter_tiff_tag_entries(self.tiff_info["ifds"]):
+        for tag, ifd in self.traversal.tag_entries:
             if ifd["offset"] != offset:
                 offset = ifd["offset"]
                 ifd_count += 1
                 logger.debug(f"IFD {ifd_count}:")
             if tag.value not in self.no_match_tags:
                 rule = self.metadata_redaction_steps[tag.value]
+                if rule.key_name in EXCLUDED_REPORT_TAGS:
+                    # Structural tags can be very large, and aren't reported
+                    continue
                 operation = self.determine_redaction_operation(rule, ifd)
                 logger.debug(f"Tiff Tag {tag.value} - {rule.key_name}: {operation}")
-                if (
-                    ifd["tags"][tag.value]["datatype"]
-                    == tifftools.constants.Datatype.UNDEFINED.value
-                ):
-                    encoded_value: dict[str, str | int] = {
-                        "value": f"0x{binascii.hexlify(ifd['tags'][tag.value]['data']).decode('utf-8')}",  # type: ignore # noqa: E501
-                        "bytes": len(ifd["tags"][tag.value]["data"]),
-                    }
-                    report[self.image_path.name][rule.key_name] = {
-                        "action": operation,
-                        "binary": encoded_value,
-                    }
-                else:
-                    report[self.image_path.name][rule.key_name] = {
-                        "action": operation,
-                        "value": ifd["tags"][tag.value]["data"],
-                    }
+                entry = ifd["tags"][tag.value]
+                report[self.image_path.name][rule.key_name] = report_tag_entry(
+                    operation,
+                    entry["data"],
+                    detail,
+                    binary=entry["datatype"] == tifftools.constants.Datatype.UNDEFINED.value,
+                )
 
         self.report_missing_rules(report)
         logger.debug("Tiff Associated Image Redaction Plan\n")
@@ -307,77 +423,57 @@ class TiffRedactionPlan(RedactionPlan):
             report[self.image_path.name]["associated_image_redaction_action"] = default_rule.action
         return report
 
-    def create_new_image(self, ifd: IFD, rule: ImageReplaceRule) -> BytesIO:
+    def create_new_image(self, ifd: IFD, rule: ImageReplaceRule) -> IFD:
         """
-        Given an IFD with an image, return a redacted IFD, serialized in a byte stream.
+        Given an IFD with an image, return a redacted IFD.
 
         If `rule` is `"blank_image"`, this redacted IFD contains a blank image and all
         ASCII TIFF entries from the original IFD.
         """
-        image = None
         if rule.replace_with == "blank_image":
             # Create blank image with the same size
             image_width_tag = tifftools.constants.Tag["ImageWidth"]
             image_height_tag = tifftools.constants.Tag["ImageHeight"]
             width = int(ifd["tags"][image_width_tag.value]["data"][0])
             length = int(ifd["tags"][image_height_tag.value]["data"][0])
-            image = Image.new("RGB", (width, length))
+            new_ifd = get_blank_image_ifd(width, length)
 
-            # Copy all ASCII entries to a new IFD.
+            # Copy all ASCII entries to the new IFD.
             # Only copy ASCII to avoid copying entries that affect the image decoding (even those
             # that PIL doesn't itself write; e.g. orientation or ICC color profile).
-            new_ifd = ImageFileDirectory_v2()
             for tag_value, entry in ifd["tags"].items():
                 if entry["datatype"] == tifftools.constants.Datatype.ASCII:
-                    new_ifd[tag_value] = entry["data"]
-                    new_ifd.tagtype[tag_value] = TiffTags.ASCII
-
-            # Encode the new IFD, including the new blank image within it
-            new_ifd_stream = BytesIO()
-            image.save(new_ifd_stream, "TIFF", compression="jpeg", tiffinfo=new_ifd)
-            return new_ifd_stream
+                    new_ifd["tags"][tag_value] = entry.copy()
+            return new_ifd
 
         raise Exception("Redaction option not currently supported")
 
     def replace_associated_image(self, ifds: list[IFD], index: int, rule: ImageReplaceRule):
-        old_ifd = ifds[index]
-        new_ifd_stream = self.create_new_image(old_ifd, rule)
-        replacement_tiff_info = tifftools.read_tiff(new_ifd_stream)
-        new_ifd = replacement_tiff_info["ifds"][0]
-        ifds[index] = new_ifd
-
-    def _redact_associated_images(
-        self, ifds: list[IFD], tag_set=tifftools.constants.Tag
-    ) -> list[IFD]:
-        delete_ifd_indices = []
-        for index, ifd in enumerate(ifds):
-            for tag_id, entry in ifd["tags"].items():
-                tag = tifftools.constants.get_or_create_tag(
-                    tag_id, tagSet=tag_set, datatype=tifftools.Datatype[entry["datatype"]]
-                )
-                if tag.isIFD():
-                    sub_ifds_list = entry.get("ifds", [])
-                    for idx, sub_ifds in enumerate(sub_ifds_list):
-                        sub_ifds_list[idx] = self._redact_associated_images(
-                            sub_ifds, tag.get("tagset")
-                        )
-            if ifd["offset"] in self.image_redaction_steps:
-                rule = self.image_redaction_steps[ifd["offset"]]
-                if rule.action == "delete":
-                    delete_ifd_indices.append(index)
-                elif rule.action == "replace":
-                    self.replace_associated_image(ifds, index, rule)
-        return [ifd for idx, ifd in enumerate(ifds) if idx not in delete_ifd_indices]
+        ifds[index] = self.create_new_image(ifds[index], rule)
+
+    def _redact_associated_images(self) -> None:
+        # IFDs are visited after their sub-IFDs, so each list can be edited in place
+        for visited in self.traversal.ifds:
+            rule = self.image_redaction_steps.get(visited.ifd["offset"])
+            if rule is None:
+                continue
+            # IFDs are compared by identity, since separate IFDs may have equal contents
+            index = next(index for index, ifd in enumerate(visited.siblings) if ifd is visited.ifd)
+            if rule.action == "delete":
+                del visited.siblings[index]
+            elif rule.action == "replace":
+                self.replace_associated_image(visited.siblings, index, rule)
 
     def execute_plan(self) -> None:
         """Modify the image data according to the redaction rules."""
-        ifds = self.tiff_info["ifds"]
-        new_ifds = self._redact_associated_images(ifds)
-        for tag, ifd in self._iter_tiff_tag_entries(new_ifds):
+        self._executed = True
+        self._redact_associated_images()
+        # Associated images may have been replaced, so the remaining IFDs are visited again
+        self._traversal = IfdTraversal(self.tiff_info["ifds"])
+        for tag, ifd in self._traversal.tag_entries:
             rule = self.metadata_redaction_steps.get(tag.value)
             if rule is not None:
                 self.apply(rule, ifd)
-        self.tiff_info["ifds"] = new_ifds
 
     def save(self, output_path: Path, overwrite: bool) -> None:
         # do we still need this?
@@ -0,0 +1,244 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+from collections.abc import Callable
+from dataclasses import dataclass
+from functools import partial
+from pathlib import Path
+import threading
+from typing import TYPE_CHECKING
+
+from wsidicom import WsiDicom
+
+from imagedephi.rules import FileFormat
+from imagedephi.utils.constants import MAX_ASSOCIATED_IMAGE_SIZE
+from imagedephi.utils.dicom import file_is_same_series_as
+from imagedephi.utils.image import (
+    get_file_format_from_path,
+    get_image_bytes_from_dicom_slide,
+    get_image_bytes_from_ifd,
+    get_image_bytes_from_tiff,
+)
+from imagedephi.utils.tiff import (
+    find_associated_image_svs,
+    find_ifd_for_thumbnail,
+    is_svs_ifds,
+    read_tiff_info,
+)
+
+if TYPE_CHECKING:
+    from tifftools.tifftools import IFD
+
+ASSOCIATED_IMAGE_KEYS = ["thumbnail", "label", "macro"]
+# Parsed files are kept briefly, since the thumbnail, label and macro are usually requested together
+MAX_CACHED_SOURCES = 32
+
+
+class AssociatedImageError(Exception):
+    def __init__(self, status_code: int, detail: str) -> None:
+        super().__init__(status_code, detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+_sources: OrderedDict[tuple[Path, int, int], AssociatedImageSource] = OrderedDict()
+_source_lock = threading.Lock()
+
+
+@dataclass
+class _OpenSlide:
+    slide: WsiDicom
+    # The number of threads reading from the slide. Slides that are no longer cached are closed
+    # once none are.
+    users: int = 0
+    evicted: bool = False
+
+
+# Slides opened by this process, which are reused for each associated image of a slide
+_slides: OrderedDict[tuple[Path, ...], _OpenSlide] = OrderedDict()
+_slide_lock = threading.Lock()
+
+
+def _evict_slides(open_slides: list[_OpenSlide]) -> list[_OpenSlide]:
+    """Mark slides as no longer cached, and return those that can be closed now."""
+    for open_slide in open_slides:
+        open_slide.evicted = True
+    return [open_slide for open_slide in open_slides if not open_slide.users]
+
+
+def close_slides() -> None:
+    """Close the slides opened by this process. Slides in use are closed once they're read."""
+    with _slide_lock:
+        idle_slides = _evict_slides(list(_slides.values()))
+        _slides.clear()
+    for open_slide in idle_slides:
+        open_slide.slide.close()
+
+
+def _extract_tiff_image(ifd: IFD | None, file_name: str, max_width: int, max_height: int) -> bytes:
+    try:
+        if not ifd:
+            # If the image is not tiled, no appropriate IFD was found. In this case
+            # attempt to get a thumbnail using the entire image.
+            return get_image_bytes_from_tiff(file_name, max_width, max_height).getvalue()
+        return get_image_bytes_from_ifd(ifd, file_name, max_width, max_height).getvalue()
+    except Exception as e:
+        raise AssociatedImageError(
+            422,  # unprocessable content
+            f"Could not generate thumbnail image for {file_name}: {e.args[0]}",
+        )
+
+
+def _extract_dicom_image(
+    related_files: tuple[Path, ...], image_key: str, file_name: str, max_width: int, max_height: int
+) -> bytes:
+    idle_slides = []
+    with _slide_lock:
+        open_slide = _slides.get(related_files)
+        if open_slide is None:
+            open_slide = _OpenSlide(WsiDicom.open(list(related_files)))
+            _slides[related_files] = open_slide
+            evicted_slides = []
+            while len(_slides) > MAX_CACHED_SOURCES:
+                evicted_slides.append(_slides.popitem(last=False)[1])
+            idle_slides = _evict_slides(evicted_slides)
+        else:
+            _slides.move_to_end(related_files)
+        open_slide.users += 1
+    # Each slide holds every file of its series open
+    for idle_slide in idle_slides:
+        idle_slide.slide.close()
+    try:
+        image_bytes = get_image_bytes_from_dicom_slide(
+            open_slide.slide, image_key, max_width, max_height
+        )
+    finally:
+        with _slide_lock:
+            open_slide.users -= 1
+            close = open_slide.evicted and not open_slide.users
+        if close:
+            open_slide.slide.close()
+    if image_bytes:
+        return image_bytes.getvalue()
+    raise AssociatedImageError(404, f"Could not retrieve {image_key} image for {file_name}")
+
+
+class AssociatedImageSource:
+    """
+    An image file that associated images are extracted from.
+
+    The file is only parsed once, however many associated images are requested. Sources may be
+    shared between threads.
+    """
+
+    def __init__(self, file_name: Path) -> None:
+        self.file_name = file_name
+        self.image_type = get_file_format_from_path(file_name)
+        self._lock = threading.Lock()
+        self._ifds: list[IFD] | None = None
+        self._related_files: tuple[Path, ...] | None = None
+
+    @property
+    def ifds(self) -> list[IFD]:
+        with self._lock:
+            if self._ifds is None:
+                self._ifds = read_tiff_info(self.file_name)["ifds"]
+            return self._ifds
+
+    @property
+    def related_files(self) -> tuple[Path, ...]:
+        """The other files of the DICOM series of this file."""
+        with self._lock:
+            if self._related_files is None:
+                self._related_files = tuple(
+                    child
+                    for child in self.file_name.parent.iterdir()
+                    if child != self.file_name and file_is_same_series_as(self.file_name, child)
+                )
+            return self._related_files
+
+    def get_extractor(
+        self,
+        image_key: str,
+        max_width=MAX_ASSOCIATED_IMAGE_SIZE,
+        max_height=MAX_ASSOCIATED_IMAGE_SIZE,
+    ) -> Callable[[], bytes]:
+        """
+        Find an associated image, and return a function that extracts it as a JPEG.
+
+        The file is parsed here, and the function only decodes and resizes the image, so it can
+        be run in another process. Raise an `AssociatedImageError` if there is no such image.
+        """
+        file_name = str(self.file_name)
+        if self.image_type == FileFormat.SVS or self.image_type == FileFormat.TIFF:
+            ifd: IFD | None = None
+            if image_key == "thumbnail":
+                ifd = find_ifd_for_thumbnail(self.ifds, int(max_width), int(max_height))
+            else:
+                # image key is one of "macro", "label"
+                if not is_svs_ifds(self.ifds):
+                    raise AssociatedImageError(
+                        404, f"Image key {image_key} is not supported for {file_name}"
+                    )
+                ifd = find_associated_image_svs(self.ifds, image_key)
+                if not ifd:
+                    raise AssociatedImageError(404, f"No {image_key} image found for {file_name}")
+            return partial(_extract_tiff_image, ifd, file_name, int(max_width), int(max_height))
+        elif self.image_type == FileFormat.DICOM:
+            return partial(
+                _extract_dicom_image,
+                self.related_files,
+                image_key,
+                file_name,
+                int(max_width),
+                int(max_height),
+            )
+        raise AssociatedImageError(404, f"Could not retrieve {image_key} image for {file_name}")
+
+
+def get_associated_image_source(file_name: Path) -> AssociatedImageSource:
+    """Return a source for an image file, reusing a recent one if the file hasn't changed."""
+    stat = file_name.stat()
+    key = (file_name.resolve(), stat.st_mtime_ns, stat.st_size)
+    with _source_lock:
+        source = _sources.get(key)
+        if source is not None:
+            _sources.move_to_end(key)
+            return source
+    source = AssociatedImageSource(file_name)
+    with _source_lock:
+        source = _sources.setdefault(key, source)
+        while len(_sources) > MAX_CACHED_SOURCES:
+            _sources.popitem(last=False)
+    return source
+
+
+def get_associated_image_extractor(
+    file_name: str,
+    image_key: str,
+    max_width=MAX_ASSOCIATED_IMAGE_SIZE,
+    max_height=MAX_ASSOCIATED_IMAGE_SIZE,
+) -> Callable[[], bytes]:
+    """
+    Return a function that extracts a JPEG of an associated image, which may run in a process.
+
+    Raise an `AssociatedImageError` if the image can't be found.
+    """
+    if image_key not in ASSOCIATED_IMAGE_KEYS:
+        raise AssociatedImageError(
+            400, f"{image_key} is not a supported associated image key for {file_name}."
+        )
+    if not Path(file_name).exists():
+        raise AssociatedImageError(404, f"{file_name} does not exist")
+    source = get_associated_image_source(Path(file_name))
+    return source.get_extractor(image_key, max_width, max_height)
+
+
+def get_associated_image_bytes(
+    file_name: str,
+    image_key: str,
+    max_width=MAX_ASSOCIATED_IMAGE_SIZE,
+    max_height=MAX_ASSOCIATED_IMAGE_SIZE,
+) -> bytes:
+    """Return a JPEG of an associated image, or raise an `AssociatedImageError`."""
+    return get_associated_image_extractor(file_name, image_key, max_width, max_height)()
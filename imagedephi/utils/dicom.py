@@ -3,6 +3,8 @@ import re
 
 import pydicom
 
+from imagedephi.utils.metadata_index import get_indexed
+
 extensions = {
     None: True,
     "dcm": True,
@@ -11,6 +13,17 @@ extensions = {
 }
 
 
+def _read_series_uid(path: Path) -> str | None:
+    dataset = pydicom.dcmread(path, stop_before_pixels=True)
+    series_uid = dataset.data_element("SeriesInstanceUID")
+    return str(series_uid.value) if series_uid is not None else None
+
+
+def get_series_uid(path: Path) -> str | None:
+    """Return the series of a DICOM file, through the metadata index if one is in use."""
+    return get_indexed(path, "series_uid", _read_series_uid)
+
+
 def file_is_same_series_as(original_path: Path, path: Path) -> bool:
     """
     Determine if path belongs to the same series as original_path.
@@ -31,11 +44,7 @@ def file_is_same_series_as(original_path: Path, path: Path) -> bool:
     if not might_match and re.match(r"^DCM_\d+$", str(path)):
         might_match = True
     if might_match:
-        original = pydicom.dcmread(original_path, stop_before_pixels=True)
-        original_series_uid = original.data_element("SeriesInstanceUID")
+        original_series_uid = get_series_uid(original_path)
         if original_series_uid:
-            original_series_uid = original_series_uid.value
-            slide_to_test = pydicom.dcmread(path, stop_before_pixels=True)
-            slide_series_uid = slide_to_test.data_element("SeriesInstanceUID")
-            return slide_series_uid is not None and slide_series_uid.value == original_series_uid
+            return get_series_uid(path) == original_series_uid
     return False
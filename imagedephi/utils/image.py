@@ -14,25 +14,33 @@ from imagedephi.utils.constants import (
     IMAGE_DEPHI_MAX_IMAGE_PIXELS,
     MAX_ASSOCIATED_IMAGE_SIZE,
 )
+from imagedephi.utils.metadata_index import get_indexed
+from imagedephi.utils.tiff import TIFF_HEADERS, is_svs_file
 
 if TYPE_CHECKING:
     from tifftools.tifftools import IFD
 
 
+def _read_file_format(image_path: Path) -> FileFormat | None:
+    with open(image_path, "rb") as image_file:
+        data = image_file.read(132)
+        if data[128:] == b"DICM":
+            return FileFormat.DICOM
+        elif data[:4] in TIFF_HEADERS:
+            return FileFormat.SVS if is_svs_file(image_file, data) else FileFormat.TIFF
+    return None
+
+
 def get_file_format_from_path(image_path: Path) -> FileFormat | None:
     """
     Attempt to determine the file type of an image by looking at its file signature.
 
     See https://en.wikipedia.org/wiki/List_of_file_signatures. In case of a "dual-flavor" DICOM
     file (i.e. a file that can be read as a DICOM or a tiff), prefer to report the image as
-    DICOM.
+    DICOM. TIFF files are reported as SVS if their first IFD marks them as Aperio files. If a
+    metadata index is in use, the type is read from the index when the file is unchanged.
     """
-    data = open(image_path, "rb").read(132)
-    if data[128:] == b"DICM":
-        return FileFormat.DICOM
-    elif data[:4] in (b"II\x2a\x00", b"MM\x00\x2a", b"II\x2b\x00", b"MM\x00\x2b"):
-        return FileFormat.TIFF
-    return None
+    return get_indexed(Path(image_path), "file_format", _read_file_format)
 
 
 def get_scale_factor(max_dimensions: tuple[int, int], image_dimensions: tuple[int, int]) -> float:
@@ -164,26 +172,35 @@ def get_image_bytes_from_dicom(
     key: str,
     max_width=MAX_ASSOCIATED_IMAGE_SIZE,
     max_height=MAX_ASSOCIATED_IMAGE_SIZE,
-) -> BytesIO:
+) -> BytesIO | None:
     slide = WsiDicom.open(related_files)
+    return get_image_bytes_from_dicom_slide(slide, key, max_width, max_height)
+
+
+def get_image_bytes_from_dicom_slide(
+    slide: WsiDicom,
+    key: str,
+    max_width=MAX_ASSOCIATED_IMAGE_SIZE,
+    max_height=MAX_ASSOCIATED_IMAGE_SIZE,
+) -> BytesIO | None:
+    """Return a JPEG of an associated image of an open DICOM slide, if it has one."""
     image = None
     try:
         if key == "thumbnail":
             image = slide.read_thumbnail()
         elif key == "label":
             image = slide.read_label()
-        elif key == "macro":
+        elif key in ("macro", "overview"):
             image = slide.read_overview()
-        if image:
-            # resize the image
-            scale_factor = get_scale_factor((max_width, max_height), image.size)
-            new_size = (int(image.size[0] * scale_factor), int(image.size[1] * scale_factor))
-            image.thumbnail(new_size, Image.LANCZOS)
-            img_buffer = BytesIO()
-            image.save(img_buffer, "JPEG")
-            img_buffer.seek(0)
-            return img_buffer
-        else:
-            raise WsiDicomNotFoundError
     except WsiDicomNotFoundError:
-        return img_buffer
+        return None
+    if not image:
+        return None
+    # resize the image
+    scale_factor = get_scale_factor((max_width, max_height), image.size)
+    new_size = (int(image.size[0] * scale_factor), int(image.size[1] * scale_factor))
+    image.thumbnail(new_size, Image.LANCZOS)
+    img_buffer = BytesIO()
+    image.save(img_buffer, "JPEG")
+    img_buffer.seek(0)
+    return img_buffer
@@ -0,0 +1,149 @@
+from __future__ import annotations
+
+from collections.abc import Callable
+from pathlib import Path
+import pickle
+import sqlite3
+import threading
+from typing import TypeVar
+
+import click
+
+from imagedephi.utils.logger import logger
+
+T = TypeVar("T")
+
+# Commands read through the index at this location when it exists; `imagedephi index` creates it
+DEFAULT_METADATA_INDEX_PATH = Path(click.get_app_dir("ImageDePHI")) / "metadata_index.sqlite"
+# Increase when the layout of stored values changes, so that values are extracted again
+METADATA_INDEX_VERSION = 1
+# How long to wait for another process that is writing to the same index, in seconds
+METADATA_INDEX_TIMEOUT = 30.0
+
+FileKey = tuple[int, int, int, int]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    path TEXT NOT NULL,
+    name TEXT NOT NULL,
+    device INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    value BLOB NOT NULL,
+    PRIMARY KEY (path, name)
+)
+"""
+
+
+def get_file_key(path: Path) -> FileKey:
+    """Return what identifies the current contents of a file, without reading it."""
+    stat = path.stat()
+    return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+class MetadataIndex:
+    """
+    A persistent index of metadata extracted from image files, stored in SQLite.
+
+    Each value is stored by the path of its file and the name of what was extracted, and is only
+    reused while the device, inode, size and modification time of the file are unchanged. Values
+    are pickled, so an index must only be opened from a trusted location. An index may be shared
+    between threads, and between processes.
+    """
+
+    def __init__(self, index_path: Path) -> None:
+        index_path.parent.mkdir(parents=True, exist_ok=True)
+        self.index_path = index_path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            index_path, timeout=METADATA_INDEX_TIMEOUT, check_same_thread=False
+        )
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            (version,) = self._connection.execute("PRAGMA user_version").fetchone()
+            if version != METADATA_INDEX_VERSION:
+                self._connection.execute("DROP TABLE IF EXISTS entries")
+                self._connection.execute(f"PRAGMA user_version = {METADATA_INDEX_VERSION}")
+            self._connection.execute(_SCHEMA)
+
+    def get(self, path: Path, name: str, extract: Callable[[Path], T]) -> T:
+        """
+        Return the value named `name` for the file at `path`.
+
+        The value is extracted with `extract` and stored, unless it is already stored for the
+        current contents of the file. Errors from `extract` are raised, and nothing is stored.
+        """
+        file_key = get_file_key(path)
+        index_key = (str(path.absolute()), name)
+        try:
+            with self._lock:
+                row = self._connection.execute(
+                    "SELECT device, inode, size, mtime_ns, value FROM entries "
+                    "WHERE path = ? AND name = ?",
+                    index_key,
+                ).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"Could not read from metadata index {self.index_path}: {e}")
+            row = None
+        if row is not None and tuple(row[:4]) == file_key:
+            self.hits += 1
+            return pickle.loads(row[4])
+
+        self.misses += 1
+        value = extract(path)
+        try:
+            with self._lock, self._connection:
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (*index_key, *file_key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)),
+                )
+        except sqlite3.Error as e:
+            logger.warning(f"Could not write to metadata index {self.index_path}: {e}")
+        return value
+
+    def prune(self, directory: Path | None = None) -> int:
+        """
+        Remove values for files that no longer exist, within `directory` if it's given.
+
+        Return the number of files removed.
+        """
+        with self._lock:
+            paths = [
+                Path(path)
+                for (path,) in self._connection.execute("SELECT DISTINCT path FROM entries")
+            ]
+        if directory is not None:
+            paths = [path for path in paths if path.is_relative_to(directory.absolute())]
+        missing = [(str(path),) for path in paths if not path.is_file()]
+        with self._lock, self._connection:
+            self._connection.executemany("DELETE FROM entries WHERE path = ?", missing)
+        return len(missing)
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+_metadata_index: MetadataIndex | None = None
+
+
+def get_metadata_index() -> MetadataIndex | None:
+    return _metadata_index
+
+
+def set_metadata_index(metadata_index: MetadataIndex | None) -> None:
+    """Read metadata through `metadata_index` from now on, or read every file if it is `None`."""
+    global _metadata_index
+    if _metadata_index is not None and _metadata_index is not metadata_index:
+        _metadata_index.close()
+    _metadata_index = metadata_index
+
+
+def get_indexed(path: Path, name: str, extract: Callable[[Path], T]) -> T:
+    """Return the value named `name` for a file, through the metadata index if one is in use."""
+    if _metadata_index is None:
+        return extract(path)
+    return _metadata_index.get(path, name, extract)
@@ -1,18 +1,128 @@
+from __future__ import annotations
+
+import asyncio
+from collections.abc import Generator
+from contextlib import contextmanager
 from pathlib import Path
-import queue
+import threading
+import time
+from typing import Any
 
-_progress_queue: queue.Queue[tuple] = queue.Queue(-1)
+# Limit how often updates for a single run are forwarded to subscribers
+PROGRESS_MIN_INTERVAL = 0.1
+# Progress events describe the latest state, so subscribers only need a short backlog
+SUBSCRIPTION_MAX_SIZE = 16
 
+ProgressEvent = dict[str, Any]
 
-def push_progress(count: int, max: int, redact_dir: Path) -> None:
-    _progress_queue.put_nowait((count, max, redact_dir))
 
+class ProgressSubscription:
+    """A per-consumer view of progress events, to be read from the event loop."""
+
+    def __init__(self, max_size: int = SUBSCRIPTION_MAX_SIZE) -> None:
+        self._queue: asyncio.Queue[ProgressEvent] = asyncio.Queue(max_size)
+
+    def put(self, event: ProgressEvent) -> None:
+        # A slow consumer only needs the most recent events, so drop the oldest
+        if self._queue.full():
+            self._queue.get_nowait()
+        self._queue.put_nowait(event)
+
+    async def get(self) -> ProgressEvent:
+        """Wait until a progress event is available."""
+        return await self._queue.get()
+
+
+class ProgressBroadcaster:
+    """
+    Deliver progress events from worker threads to every asyncio subscriber.
+
+    Events are keyed by the run that produced them. Intermediate events for a run are coalesced,
+    so that each subscriber receives at most one event per run every `min_interval` seconds. The
+    final event of a run is always delivered immediately. Publishing when nobody is subscribed is
+    a no-op.
+    """
+
+    def __init__(self, min_interval: float = PROGRESS_MIN_INTERVAL) -> None:
+        self.min_interval = min_interval
+        self._lock = threading.Lock()
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._subscriptions: set[ProgressSubscription] = set()
+        # These are only accessed from the event loop thread
+        self._pending: dict[str, ProgressEvent] = {}
+        self._last_sent: dict[str, float] = {}
+        self._scheduled: dict[str, asyncio.TimerHandle] = {}
 
-def get_next_progress_message() -> tuple | None:
-    try:
-        record = _progress_queue.get_nowait()
-    except queue.Empty:
-        return None
-    else:
-        # return record.message
-        return record
+    @property
+    def subscriber_count(self) -> int:
+        """The number of subscriptions that currently receive events."""
+        with self._lock:
+            return len(self._subscriptions)
+
+    @contextmanager
+    def subscribe(self) -> Generator[ProgressSubscription, None, None]:
+        """Register a new subscription; must be called from within a running event loop."""
+        subscription = ProgressSubscription()
+        with self._lock:
+            self._loop = asyncio.get_running_loop()
+            self._subscriptions.add(subscription)
+        try:
+            yield subscription
+        finally:
+            with self._lock:
+                self._subscriptions.discard(subscription)
+
+    def publish(self, key: str, event: ProgressEvent, final: bool = False) -> None:
+        """Publish an event; this may be called from any thread."""
+        with self._lock:
+            loop = self._loop
+            if loop is None or not self._subscriptions:
+                return
+        try:
+            loop.call_soon_threadsafe(self._receive, key, event, final)
+        except RuntimeError:
+            # The event loop has been closed
+            with self._lock:
+                if self._loop is loop:
+                    self._loop = None
+
+    def _receive(self, key: str, event: ProgressEvent, final: bool) -> None:
+        self._pending[key] = event
+        if final:
+            if handle := self._scheduled.pop(key, None):
+                handle.cancel()
+            self._flush(key)
+            # The run is finished, so stop tracking it
+            self._last_sent.pop(key, None)
+            return
+        if key in self._scheduled:
+            # A flush is already due, which will pick up this event
+            return
+        delay = self._last_sent.get(key, float("-inf")) + self.min_interval - time.monotonic()
+        if delay <= 0:
+            self._flush(key)
+        else:
+            assert self._loop is not None
+            self._scheduled[key] = self._loop.call_later(delay, self._flush, key)
+
+    def _flush(self, key: str) -> None:
+        self._scheduled.pop(key, None)
+        event = self._pending.pop(key, None)
+        if event is None:
+            return
+        self._last_sent[key] = time.monotonic()
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            subscription.put(event)
+
+
+progress_broadcaster = ProgressBroadcaster()
+
+
+def push_progress(count: int, max: int, redact_dir: Path) -> None:
+    progress_broadcaster.publish(
+        str(redact_dir),
+        dict(count=count, max=max, redact_dir=redact_dir.name),
+        final=count >= max,
+    )
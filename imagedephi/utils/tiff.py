@@ -1,38 +1,241 @@
 from __future__ import annotations
 
-from collections.abc import Generator
+from array import array
+from collections.abc import Generator, Iterator
+from dataclasses import dataclass
+from enum import Enum
+from functools import partial
+import io
+import os
 from pathlib import Path
-from typing import TYPE_CHECKING
+import struct
+from typing import TYPE_CHECKING, Any, BinaryIO, cast
 
 import tifftools
 
 from imagedephi.utils.constants import IMAGE_DEPHI_MAX_IMAGE_PIXELS
+from imagedephi.utils.metadata_index import get_metadata_index
 
 if TYPE_CHECKING:
-    from tifftools.tifftools import IFD
+    from tifftools.tifftools import IFD, TiffInfo
 
 
+# TIFF file signatures, for each byte order, in classic and BigTIFF layouts
+TIFF_HEADERS = (b"II\x2a\x00", b"MM\x00\x2a", b"II\x2b\x00", b"MM\x00\x2b")
 IMAGE_DESCRIPTION_ID = tifftools.constants.Tag["ImageDescription"].value
 NEWSUBFILETYPE_ID = tifftools.constants.Tag["NewSubfileType"].value
 
+# Tags holding one value per strip or tile, which can have millions of entries in large pyramids
+OFFSET_DATA_TAG_IDS = {
+    tifftools.constants.Tag[name].value
+    for name in ["StripOffsets", "StripByteCounts", "TileOffsets", "TileByteCounts"]
+}
+UNSIGNED_DATATYPES = {tifftools.Datatype[name].value for name in ["BYTE", "SHORT", "LONG", "LONG8"]}
 
-def iter_ifds(
-    ifds: list[IFD],
-    tag_set=tifftools.constants.Tag,
-) -> Generator[IFD, None, None]:
-    for ifd in ifds:
-        for tag_id, entry in ifd["tags"].items():
-            tag: tifftools.TiffTag = tifftools.constants.get_or_create_tag(
-                tag_id,
-                tagSet=tag_set,
-                datatype=tifftools.Datatype[entry["datatype"]],
-            )
+# Size of the reads used to parse TIFF headers. IFDs and their tag data are usually close together,
+# so a few large reads can replace many small ones.
+HEADER_BLOCK_SIZE = 256 * 1024
+
+# Limits on what is read when checking for Aperio files, in case of malformed or unusual files
+MAX_SNIFFED_ENTRY_COUNT = 4096
+MAX_SNIFFED_DESCRIPTION_LENGTH = 64 * 1024
+
+
+class BlockReader(io.RawIOBase):
+    """
+    A seekable, read-only view of a file, which reads and caches whole blocks at a time.
+
+    Consecutive blocks that aren't cached yet are fetched with a single read. This is useful on
+    network storage, where each read of the underlying file is a round trip.
+    """
+
+    def __init__(self, raw: BinaryIO, block_size: int = HEADER_BLOCK_SIZE) -> None:
+        super().__init__()
+        self.raw = raw
+        self.block_size = block_size
+        self.size = raw.seek(0, os.SEEK_END)
+        # The number of reads of the underlying file
+        self.read_count = 0
+        self._blocks: dict[int, bytes] = {}
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError(f"Negative seek position {offset}")
+        self._position = offset
+        return offset
+
+    def readinto(self, buffer: Any) -> int:
+        view = memoryview(buffer).cast("B")
+        end = min(self._position + len(view), self.size)
+        if end <= self._position:
+            return 0
+        first_block = self._position // self.block_size
+        last_block = (end - 1) // self.block_size
+        self._load_blocks(first_block, last_block)
+        written = 0
+        for index in range(first_block, last_block + 1):
+            block_start = index * self.block_size
+            start = max(self._position, block_start) - block_start
+            stop = min(end, block_start + self.block_size) - block_start
+            view[written : written + stop - start] = self._blocks[index][start:stop]
+            written += stop - start
+        self._position = end
+        return written
+
+    def _load_blocks(self, first_block: int, last_block: int) -> None:
+        index = first_block
+        while index <= last_block:
+            if index in self._blocks:
+                index += 1
+                continue
+            run_end = index
+            while run_end < last_block and run_end + 1 not in self._blocks:
+                run_end += 1
+            self.raw.seek(index * self.block_size)
+            data = self.raw.read((run_end - index + 1) * self.block_size)
+            self.read_count += 1
+            for block_index in range(index, run_end + 1):
+                block_start = (block_index - index) * self.block_size
+                self._blocks[block_index] = data[block_start : block_start + self.block_size]
+            index = run_end + 1
+
+
+class IfdRole(Enum):
+    # A tiled image, which is usually one resolution level of the main image
+    Pyramid = "pyramid"
+    # A top-level image that isn't tiled, like a label, macro or thumbnail
+    Associated = "associated"
+    # A non-tiled IFD referenced by a tag of another IFD, like EXIF or GPS data
+    SubIfd = "sub_ifd"
+
+
+@dataclass
+class VisitedIfd:
+    ifd: IFD
+    role: IfdRole
+    # The list of IFDs that contains this IFD, for edits
+    siblings: list[IFD]
+    depth: int
+
+
+# Resolved tags, keyed by the identity of their tag set, their ID and their datatype
+_resolved_tags: dict[tuple[int, int, int], tifftools.TiffTag] = {}
+
+
+def resolve_tag(tag_id: int, datatype: int, tag_set=tifftools.constants.Tag) -> tifftools.TiffTag:
+    """Return the tag for an IFD entry, only creating each tag once."""
+    key = (id(tag_set), tag_id, datatype)
+    tag = _resolved_tags.get(key)
+    if tag is None:
+        tag = tifftools.constants.get_or_create_tag(
+            tag_id, tagSet=tag_set, datatype=tifftools.Datatype[datatype]
+        )
+        _resolved_tags[key] = tag
+    return tag
+
+
+class IfdTraversal:
+    """
+    The IFDs of a TIFF file, including sub-IFDs, and their tags, found in a single visit.
+
+    `tag_entries` lists every tag that isn't a reference to sub-IFDs, with its IFD. Tags are in
+    ID order, and the tags of sub-IFDs are listed where the tag referencing them would be.
+    `ifds` lists every IFD, after its sub-IFDs, with its role.
+    """
+
+    def __init__(self, ifds: list[IFD]) -> None:
+        self.tag_entries: list[tuple[tifftools.TiffTag, IFD]] = []
+        self.ifds: list[VisitedIfd] = []
+        # Each frame is either a list of IFDs, or an IFD with its remaining tags
+        stack: list[tuple[list[IFD], IFD | None, Iterator[Any], Any, int]] = [
+            (ifds, None, iter(ifds), tifftools.constants.Tag, 0)
+        ]
+        while stack:
+            siblings, ifd, items, tag_set, depth = stack[-1]
+            item = next(items, None)
+            if ifd is None:
+                if item is None:
+                    stack.pop()
+                else:
+                    stack.append(
+                        (siblings, item, iter(sorted(item["tags"].items())), tag_set, depth)
+                    )
+                continue
+            if item is None:
+                stack.pop()
+                if is_tiled(ifd):
+                    role = IfdRole.Pyramid
+                else:
+                    role = IfdRole.Associated if depth == 0 else IfdRole.SubIfd
+                self.ifds.append(VisitedIfd(ifd, role, siblings, depth))
+                continue
+            tag_id, entry = item
+            tag = resolve_tag(tag_id, entry["datatype"], tag_set)
             if tag.isIFD():
                 # entry['ifds'] contains a list of lists
                 # see tifftools.read_tiff
-                for sub_ifds in entry.get("ifds", []):
-                    yield from iter_ifds(sub_ifds, tag.get("tagset"))
-        yield ifd
+                for sub_ifds in reversed(entry.get("ifds", [])):
+                    stack.append((sub_ifds, None, iter(sub_ifds), tag.get("tagset"), depth + 1))
+            else:
+                self.tag_entries.append((tag, ifd))
+
+
+def _parse_tiff_info(image_path: Path | str, block_size: int = HEADER_BLOCK_SIZE) -> TiffInfo:
+    with open(image_path, "rb", buffering=0) as raw:
+        tiff_info = tifftools.read_tiff(cast(BinaryIO, BlockReader(raw, block_size)))
+    _set_tiff_info_path(tiff_info, image_path)
+    for visited in IfdTraversal(tiff_info["ifds"]).ifds:
+        for tag_id, entry in visited.ifd["tags"].items():
+            if tag_id in OFFSET_DATA_TAG_IDS and entry["datatype"] in UNSIGNED_DATATYPES:
+                # tifftools indexes and packs these values, so any sequence of integers works
+                entry["data"] = array("Q", entry["data"])  # type: ignore[typeddict-item]
+    return tiff_info
+
+
+def _set_tiff_info_path(tiff_info: TiffInfo, image_path: Path | str) -> None:
+    # Image data is copied from the file itself when writing, rather than from the reader
+    tiff_info["path_or_fobj"] = image_path
+    for visited in IfdTraversal(tiff_info["ifds"]).ifds:
+        visited.ifd["path_or_fobj"] = image_path
+
+
+def read_tiff_info(image_path: Path | str, block_size: int = HEADER_BLOCK_SIZE) -> TiffInfo:
+    """
+    Read the structure of a TIFF file with tifftools.
+
+    The file is read in blocks of `block_size` bytes, which are cached while parsing. If a
+    metadata index is in use, the structure is read from the index when the file is unchanged.
+
+    Offsets and byte counts of strips and tiles are stored as compact arrays of 64-bit integers,
+    rather than lists of Python integers.
+    """
+    metadata_index = get_metadata_index()
+    if metadata_index is None:
+        return _parse_tiff_info(image_path, block_size)
+    tiff_info = metadata_index.get(
+        Path(image_path), "tiff_info", partial(_parse_tiff_info, block_size=block_size)
+    )
+    _set_tiff_info_path(tiff_info, image_path)
+    return tiff_info
+
+
+def iter_ifds(ifds: list[IFD]) -> Generator[IFD, None, None]:
+    for visited in IfdTraversal(ifds).ifds:
+        yield visited.ifd
 
 
 def is_tiled(ifd: IFD):
@@ -85,10 +288,13 @@ def get_associated_image_svs(image_path: Path, image_key: str) -> IFD | None:
     if image_key not in ["macro", "label"]:
         raise ValueError("image_key must be one of macro, label")
 
-    image_info = tifftools.read_tiff(image_path)
-    ifds = image_info["ifds"]
+    image_info = read_tiff_info(image_path)
+    return find_associated_image_svs(image_info["ifds"], image_key)
+
 
-    if "aperio" not in str(ifds[0]["tags"][IMAGE_DESCRIPTION_ID]["data"]).lower():
+def find_associated_image_svs(ifds: list[IFD], image_key: str) -> IFD | None:
+    """Given the IFDs of an SVS image, return the IFD for an associated label or macro image."""
+    if not is_svs_ifds(ifds):
         return None
 
     if image_key == "macro":
@@ -100,12 +306,16 @@ def get_associated_image_svs(image_path: Path, image_key: str) -> IFD | None:
 
 def get_ifd_for_thumbnail(image_path: Path, thumbnail_width=0, thumbnail_height=0) -> IFD | None:
     """Given a path to a TIFF image, return the IFD for the lowest resolution tiled image."""
-    image_info = tifftools.read_tiff(image_path)
+    image_info = read_tiff_info(image_path)
+    return find_ifd_for_thumbnail(image_info["ifds"], thumbnail_width, thumbnail_height)
+
 
+def find_ifd_for_thumbnail(ifds: list[IFD], thumbnail_width=0, thumbnail_height=0) -> IFD | None:
+    """Given the IFDs of a TIFF image, return the IFD for the lowest resolution tiled image."""
     candidate_width = float("inf")
     candidate_height = float("inf")
     candidate_ifd = None
-    for ifd in iter_ifds(image_info["ifds"]):
+    for ifd in iter_ifds(ifds):
         # We are interested in the lowest res tiled image.
         if tifftools.Tag.TileWidth.value not in ifd["tags"]:
             continue
@@ -148,8 +358,53 @@ def get_ifd_for_thumbnail(image_path: Path, thumbnail_width=0, thumbnail_height=
 
 
 def get_is_svs(image_path: Path) -> bool:
-    image_info = tifftools.read_tiff(image_path)
-    if tifftools.Tag.ImageDescription.value not in image_info["ifds"][0]["tags"]:
+    with open(image_path, "rb") as image_file:
+        header = image_file.read(16)
+        return header[:4] in TIFF_HEADERS and is_svs_file(image_file, header)
+
+
+def is_svs_file(image_file: BinaryIO, header: bytes) -> bool:
+    """
+    Determine if an open TIFF file is an Aperio (.svs) file, reading only its first IFD.
+
+    `header` holds the first bytes of the file, at least 16 of them for BigTIFF files. This gives
+    the same result as `is_svs_ifds`, without parsing the structure of the whole file.
+    """
+    byte_order = ">" if header[:2] == b"MM" else "<"
+    bigtiff = header[2:4] in (b"\x2b\x00", b"\x00\x2b")
+    if len(header) < (16 if bigtiff else 8):
+        return False
+    # Layouts of the IFD offset, the entry count, and each entry of an IFD
+    if bigtiff:
+        offset, entry_count, entry = "Q", "Q", "HHQ8s"
+    else:
+        offset, entry_count, entry = "L", "H", "HHL4s"
+    offset_struct = struct.Struct(byte_order + offset)
+    count_struct = struct.Struct(byte_order + entry_count)
+    entry_struct = struct.Struct(byte_order + entry)
+
+    image_file.seek(offset_struct.unpack_from(header, 8 if bigtiff else 4)[0])
+    count_data = image_file.read(count_struct.size)
+    if len(count_data) < count_struct.size:
+        return False
+    count = min(count_struct.unpack(count_data)[0], MAX_SNIFFED_ENTRY_COUNT)
+    entries = image_file.read(count * entry_struct.size)
+    for tag_id, _, value_count, value in entry_struct.iter_unpack(
+        entries[: len(entries) - len(entries) % entry_struct.size]
+    ):
+        if tag_id != IMAGE_DESCRIPTION_ID:
+            continue
+        if value_count <= len(value):
+            description = value[:value_count]
+        else:
+            image_file.seek(offset_struct.unpack(value)[0])
+            description = image_file.read(min(value_count, MAX_SNIFFED_DESCRIPTION_LENGTH))
+        return b"aperio" in description.lower()
+    return False
+
+
+def is_svs_ifds(ifds: list[IFD]) -> bool:
+    if IMAGE_DESCRIPTION_ID not in ifds[0]["tags"]:
         return False
-    image_description = image_info["ifds"][0]["tags"][tifftools.Tag.ImageDescription.value]["data"]
+    image_description = ifds[0]["tags"][IMAGE_DESCRIPTION_ID]["data"]
     return "aperio" in str(image_description).lower()
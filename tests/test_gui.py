@@ -1,9 +1,34 @@
+from functools import partial
+import gzip
+from io import BytesIO
+from itertools import accumulate
+import json
+import os
 from pathlib import Path
+import pickle
+import struct
+import threading
+import time
+from typing import TYPE_CHECKING, cast
+import zlib
 
+from PIL import Image, ImageChops, ImageStat
+from fastapi import FastAPI
 from fastapi.testclient import TestClient
 import pytest
+import tifftools
+import yaml
 
+from imagedephi.gui import plan_store
 from imagedephi.gui.app import app
+from imagedephi.gui.static_files import IMMUTABLE_CACHE_CONTROL, PrecompressedStaticFiles
+from imagedephi.gui.thumbnail_scheduler import ThumbnailScheduler
+from imagedephi.redact import PlanSession, redact
+from imagedephi.utils import associated_images
+from imagedephi.utils.progress_log import progress_broadcaster, push_progress
+
+if TYPE_CHECKING:
+    from tifftools.tifftools import IFD, TagEntry
 
 
 @pytest.fixture
@@ -41,6 +66,40 @@ def test_gui_select_directory_not_found(
     assert response.json() == {"detail": "Input directory not found"}
 
 
+def test_gui_select_directory_listing(
+    client: TestClient,
+    tmp_path: Path,
+) -> None:
+    (tmp_path / "child").mkdir()
+    (tmp_path / "rules.yaml").touch()
+    (tmp_path / "notes.txt").touch()
+
+    response = client.get(
+        app.url_path_for("select_directory"), params={"directory": str(tmp_path), "limit": 10}
+    )
+
+    assert response.status_code == 200
+    directory_data = response.json()[0]["directory_data"]
+    assert directory_data["child_directories"] == [
+        {"name": "child", "path": str(tmp_path / "child")}
+    ]
+    assert directory_data["child_yaml_files"] == [
+        {"name": "rules.yaml", "path": str(tmp_path / "rules.yaml")}
+    ]
+    assert directory_data["child_images"] == []
+    assert directory_data["file_count"] == 2
+    assert directory_data["images_complete"]
+
+    # Changing the directory contents invalidates the cached listing
+    (tmp_path / "more_rules.yaml").touch()
+    # Make sure the change is visible, even with a coarse file system timestamp resolution
+    mtime_ns = tmp_path.stat().st_mtime_ns + 1_000_000_000
+    os.utime(tmp_path, ns=(mtime_ns, mtime_ns))
+    response = client.get(app.url_path_for("select_directory"), params={"directory": str(tmp_path)})
+
+    assert len(response.json()[0]["directory_data"]["child_yaml_files"]) == 2
+
+
 def test_gui_redact(
     client: TestClient,
     tmp_path: Path,
@@ -121,3 +180,439 @@ def test_gui_redact_no_rename(
     assert response.status_code == 200
     output_file = tmp_path / "Redacted_2023-05-12_12-12-53" / "test_image.tif"
     assert output_file.exists()
+
+
+@pytest.mark.timeout(5)
+def test_gui_websocket_progress(
+    client: TestClient,
+    tmp_path: Path,
+) -> None:
+    with client.websocket_connect("/ws") as websocket:
+        # Wait for the server to register the subscription
+        while not progress_broadcaster.subscriber_count:
+            time.sleep(0.01)
+        push_progress(3, 3, tmp_path / "Redacted_test")
+
+        assert websocket.receive_json() == {"count": 3, "max": 3, "redact_dir": "Redacted_test"}
+
+
+@pytest.mark.timeout(10)
+def test_gui_job(
+    client: TestClient,
+    tmp_path: Path,
+) -> None:
+    response = client.post(
+        app.url_path_for("create_job"),
+        params={"input_directory": str(tmp_path), "output_directory": str(tmp_path)},
+    )
+
+    assert response.status_code == 200
+    job_id = response.json()["job_id"]
+
+    status = response.json()["status"]
+    while status not in ["completed", "failed", "cancelled"]:
+        status = client.get(app.url_path_for("get_job_status", job_id=job_id)).json()["status"]
+    assert status == "completed"
+
+    response = client.get(app.url_path_for("get_job_throughput", job_id=job_id))
+    assert response.status_code == 200
+    assert response.json()["eta"] is None
+
+
+@pytest.mark.timeout(10)
+def test_gui_job_planned_images(client: TestClient, tmp_path: Path, mocker) -> None:
+    image_dir = tmp_path / "images"
+    image_dir.mkdir()
+    Image.new("RGB", (64, 64)).save(image_dir / "image.tif", tiffinfo={305: "Scanner"})
+    response = client.get(
+        app.url_path_for("get_redaction_plan"), params={"input_directory": str(image_dir)}
+    )
+    assert "image.tif" in response.json()["data"]
+    spy = mocker.spy(redact, "build_redaction_plan")
+
+    response = client.post(
+        app.url_path_for("create_job"),
+        params={"input_directory": str(image_dir), "output_directory": str(tmp_path)},
+    )
+    job_id = response.json()["job_id"]
+    status = response.json()["status"]
+    while status not in ["completed", "failed", "cancelled"]:
+        status = client.get(app.url_path_for("get_job_status", job_id=job_id)).json()["status"]
+
+    # The plan made for display is executed, rather than planning the image again
+    assert status == "completed"
+    assert spy.call_count == 0
+    assert len(list(tmp_path.glob("Redacted_*/*.tif"))) == 1
+
+
+def test_gui_job_input_failure(
+    client: TestClient,
+    tmp_path: Path,
+) -> None:
+    response = client.post(
+        app.url_path_for("create_job"),
+        params={"input_directory": str(tmp_path / "fake"), "output_directory": str(tmp_path)},
+    )
+
+    assert response.status_code == 404
+    assert response.json() == {"detail": "Input directory not found"}
+
+
+def test_gui_job_not_found(client: TestClient) -> None:
+    response = client.get(app.url_path_for("get_job_status", job_id="fake"))
+    assert response.status_code == 404
+
+    response = client.post(app.url_path_for("cancel_job", job_id="fake"))
+    assert response.status_code == 404
+
+
+def test_gui_associated_images_batch(
+    client: TestClient,
+    tmp_path: Path,
+) -> None:
+    (tmp_path / "notes.txt").write_text("not an image")
+    response = client.post(
+        app.url_path_for("get_associated_images"),
+        json=[
+            {"file_name": str(tmp_path / "notes.txt"), "image_key": "thumbnail"},
+            {"file_name": str(tmp_path / "notes.txt"), "image_key": "fake"},
+            {"file_name": str(tmp_path / "fake.svs"), "image_key": "label"},
+        ],
+    )
+
+    assert response.status_code == 200
+    headers = []
+    content = response.content
+    while content:
+        (header_length,) = struct.unpack(">I", content[:4])
+        header = json.loads(content[4 : 4 + header_length])
+        headers.append(header)
+        content = content[4 + header_length + header["length"] :]
+    # Every request gets a frame, even if the image couldn't be extracted
+    assert sorted((header["image_key"], header["status"]) for header in headers) == [
+        ("fake", 400),
+        ("label", 404),
+        ("thumbnail", 404),
+    ]
+
+
+def test_gui_associated_image_extractor(tmp_path: Path, mocker) -> None:
+    image_path = tmp_path / "image.tif"
+    Image.new("RGB", (64, 64)).save(image_path)
+    spy = mocker.spy(associated_images, "read_tiff_info")
+
+    extract = associated_images.get_associated_image_extractor(str(image_path), "thumbnail")
+    associated_images.get_associated_image_extractor(str(image_path), "thumbnail")
+    # The file is parsed once, and only decoding is sent to worker processes
+    assert spy.call_count == 1
+    thumbnail = Image.open(BytesIO(pickle.loads(pickle.dumps(extract))()))
+    assert thumbnail.format == "JPEG"
+
+
+def test_gui_associated_image_slides(mocker) -> None:
+    mocker.patch.object(associated_images, "MAX_CACHED_SOURCES", 1)
+    open_slide = mocker.patch.object(associated_images.WsiDicom, "open")
+    slides = [mocker.Mock(name="first"), mocker.Mock(name="second")]
+    open_slide.side_effect = slides
+    mocker.patch.object(
+        associated_images, "get_image_bytes_from_dicom_slide", return_value=BytesIO(b"image")
+    )
+
+    associated_images._extract_dicom_image((Path("first.dcm"),), "label", "first.dcm", 64, 64)
+    associated_images._extract_dicom_image((Path("second.dcm"),), "label", "second.dcm", 64, 64)
+    # Evicted slides are closed, since each holds the files of its series open
+    slides[0].close.assert_called_once()
+    slides[1].close.assert_not_called()
+
+    associated_images.close_slides()
+    slides[1].close.assert_called_once()
+
+
+def test_gui_redaction_plan_empty(
+    client: TestClient,
+    tmp_path: Path,
+) -> None:
+    response = client.get(
+        app.url_path_for("get_redaction_plan"),
+        params={"input_directory": str(tmp_path), "update": False},
+    )
+
+    assert response.status_code == 200
+    assert response.json() == {
+        "data": {},
+        "total": 0,
+        "tags": [],
+        "missing_rules": False,
+        "complete": True,
+    }
+
+
+def test_gui_redaction_plan_summary(client: TestClient, tmp_path: Path) -> None:
+    Image.new("RGB", (64, 64)).save(tmp_path / "image.tif", tiffinfo={305: "x" * 1000})
+
+    response = client.get(
+        app.url_path_for("get_redaction_plan"), params={"input_directory": str(tmp_path)}
+    )
+    # Long values are truncated in the browser, but reported in full on the command line
+    software = response.json()["data"]["image.tif"]["Software"]
+    assert software["length"] == 1000
+    assert len(software["value"]) < 1000
+    session = PlanSession()
+    redact.show_redaction_plan([tmp_path / "image.tif"], session=session)
+    report = session.get_report("image.tif")
+    assert report is not None
+    assert report["Software"]["value"] == "x" * 1000
+
+
+def test_gui_redaction_plan_cached(
+    client: TestClient,
+    data_dir: Path,
+    test_image_svs: Path,
+    mocker,
+) -> None:
+    spy = mocker.spy(plan_store, "build_redaction_plan")
+    params = {"input_directory": str(data_dir / "input" / "svs"), "limit": 1}
+
+    response = client.get(
+        app.url_path_for("get_redaction_plan"), params={**params, "update": False}
+    )
+    assert response.status_code == 200
+    assert test_image_svs.name in response.json()["data"]
+    call_count = spy.call_count
+
+    # Paging through an unchanged directory does not build plans again
+    response = client.get(app.url_path_for("get_redaction_plan"), params={**params, "update": True})
+    assert response.status_code == 200
+    assert spy.call_count == call_count
+
+
+def test_gui_redaction_plan_rule_edit(client: TestClient, tmp_path: Path, mocker) -> None:
+    image_dir = tmp_path / "images"
+    image_dir.mkdir()
+    Image.new("RGB", (64, 64)).save(image_dir / "artist.tif", tiffinfo={315: "Someone"})
+    Image.new("RGB", (64, 64)).save(image_dir / "software.tif", tiffinfo={305: "Scanner"})
+    rules_path = tmp_path / "rules.yaml"
+    rules_path.write_text(yaml.safe_dump({"tiff": {"metadata": {"Artist": {"action": "keep"}}}}))
+    spy = mocker.spy(plan_store, "build_redaction_plan")
+    params = {"input_directory": str(image_dir), "rules_path": str(rules_path), "limit": 10}
+
+    response = client.get(app.url_path_for("get_redaction_plan"), params=params)
+    assert response.json()["data"]["artist.tif"]["Artist"]["action"] == "keep"
+    assert spy.call_count == 2
+
+    # Only the image with the edited rule's tag is planned again
+    rules_path.write_text(yaml.safe_dump({"tiff": {"metadata": {"Artist": {"action": "delete"}}}}))
+    response = client.get(app.url_path_for("get_redaction_plan"), params=params)
+    assert response.json()["data"]["artist.tif"]["Artist"]["action"] == "delete"
+    assert response.json()["data"]["software.tif"]["Software"]["action"] == "delete"
+    assert [call.args[0].name for call in spy.call_args_list[2:]] == ["artist.tif"]
+
+
+def test_gui_thumbnail_scheduler() -> None:
+    scheduler = ThumbnailScheduler(max_workers=1, use_processes=False)
+    started = threading.Event()
+    unblock = threading.Event()
+    order: list[str] = []
+
+    def block() -> str:
+        started.set()
+        unblock.wait()
+        return "block"
+
+    def record(name: str) -> str:
+        order.append(name)
+        return name
+
+    blocking = scheduler.submit("block", block, (scheduler.new_viewport(), 0))
+    started.wait()
+
+    old_viewport = scheduler.new_viewport()
+    old = scheduler.submit("old", partial(record, "old"), (old_viewport, 0))
+    abandoned = scheduler.submit("abandoned", partial(record, "abandoned"), (old_viewport, 1))
+    new_viewport = scheduler.new_viewport()
+    new = scheduler.submit("new", partial(record, "new"), (new_viewport, 0))
+    # Identical requests share the same work
+    assert scheduler.submit("new", partial(record, "duplicate"), (new_viewport, 1)) is new
+    scheduler.release(abandoned)
+
+    unblock.set()
+    assert blocking.future.result() == "block"
+    assert old.future.result() == "old"
+    assert new.future.result() == "new"
+    # The newest viewport runs first, and abandoned work never runs
+    assert order == ["new", "old"]
+    assert abandoned.future.cancelled()
+    scheduler.shutdown()
+
+
+def test_gui_thumbnail_scheduler_priority() -> None:
+    scheduler = ThumbnailScheduler(max_workers=1, use_processes=False)
+    started = threading.Event()
+    unblock = threading.Event()
+    order: list[str] = []
+
+    def block() -> None:
+        started.set()
+        unblock.wait()
+
+    def record(name: str) -> str:
+        order.append(name)
+        return name
+
+    scheduler.submit("block", block, (scheduler.new_viewport(), 0))
+    started.wait()
+
+    viewport = scheduler.new_viewport()
+    shown = scheduler.submit("shown", partial(record, "shown"), (viewport, 0))
+    next_row = scheduler.submit("next_row", partial(record, "next_row"), (viewport, 1))
+    prefetched = scheduler.submit("prefetched", partial(record, "prefetched"), (viewport, 3))
+    # A less urgent request for the same key doesn't move it down, but a more urgent one moves it up
+    assert scheduler.submit("shown", partial(record, "shown"), (viewport, 5)) is shown
+    assert scheduler.submit("prefetched", partial(record, "prefetched"), (viewport, 0)) is (
+        prefetched
+    )
+
+    unblock.set()
+    assert [task.future.result() for task in [shown, next_row, prefetched]] == [
+        "shown",
+        "next_row",
+        "prefetched",
+    ]
+    assert order == ["shown", "prefetched", "next_row"]
+    scheduler.shutdown()
+
+
+def test_gui_tiles(client: TestClient, test_image_svs: Path) -> None:
+    params = {"file_name": str(test_image_svs)}
+    response = client.get(app.url_path_for("get_tile_info"), params=params)
+    assert response.status_code == 200
+    info = response.json()
+    assert info["levels"][0]["width"] == info["width"]
+
+    for level in info["levels"]:
+        # Check the last tile, which may be an edge tile that is cropped to the image
+        x, y = level["tiles_across"] - 1, level["tiles_down"] - 1
+        response = client.get(
+            app.url_path_for("get_tile", level=level["level"], x=x, y=y), params=params
+        )
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "image/jpeg"
+        tile = Image.open(BytesIO(response.content))
+        assert tile.size == (
+            min(level["tile_width"], level["width"] - x * level["tile_width"]),
+            min(level["tile_height"], level["height"] - y * level["tile_height"]),
+        )
+
+    response = client.get(
+        app.url_path_for("get_tile", level=len(info["levels"]), x=0, y=0), params=params
+    )
+    assert response.status_code == 404
+
+
+def _write_tiled_tiff(path: Path, image: Image.Image, tile_size: int, compression: int) -> None:
+    """Write an RGB image as a tiled TIFF, with JPEG (7) or otherwise Deflate compressed tiles."""
+    tiles = []
+    for y in range(0, image.height, tile_size):
+        for x in range(0, image.width, tile_size):
+            # Edge tiles are padded to the full tile size
+            tile = image.crop((x, y, x + tile_size, y + tile_size))
+            if compression == 7:
+                tile_buffer = BytesIO()
+                tile.save(tile_buffer, "JPEG")
+                tiles.append(tile_buffer.getvalue())
+            else:
+                tiles.append(zlib.compress(tile.tobytes()))
+    offsets = list(accumulate([len(tile) for tile in tiles[:-1]], initial=8))
+    data = bytes(8) + b"".join(tiles)
+    long_tags = {
+        tifftools.Tag.ImageWidth: [image.width],
+        tifftools.Tag.ImageLength: [image.height],
+        tifftools.Tag.TileWidth: [tile_size],
+        tifftools.Tag.TileLength: [tile_size],
+        tifftools.Tag.TileOffsets: offsets,
+        tifftools.Tag.TileByteCounts: [len(tile) for tile in tiles],
+    }
+    short_tags = {
+        tifftools.Tag.BitsPerSample: [8, 8, 8],
+        tifftools.Tag.Compression: [compression],
+        tifftools.Tag.Photometric: [6 if compression == 7 else 2],
+        tifftools.Tag.SamplesPerPixel: [3],
+        tifftools.Tag.PlanarConfig: [1],
+    }
+    tags = {
+        tag.value: cast("TagEntry", {"datatype": datatype.value, "data": values})
+        for datatype, tag_values in [
+            (tifftools.Datatype.LONG, long_tags),
+            (tifftools.Datatype.SHORT, short_tags),
+        ]
+        for tag, values in tag_values.items()
+    }
+    tifftools.write_tiff(
+        cast("IFD", {"tags": tags, "path_or_fobj": BytesIO(data), "size": len(data)}), path
+    )
+
+
+@pytest.mark.parametrize("compression", [7, 8], ids=["jpeg", "deflate"])
+def test_gui_tiles_compression(client: TestClient, tmp_path: Path, compression: int) -> None:
+    image = Image.linear_gradient("L").resize((300, 200)).convert("RGB")
+    image_path = tmp_path / "tiled.tif"
+    _write_tiled_tiff(image_path, image, 128, compression)
+    params = {"file_name": str(image_path)}
+
+    for x, y in [(0, 0), (2, 1)]:
+        response = client.get(app.url_path_for("get_tile", level=0, x=x, y=y), params=params)
+        assert response.status_code == 200
+        tile = Image.open(BytesIO(response.content))
+        assert tile.format == "JPEG"
+        # The last tile is at the edge of the image, and is cropped to it
+        expected = image.crop((x * 128, y * 128, min(x * 128 + 128, 300), min(y * 128 + 128, 200)))
+        assert tile.size == expected.size
+        difference = ImageChops.difference(tile.convert("RGB"), expected)
+        assert max(high for _, high in ImageStat.Stat(difference).extrema) < 16
+
+
+def test_gui_tiles_unsupported_compression(client: TestClient, tmp_path: Path) -> None:
+    image_path = tmp_path / "tiled.tif"
+    # LERC compression
+    _write_tiled_tiff(image_path, Image.new("RGB", (64, 64)), 64, 34887)
+
+    response = client.get(app.url_path_for("get_tile_info"), params={"file_name": str(image_path)})
+    assert response.status_code == 415
+
+
+def test_gui_tiles_not_tiled(client: TestClient, tmp_path: Path) -> None:
+    text_file = tmp_path / "not_an_image.txt"
+    text_file.write_text("not an image")
+
+    response = client.get(app.url_path_for("get_tile_info"), params={"file_name": str(text_file)})
+    assert response.status_code == 404
+
+    response = client.get(
+        app.url_path_for("get_tile", level=0, x=0, y=0),
+        params={"file_name": str(tmp_path / "missing.svs")},
+    )
+    assert response.status_code == 404
+
+
+def test_gui_precompressed_static_files(tmp_path: Path) -> None:
+    script = b"console.log('hello');" * 100
+    (tmp_path / "index-1234.js").write_bytes(script)
+    (tmp_path / "index-1234.js.gz").write_bytes(gzip.compress(script))
+    static_app = FastAPI()
+    static_app.mount("/assets", PrecompressedStaticFiles(directory=tmp_path, immutable=True))
+    static_client = TestClient(static_app)
+
+    response = static_client.get("/assets/index-1234.js", headers={"Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["content-type"].startswith("text/javascript")
+    assert response.headers["cache-control"] == IMMUTABLE_CACHE_CONTROL
+    assert response.content == script
+
+    # Clients that don't accept a precompressed variant get the original file
+    response = static_client.get(
+        "/assets/index-1234.js", headers={"Accept-Encoding": "br, gzip;q=0"}
+    )
+    assert response.status_code == 200
+    assert "content-encoding" not in response.headers
+    assert response.content == script
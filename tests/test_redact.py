@@ -1,18 +1,43 @@
+from array import array
 import datetime
 import importlib.resources
 import logging
 from pathlib import Path, PurePath
 import struct
+import threading
+from typing import TYPE_CHECKING, cast
 
+from PIL import Image, TiffImagePlugin
 from freezegun import freeze_time
 import pytest
+import tifftools
 import yaml
 
 from imagedephi import redact
+from imagedephi.redact.build_redaction_plan import build_redaction_plan, get_changed_rule_keys
+from imagedephi.redact.census import take_census
+from imagedephi.redact.plan_session import ImageReport, PlanQuery, PlanSession, to_columnar
+from imagedephi.redact.plan_template import PlanTemplateCache
 from imagedephi.redact.redact import ProfileChoice, create_redact_dir_and_manifest
-from imagedephi.redact.svs import SvsRedactionPlan
-from imagedephi.rules import KeepRule, Ruleset
+from imagedephi.redact.redaction_plan import (
+    MAX_REPORT_BINARY_BYTES,
+    MAX_REPORT_LIST_LENGTH,
+    PlanOutdatedError,
+    ReportDetail,
+    report_tag_entry,
+)
+from imagedephi.redact.svs import SvsDescription, SvsRedactionPlan
+from imagedephi.redact.tiff import (
+    TiffRedactionPlan,
+    UnsupportedFileTypeError,
+    get_blank_image_ifd,
+)
+from imagedephi.rules import FileFormat, KeepRule, Ruleset
 from imagedephi.utils.logger import logger
+from imagedephi.utils.tiff import IfdRole, IfdTraversal, read_tiff_info
+
+if TYPE_CHECKING:
+    from tifftools.tifftools import IFD, TagEntry
 
 
 @pytest.fixture
@@ -100,6 +125,317 @@ def test_redact_svs_no_extension(mocker, test_image_svs_no_extension, tmp_path):
     assert spy.call_count == 1
 
 
+def test_redact_cancelled_failed_manifest(tmp_path: Path):
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    Image.new("RGB", (64, 64)).save(input_dir / "a_private.tif", tiffinfo={65000: "Private"})
+    Image.new("RGB", (64, 64)).save(input_dir / "b.tif", tiffinfo={305: "Scanner"})
+    cancel_event = threading.Event()
+
+    # Cancel the run after the first image, which can't be redacted
+    redact_dir = redact.redact_images(
+        [input_dir],
+        tmp_path,
+        progress_callback=lambda count, total, path: cancel_event.set(),
+        cancel_event=cancel_event,
+    )
+
+    assert not list(redact_dir.iterdir())
+    run_name = redact_dir.name.removeprefix("Redacted_")
+    failed_manifest_file = tmp_path / f"Failed_{run_name}" / f"Failed_{run_name}_manifest.yaml"
+    failed_manifest = list(yaml.safe_load_all(failed_manifest_file.read_text()))[0]
+    assert [list(image) for image in failed_manifest["failed_images"]] == [["a_private.tif"]]
+    assert failed_manifest["failed_images_count"] == 1
+    assert failed_manifest["command"].endswith(f"--output-dir {tmp_path} --index 1")
+
+
+def test_plan_session_eviction():
+    session = PlanSession(max_images=2)
+    session.add_report("a.tif", {"missing_tags": []}, comprehensive=False)
+    session.add_report("b.tif", {"Make": {"action": "keep"}}, comprehensive=True)
+    session.add_report("c.tif", {"Model": {"action": "delete"}}, comprehensive=True)
+
+    # The least recently added report is evicted, but still counted in other summaries
+    assert list(session.get_page()) == ["b.tif", "c.tif"]
+    assert session.total == 2
+    assert session.query(PlanQuery(sort_by="name")) == (session.get_page(), 2)
+    assert session.evicted_images == ["a.tif"]
+    assert session.tags_used == ["missing_tags", "Make", "Model"]
+    assert session.missing_rules
+
+    session.remove(Path("a.tif"))
+    assert session.total == 2
+    assert session.evicted_images == []
+    assert not session.missing_rules
+
+
+def test_plan_release(tmp_path: Path, base_rule_set: Ruleset):
+    image_path = tmp_path / "plain.tif"
+    Image.new("RGB", (64, 64)).save(image_path, tiffinfo={305: "Scanner software"})
+    redaction_plan = build_redaction_plan(image_path, base_rule_set)
+    report = redaction_plan.report_plan()
+
+    # Released plans read the file again when needed
+    redaction_plan.release()
+    assert redaction_plan.report_plan() == report
+    redaction_plan.execute_plan()
+    redaction_plan.save(tmp_path / "redacted.tif", overwrite=False)
+    assert (tmp_path / "redacted.tif").exists()
+
+    # Plans can't be executed once the file has changed
+    redaction_plan = build_redaction_plan(image_path, base_rule_set)
+    redaction_plan.release()
+    Image.new("RGB", (32, 32)).save(image_path, tiffinfo={305: "Other software"})
+    assert redaction_plan.is_outdated()
+    with pytest.raises(PlanOutdatedError):
+        redaction_plan.execute_plan()
+
+
+def test_ifd_traversal(tmp_path: Path):
+    image_path = tmp_path / "exif.tif"
+    Image.new("RGB", (64, 64)).save(image_path, tiffinfo={305: "Scanner software"})
+    tiff_info = tifftools.read_tiff(image_path)
+    exposure_time_entry = cast(
+        "TagEntry", {"datatype": tifftools.Datatype.RATIONAL.value, "data": [1, 100]}
+    )
+    exif_ifd = cast(
+        "IFD", {"tags": {tifftools.constants.EXIFTag["ExposureTime"].value: exposure_time_entry}}
+    )
+    tiff_info["ifds"][0]["tags"][tifftools.Tag["EXIFIFD"].value] = cast(
+        "TagEntry", {"datatype": tifftools.Datatype.IFD.value, "ifds": [[exif_ifd]]}
+    )
+    tifftools.write_tiff(tiff_info, image_path, allowExisting=True)
+
+    traversal = IfdTraversal(tifftools.read_tiff(image_path)["ifds"])
+
+    # Sub-IFDs are visited before the IFD referencing them
+    assert [(visited.role, visited.depth) for visited in traversal.ifds] == [
+        (IfdRole.SubIfd, 1),
+        (IfdRole.Associated, 0),
+    ]
+    tag_names = [tag.name for tag, _ in traversal.tag_entries]
+    assert tag_names.index("Software") < tag_names.index("ExposureTime")
+    assert "EXIFIFD" not in tag_names
+
+
+def test_offset_arrays(tmp_path: Path, base_rule_set: Ruleset):
+    image_path = tmp_path / "plain.tif"
+    Image.new("RGB", (64, 64)).save(image_path)
+    tiff_info = read_tiff_info(image_path)
+    strip_offsets = tiff_info["ifds"][0]["tags"][tifftools.Tag["StripOffsets"].value]["data"]
+    assert isinstance(strip_offsets, array)
+
+    redaction_plan = build_redaction_plan(image_path, base_rule_set)
+    assert isinstance(redaction_plan, TiffRedactionPlan)
+    assert redaction_plan.passes_type_check(array("Q", [1, 2]), [int], 2)
+    assert not redaction_plan.passes_type_check(array("Q", [1, 2]), [int], 3)
+    assert not redaction_plan.passes_type_check(array("d", [1.0, 2.0]), [int], 2)
+
+    # Arrays are written like lists
+    tifftools.write_tiff(tiff_info, tmp_path / "copy.tif")
+    with Image.open(tmp_path / "copy.tif") as image_copy:
+        assert image_copy.size == (64, 64)
+
+
+def test_plan_templates(tmp_path: Path, base_rule_set: Ruleset):
+    for name, software in [("first.tif", "Scanner"), ("second.tif", "Other scanner")]:
+        Image.new("RGB", (64, 64)).save(tmp_path / name, tiffinfo={305: software})
+    Image.new("RGB", (64, 64)).save(tmp_path / "other_tags.tif", tiffinfo={315: "Artist"})
+    plan_templates = PlanTemplateCache()
+
+    first_plan = build_redaction_plan(
+        tmp_path / "first.tif", base_rule_set, plan_templates=plan_templates
+    )
+    second_plan = build_redaction_plan(
+        tmp_path / "second.tif", base_rule_set, plan_templates=plan_templates
+    )
+    assert (plan_templates.hits, plan_templates.misses) == (1, 1)
+    assert isinstance(first_plan, TiffRedactionPlan)
+    assert isinstance(second_plan, TiffRedactionPlan)
+    assert second_plan.metadata_redaction_steps == first_plan.metadata_redaction_steps
+    # Plans don't share their steps with the cached template
+    assert second_plan.metadata_redaction_steps is not first_plan.metadata_redaction_steps
+    # Values are still reported for each image
+    software_report = second_plan.report_plan()["second.tif"]["Software"]
+    assert isinstance(software_report, dict)
+    assert software_report["value"] == "Other scanner"
+
+    build_redaction_plan(tmp_path / "other_tags.tif", base_rule_set, plan_templates=plan_templates)
+    assert (plan_templates.hits, plan_templates.misses) == (1, 2)
+
+
+@pytest.mark.parametrize("size", [(400, 300), (1000, 720), (50, 3)])
+def test_blank_image_ifd(tmp_path: Path, size: tuple[int, int]):
+    blank_ifd = get_blank_image_ifd(*size)
+    blank_ifd["tags"][tifftools.Tag["ImageDescription"].value] = cast(
+        "TagEntry", {"datatype": tifftools.Datatype.ASCII.value, "data": "label"}
+    )
+    tifftools.write_tiff([blank_ifd], tmp_path / "blank.tif")
+
+    with Image.open(tmp_path / "blank.tif") as blank_image:
+        assert isinstance(blank_image, TiffImagePlugin.TiffImageFile)
+        assert blank_image.size == size
+        assert blank_image.getextrema() == ((0, 0), (0, 0), (0, 0))
+        assert blank_image.tag_v2[tifftools.Tag["ImageDescription"].value] == "label"
+    # Each IFD from the cache can be modified separately
+    assert tifftools.Tag["ImageDescription"].value not in get_blank_image_ifd(*size)["tags"]
+
+
+def test_changed_rule_keys(tmp_path: Path, base_rule_set: Ruleset):
+    image_path = tmp_path / "plain.tif"
+    Image.new("RGB", (64, 64)).save(image_path, tiffinfo={305: "Scanner"})
+    redaction_plan = build_redaction_plan(image_path, base_rule_set)
+    assert "tiff.metadata.Software" in redaction_plan.rule_keys
+    assert "tiff.metadata.Artist" not in redaction_plan.rule_keys
+
+    override_rule_set = Ruleset.model_validate(
+        {"tiff": {"metadata": {"Artist": {"action": "keep"}}}, "svs": {"associated_images": {}}}
+    )
+    assert get_changed_rule_keys((base_rule_set, None), (base_rule_set, override_rule_set)) == {
+        "tiff.metadata.Artist"
+    }
+    # Strict rules can affect any tag
+    strict_rule_set = Ruleset.model_validate({"strict": True})
+    assert get_changed_rule_keys((base_rule_set, None), (base_rule_set, strict_rule_set)) is None
+
+
+def test_take_census(tmp_path: Path, base_rule_set: Ruleset):
+    for name, software in [("first.tif", "Scanner"), ("second.tif", "Other scanner")]:
+        Image.new("RGB", (64, 64)).save(tmp_path / name, tiffinfo={305: software})
+    Image.new("RGB", (64, 64)).save(tmp_path / "private.tif", tiffinfo={65000: "Private"})
+    # NDPI_FORMAT_FLAG marks a file that plans don't support
+    Image.new("RGB", (64, 64)).save(tmp_path / "ndpi.tif", tiffinfo={65420: 1})
+    (tmp_path / "unreadable.tif").write_bytes(b"II*\x00")
+
+    census = take_census([tmp_path])
+
+    assert census.image_count == 3
+    assert census.complete
+    assert sorted(census.unprocessable) == [tmp_path / "ndpi.tif", tmp_path / "unreadable.tif"]
+    with pytest.raises(UnsupportedFileTypeError):
+        build_redaction_plan(tmp_path / "ndpi.tif", base_rule_set)
+    assert "not supported" in census.unprocessable[tmp_path / "ndpi.tif"]
+    software_entry = census.entries[FileFormat.TIFF, "metadata", "Software (305)"]
+    assert software_entry.covered
+    assert (software_entry.count, software_entry.example) == (2, tmp_path / "first.tif")
+    # The census agrees with the plan of each image
+    private_plan = build_redaction_plan(tmp_path / "private.tif", base_rule_set)
+    assert isinstance(private_plan, TiffRedactionPlan)
+    assert [tag.value for tag in private_plan.no_match_tags] == [65000]
+    assert [(entry.label, entry.count) for entry in census.uncovered] == [("65000 (65000)", 1)]
+
+    census = take_census([tmp_path], fail_fast=True, max_workers=1)
+    assert census.uncovered
+    assert census.image_count < 3
+
+
+def test_svs_description():
+    description_string = (
+        "Aperio Image Library v10.0.50|AppMag = 40|MPP = 0.25|User = a=b-c|Date = 12/29/09"
+    )
+    with pytest.raises(ValueError):
+        SvsDescription(description_string)
+
+    description_string = "Aperio Image Library v10.0.50|AppMag = 40|MPP = 0.25|Date = 12/29/09"
+    svs_description = SvsDescription(description_string)
+    assert svs_description.metadata == {"AppMag": 40, "MPP": 0.25, "Date": "12/29/09"}
+    assert str(svs_description) == description_string
+
+    # Copies are redacted separately
+    redacted_description = svs_description.copy()
+    del redacted_description.metadata["Date"]
+    assert str(svs_description) == description_string
+
+
+def test_image_report():
+    tags = {
+        "missing_tags": [{65000: "Unknown"}],
+        "ICC Profile": {"action": "delete", "binary": {"value": "0x00", "bytes": 1}},
+        "Make": {"action": "keep", "value": "x"},
+        "Model": {"action": "delete"},
+        "Other": {"action": "unknown", "value": None},
+        "associated_images": 2,
+    }
+    report = ImageReport(tags)
+
+    # Reports are stored compactly, but read back as they were given
+    assert report.to_dict() == tags
+    assert list(report.to_dict()) == list(tags)
+    assert report["Make"] == {"action": "keep", "value": "x"}
+    assert "Model" in report
+    assert "Serial" not in report
+
+
+def test_image_report_iteration(mocker):
+    report = ImageReport({f"Tag {index}": {"action": "keep", "value": index} for index in range(8)})
+    spy = mocker.spy(ImageReport, "__getitem__")
+
+    # Iterating doesn't look up each key
+    assert list(report.items()) == list(report.to_dict().items())
+    assert list(report.values()) == list(report.to_dict().values())
+    assert spy.call_count == 0
+
+
+def test_report_tag_entry():
+    blob = bytes(range(256)) * 4
+    offsets = list(range(1000))
+
+    assert report_tag_entry("keep", offsets, ReportDetail.Decisions) == {"action": "keep"}
+    assert report_tag_entry("keep", offsets, ReportDetail.Full)["value"] == offsets
+
+    # Large values are truncated, but keep their size
+    summary = report_tag_entry("keep", offsets, ReportDetail.Summary)
+    assert summary["value"] == offsets[:MAX_REPORT_LIST_LENGTH]
+    assert summary["count"] == len(offsets)
+
+    binary = report_tag_entry("delete", blob, ReportDetail.Summary, binary=True)["binary"]
+    assert binary["value"] == "0x" + blob[:MAX_REPORT_BINARY_BYTES].hex()
+    assert binary["bytes"] == len(blob)
+    assert binary["sha256"]
+    binary = report_tag_entry("delete", blob, ReportDetail.Full, binary=True)["binary"]
+    assert binary["value"] == "0x" + blob.hex()
+
+
+def test_plan_session_query():
+    session = PlanSession()
+    session.add_report("a.tif", {"missing_tags": [{"Make": "x"}]}, comprehensive=False)
+    session.add_report("b.tif", {"Make": {"action": "keep", "value": "z"}}, comprehensive=True)
+    session.add_report("c.tif", {"Make": {"action": "delete", "value": "y"}}, comprehensive=True)
+
+    data, total = session.query(PlanQuery(action="delete"))
+    assert list(data) == ["c.tif"]
+    assert total == 1
+
+    data, total = session.query(PlanQuery(sort_by="Make"), limit=2, offset=0)
+    assert list(data) == ["c.tif", "b.tif"]
+    assert total == 3
+
+    data, _ = session.query(PlanQuery(sort_by="Make", descending=True))
+    assert list(data) == ["b.tif", "c.tif", "a.tif"]
+
+    data, _ = session.query(PlanQuery(filename="A", columns=[]))
+    assert to_columnar(data) == {
+        "images": ["a.tif"],
+        "actions": {},
+        "values": {},
+        "details": {},
+        "columns": {"missing_tags": [[{"Make": "x"}]]},
+    }
+    data, _ = session.query(PlanQuery(sort_by="name"))
+    assert to_columnar(data)["actions"] == {"Make": [None, "keep", "delete"]}
+    assert to_columnar(data)["values"] == {"Make": [None, "z", "y"]}
+
+
+def test_plan_session_shared(svs_input_paths, override_rule_set):
+    session = PlanSession()
+    first = redact.show_redaction_plan(svs_input_paths, override_rule_set, session=session)
+    # Planning the same images again into the same session doesn't duplicate them
+    second = redact.show_redaction_plan(svs_input_paths, override_rule_set, session=session)
+
+    assert first.total == second.total == session.total
+    assert list(first.data) == list(second.data)
+
+
 def test_plan_svs(caplog, svs_input_paths, override_rule_set):
     logger.setLevel(logging.INFO)
     redact.show_redaction_plan(svs_input_paths, override_rule_set)
@@ -0,0 +1,89 @@
+from collections.abc import Generator
+import os
+from pathlib import Path
+
+from PIL import Image
+from click.testing import CliRunner
+import pytest
+
+from imagedephi.main import imagedephi
+from imagedephi.rules import FileFormat
+from imagedephi.utils.image import get_file_format_from_path
+from imagedephi.utils.metadata_index import MetadataIndex, get_metadata_index, set_metadata_index
+from imagedephi.utils.tiff import read_tiff_info
+
+
+@pytest.fixture
+def metadata_index(tmp_path: Path) -> Generator[MetadataIndex, None, None]:
+    metadata_index = MetadataIndex(tmp_path / "index" / "metadata_index.sqlite")
+    set_metadata_index(metadata_index)
+    yield metadata_index
+    set_metadata_index(None)
+
+
+def test_utils_metadata_index_get(tmp_path: Path, metadata_index: MetadataIndex) -> None:
+    image_path = tmp_path / "image.txt"
+    image_path.write_text("first")
+    extracted = []
+
+    def extract(path: Path) -> str:
+        extracted.append(path)
+        return path.read_text()
+
+    assert metadata_index.get(image_path, "text", extract) == "first"
+    assert metadata_index.get(image_path, "text", extract) == "first"
+    assert len(extracted) == 1
+    assert (metadata_index.hits, metadata_index.misses) == (1, 1)
+
+    # Values are extracted again once the file changes
+    image_path.write_text("second")
+    os.utime(image_path, ns=(0, 0))
+    assert metadata_index.get(image_path, "text", extract) == "second"
+    assert len(extracted) == 2
+
+    # Values are kept by the index across processes
+    reopened_index = MetadataIndex(metadata_index.index_path)
+    assert reopened_index.get(image_path, "text", extract) == "second"
+    assert len(extracted) == 2
+    reopened_index.close()
+
+    image_path.unlink()
+    assert metadata_index.prune(tmp_path) == 1
+
+
+def test_utils_metadata_index_read_through(tmp_path: Path, metadata_index: MetadataIndex) -> None:
+    image_path = tmp_path / "image.tif"
+    Image.new("RGB", (64, 64)).save(image_path, tiffinfo={305: "Scanner"})
+
+    assert get_file_format_from_path(image_path) == FileFormat.TIFF
+    first_info = read_tiff_info(image_path)
+    assert get_file_format_from_path(image_path) == FileFormat.TIFF
+    second_info = read_tiff_info(image_path)
+
+    assert (metadata_index.hits, metadata_index.misses) == (2, 2)
+    assert second_info["ifds"][0]["tags"] == first_info["ifds"][0]["tags"]
+    assert second_info["ifds"][0]["path_or_fobj"] == image_path
+    # Each read returns its own copy, which plans can modify
+    assert second_info["ifds"][0] is not first_info["ifds"][0]
+
+
+def test_utils_metadata_index_command(tmp_path: Path, cli_runner: CliRunner) -> None:
+    image_dir = tmp_path / "images"
+    image_dir.mkdir()
+    Image.new("RGB", (64, 64)).save(image_dir / "image.tif")
+    index_path = tmp_path / "metadata_index.sqlite"
+
+    result = cli_runner.invoke(
+        imagedephi, ["--metadata-index", str(index_path), "index", str(image_dir)]
+    )
+
+    assert result.exit_code == 0
+    assert "Indexed 1 image(s)" in result.output
+    metadata_index = get_metadata_index()
+    assert metadata_index is not None
+    assert metadata_index.misses == 2
+
+    hits = metadata_index.hits
+    read_tiff_info(image_dir / "image.tif")
+    assert (metadata_index.hits, metadata_index.misses) == (hits + 1, 2)
+    set_metadata_index(None)
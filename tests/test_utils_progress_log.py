@@ -0,0 +1,61 @@
+import asyncio
+import threading
+
+import pytest
+
+from imagedephi.utils.progress_log import ProgressBroadcaster, ProgressEvent
+
+
+@pytest.mark.timeout(5)
+@pytest.mark.asyncio
+async def test_utils_progress_log_broadcast() -> None:
+    broadcaster = ProgressBroadcaster(min_interval=0)
+
+    with broadcaster.subscribe() as first, broadcaster.subscribe() as second:
+        assert broadcaster.subscriber_count == 2
+        broadcaster.publish("run", {"count": 1})
+
+        assert await first.get() == {"count": 1}
+        assert await second.get() == {"count": 1}
+
+    assert broadcaster.subscriber_count == 0
+
+
+@pytest.mark.timeout(5)
+@pytest.mark.asyncio
+async def test_utils_progress_log_coalesce() -> None:
+    broadcaster = ProgressBroadcaster(min_interval=0.05)
+
+    with broadcaster.subscribe() as subscription:
+
+        def publish_all() -> None:
+            for count in range(1, 101):
+                broadcaster.publish("run", {"count": count}, final=count == 100)
+
+        thread = threading.Thread(target=publish_all)
+        thread.start()
+        thread.join()
+
+        received: list[ProgressEvent] = []
+        while not received or received[-1]["count"] != 100:
+            received.append(await subscription.get())
+
+    # The final event always arrives, but most intermediate events are dropped
+    assert len(received) < 100
+
+
+@pytest.mark.timeout(5)
+@pytest.mark.asyncio
+async def test_utils_progress_log_idle() -> None:
+    broadcaster = ProgressBroadcaster()
+
+    with broadcaster.subscribe() as subscription:
+        with pytest.raises(TimeoutError):
+            await asyncio.wait_for(subscription.get(), 0.1)
+
+
+def test_utils_progress_log_no_subscribers() -> None:
+    broadcaster = ProgressBroadcaster()
+
+    # Publishing without a running event loop or any subscribers is a no-op
+    broadcaster.publish("run", {"count": 1})
@@ -0,0 +1,66 @@
+from io import BytesIO
+import os
+from pathlib import Path
+
+from PIL import Image
+import pytest
+import tifftools
+
+from imagedephi.rules import FileFormat
+from imagedephi.utils.image import get_file_format_from_path
+from imagedephi.utils.tiff import BlockReader, get_is_svs
+
+
+@pytest.mark.parametrize(
+    "position,length",
+    [(0, 4), (10, 30), (60, 10), (95, 20), (0, 100), (120, 5)],
+)
+def test_utils_tiff_block_reader(position: int, length: int) -> None:
+    data = bytes(range(100))
+    reader = BlockReader(BytesIO(data), block_size=16)
+
+    reader.seek(position)
+    result = reader.read(length)
+
+    assert result == data[position : position + length]
+    assert reader.tell() == position + len(result)
+
+
+def test_utils_tiff_block_reader_coalesces_reads() -> None:
+    reader = BlockReader(BytesIO(bytes(100)), block_size=16)
+
+    reader.seek(40)
+    reader.read(4)
+    reader.seek(0)
+    reader.read(100)
+    reader.seek(-10, os.SEEK_END)
+    reader.read(10)
+
+    # Blocks before and after the first one are each fetched with a single read
+    assert reader.read_count == 3
+
+
+@pytest.mark.parametrize("big_endian", [False, True])
+@pytest.mark.parametrize("bigtiff", [False, True])
+@pytest.mark.parametrize(
+    "description,expected",
+    [
+        ("Aperio Image Library v10.0.50|AppMag = 40", FileFormat.SVS),
+        ("Scanner image", FileFormat.TIFF),
+        ("", FileFormat.TIFF),
+    ],
+)
+def test_utils_tiff_svs_format(
+    tmp_path: Path, big_endian: bool, bigtiff: bool, description: str, expected: FileFormat
+) -> None:
+    image_path = tmp_path / "image.tif"
+    Image.new("RGB", (8, 8)).save(image_path, description=description)
+    tifftools.write_tiff(
+        tifftools.read_tiff(image_path),
+        tmp_path / "converted.tif",
+        bigEndian=big_endian,
+        bigtiff=bigtiff,
+    )
+
+    assert get_file_format_from_path(tmp_path / "converted.tif") == expected
+    assert get_is_svs(tmp_path / "converted.tif") is (expected == FileFormat.SVS)